@@ -0,0 +1 @@
+"""Benchmarks of the server, which run on a CPU-only machine with the stand-in models of fake_models."""
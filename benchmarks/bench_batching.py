@@ -0,0 +1,84 @@
+"""
+Throughput of the cross-session SAM2 prompt batching scheduler, on the CPU with a tiny 
+stand-in for the SAM2 prompt decoder that has the same call signature as Sam2Model. Like 
+the real decoder on a GPU, the stand-in is dominated by per-call overhead, which is what 
+batching amortizes; with compute-bound decoders on a CPU the gain shrinks.
+
+    python -m benchmarks.bench_batching --sessions 20 --clicks 25
+"""
+import argparse
+import threading
+import time
+from types import SimpleNamespace
+import torch
+from itksnap_dls.batching import BatchScheduler
+from itksnap_dls.segment import SAM2Wrapper
+
+
+class TinySam2Decoder(torch.nn.Module):
+    """Small convolutional decoder over cached image embeddings, conditioned on the points."""
+    
+    def __init__(self, channels: int = 32):
+        super().__init__()
+        self.point_embed = torch.nn.Linear(3, channels)
+        self.conv1 = torch.nn.Conv2d(channels, channels, 3, padding=1)
+        self.conv2 = torch.nn.Conv2d(channels, 1, 1)
+        
+    def forward(self, image_embeddings, input_points, input_labels, multimask_output=False):
+        prompts = torch.cat([input_points[:, 0], input_labels[:, 0, :, None].float()], dim=-1)
+        query = self.point_embed(prompts).mean(dim=1)[:, :, None, None]
+        x = torch.relu(self.conv1(image_embeddings[-1] + query))
+        return SimpleNamespace(pred_masks=self.conv2(x)[:, None])
+
+
+def run_sessions(decode, n_sessions: int, n_clicks: int, channels: int, size: int):
+    """
+    Each session clicks n_clicks times in its own thread, returns clicks per second. Like the
+    server, each session decodes under its own lock, so sessions do not wait for each other.
+    """
+    def session():
+        lock = threading.Lock()
+        embeddings = [ torch.randn(1, channels, size, size) ]
+        for i in range(n_clicks):
+            points = torch.rand(1, 1, 1, 2) * 1024
+            labels = torch.ones(1, 1, 1, dtype=torch.int32)
+            with lock:
+                decode((embeddings, points, labels))
+    
+    threads = [ threading.Thread(target=session) for _ in range(n_sessions) ]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return n_sessions * n_clicks / (time.perf_counter() - t0)
+
+
+def run(n_sessions: int, n_clicks: int, window: float, channels: int = 32, size: int = 16):
+    model = TinySam2Decoder(channels).eval()
+    
+    # One decoder pass per click, concurrent across sessions
+    decode_single = lambda request: SAM2Wrapper.decode_prompt_batch(model, [request])[0]
+    unbatched = run_sessions(decode_single, n_sessions, n_clicks, channels, size)
+    
+    # Clicks batched across sessions
+    scheduler = BatchScheduler(lambda reqs: SAM2Wrapper.decode_prompt_batch(model, reqs), window=window)
+    decode_batched = lambda request: scheduler.submit(tuple(request[1].shape), request)
+    batched = run_sessions(decode_batched, n_sessions, n_clicks, channels, size)
+    
+    stats = scheduler.stats()
+    print(f'{n_sessions} sessions x {n_clicks} clicks, {window * 1000:0.1f} ms window')
+    print(f'  unbatched: {unbatched:8.1f} clicks/s')
+    print(f'  batched:   {batched:8.1f} clicks/s ({batched / unbatched:0.2f}x)')
+    print(f'  mean batch size {stats["mean_batch_size"]:0.2f}, mean queue wait {stats["mean_queue_wait"] * 1000:0.2f} ms, '
+          f'max queue wait {stats["max_queue_wait"] * 1000:0.2f} ms')
+    return { "unbatched": unbatched, "batched": batched, "scheduler": stats }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark cross-session prompt batching")
+    parser.add_argument("--sessions", type=int, default=20, help="Number of concurrent sessions")
+    parser.add_argument("--clicks", type=int, default=25, help="Number of clicks per session")
+    parser.add_argument("--window-ms", type=float, default=2.0, help="Batching window in milliseconds")
+    args = parser.parse_args()
+    run(args.sessions, args.clicks, args.window_ms / 1000.0)
@@ -0,0 +1,58 @@
+"""
+Micro-benchmark of the result codecs: encode time and payload size on realistic masks.
+
+    python -m benchmarks.bench_codecs --shape 400 512 512
+"""
+import argparse
+import base64
+import gzip
+import time
+import numpy as np
+from itksnap_dls.codec import encode_mask, available_codecs
+
+
+def make_mask(shape, n_blobs: int = 3, seed: int = 0) -> np.ndarray:
+    """A few ellipsoids with a noisy boundary, similar to an organ or lesion segmentation."""
+    rng = np.random.default_rng(seed)
+    grid = np.ogrid[tuple(slice(0, n) for n in shape)]
+    mask = np.zeros(shape, dtype=np.uint8)
+    for _ in range(n_blobs):
+        center = [rng.uniform(0.3, 0.7) * n for n in shape]
+        radius = [rng.uniform(0.05, 0.2) * n for n in shape]
+        dist = sum(((g - c) / r) ** 2 for g, c, r in zip(grid, center, radius))
+        mask |= (dist + rng.normal(0, 0.05, shape) < 1.0).astype(np.uint8)
+    return mask
+
+
+def time_encode(fn, repeat: int):
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        data = fn()
+        best = min(best, time.perf_counter() - t0)
+    return best, len(data)
+
+
+def run(shape, repeat: int):
+    mask = make_mask(shape)
+    print(f'Mask of shape {shape}, {mask.mean() * 100:0.2f}% foreground, {mask.size / 2**20:0.1f} MB raw')
+    results = []
+    
+    # The legacy JSON encoding: gzip at the default level, then base64
+    legacy = lambda: base64.b64encode(gzip.compress(mask.astype(np.int8).tobytes()))
+    results.append(('legacy gzip9+base64', *time_encode(legacy, repeat)))
+    for codec in available_codecs():
+        results.append((codec, *time_encode(lambda: encode_mask(mask, codec), repeat)))
+        
+    print(f'{"codec":24s} {"encode ms":>10s} {"bytes":>12s} {"ratio":>8s}')
+    for codec, t, size in results:
+        print(f'{codec:24s} {t * 1000:10.2f} {size:12d} {mask.size / max(size, 1):8.1f}')
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark result mask codecs")
+    parser.add_argument("--shape", type=int, nargs=3, default=[128, 256, 256], help="Mask shape in array order (z y x)")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of repetitions, the best time is reported")
+    args = parser.parse_args()
+    run(tuple(args.shape), args.repeat)
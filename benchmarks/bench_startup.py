@@ -0,0 +1,100 @@
+"""
+Startup time of the command line and the server, each measured in fresh processes: --help,
+importing the server module, and starting the server until /v2/models answers. Also checks
+that importing the server leaves torch, SimpleITK, huggingface_hub and transformers to the
+background import, and that the static model catalog matches the wrapper classes. Exits with
+status 1 if a check fails or a time exceeds its limit, to guard against regressions.
+
+    python -m benchmarks.bench_startup --repeat 5 --max-listen-seconds 3
+"""
+import argparse
+import json
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+# Modules that must not be imported before the server is listening
+HEAVY_MODULES = [ "torch", "SimpleITK", "huggingface_hub", "transformers" ]
+
+# Imports the server and reports the heavy modules it imported, then checks the catalog
+CHECK_IMPORTS = f"""
+import json, sys
+import itksnap_dls.server
+from itksnap_dls.catalog import get_model_listing
+heavy = [ m for m in {HEAVY_MODULES!r} if m in sys.modules ]
+static = get_model_listing()
+import itksnap_dls.segment
+print(json.dumps({{ "heavy": heavy, "catalog_matches": static == get_model_listing() }}))
+"""
+
+
+def run_python(args: list[str]) -> tuple[float, subprocess.CompletedProcess]:
+    t0 = time.perf_counter()
+    result = subprocess.run([ sys.executable ] + args, capture_output=True, text=True)
+    return time.perf_counter() - t0, result
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def time_to_listen(timeout: float) -> float:
+    """Start the server and return the time until /v2/models answers."""
+    port = free_port()
+    t0 = time.perf_counter()
+    server = subprocess.Popen([ sys.executable, "-m", "itksnap_dls", "--host", "127.0.0.1", "--port", str(port),
+                                "--no-network" ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - t0 < timeout:
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{port}/v2/models', timeout=1) as r:
+                    if r.status == 200:
+                        return time.perf_counter() - t0
+            except OSError:
+                time.sleep(0.02)
+        raise TimeoutError(f'Server did not answer within {timeout} seconds')
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def median(values: list[float]) -> float:
+    return sorted(values)[len(values) // 2]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the startup time of the command line and the server")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs of each measurement")
+    parser.add_argument("--max-help-seconds", type=float, default=None, help="Fail if --help takes longer")
+    parser.add_argument("--max-listen-seconds", type=float, default=None, help="Fail if the server takes longer to answer")
+    parser.add_argument("--output", "-o", help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    times = { "help": [], "import_server": [], "listen": [] }
+    for _ in range(args.repeat):
+        times["help"].append(run_python([ "-m", "itksnap_dls", "--help" ])[0])
+        times["import_server"].append(run_python([ "-c", "import itksnap_dls.server" ])[0])
+        times["listen"].append(time_to_listen(timeout=120.0))
+    t, checked = run_python([ "-c", CHECK_IMPORTS ])
+    checks = json.loads(checked.stdout.strip().splitlines()[-1])
+    results = { k: { "median_s": median(v), "min_s": min(v) } for k, v in times.items() }
+    results.update(checks)
+
+    for k, v in times.items():
+        print(f'{k:16s} median {median(v):6.2f} s   min {min(v):6.2f} s')
+    print(f'Heavy modules imported with the server: {", ".join(checks["heavy"]) or "none"}')
+    print(f'Static model catalog matches the wrapper classes: {checks["catalog_matches"]}')
+    if args.output:
+        with open(args.output, 'wt') as f:
+            json.dump(results, f, indent=2)
+
+    failed = bool(checks["heavy"]) or not checks["catalog_matches"]
+    for k, limit in [ ("help", args.max_help_seconds), ("listen", args.max_listen_seconds) ]:
+        if limit is not None and results[k]["median_s"] > limit:
+            print(f'{k} took {results[k]["median_s"]:.2f} s, more than the limit of {limit:.2f} s')
+            failed = True
+    sys.exit(1 if failed else 0)
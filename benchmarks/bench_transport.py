@@ -0,0 +1,103 @@
+"""
+Click-to-mask round-trip latency of the REST endpoints and of the WebSocket channel, with a
+stand-in model that paints a sphere at each click so that no network weights are needed. The
+server runs in process, so this measures the protocol and encoding overhead of each transport
+rather than network latency. Response sizes are reported as well, since over a tunnel those
+matter; the REST sizes count the body only, not the HTTP headers.
+
+    python -m benchmarks.bench_transport --shape 128 256 256 --clicks 50
+"""
+import argparse
+import gzip
+import json
+import time
+import numpy as np
+from fastapi.testclient import TestClient
+from itksnap_dls.codec import unpack_frame
+from itksnap_dls.segment import ModelWrapper
+from itksnap_dls.server import app
+from itksnap_dls.session import session_manager
+
+
+class SphereModel(ModelWrapper):
+    """Stand-in model that adds or removes a sphere around each clicked point."""
+
+    DIMENSIONS = 3
+    OBJECT_ATTRS = [ "mask" ]
+
+    def set_image_array(self, array, components=1):
+        self.mask = np.zeros(array.shape[:3], dtype=np.uint8)
+        self.grid = np.ogrid[tuple(slice(0, n) for n in self.mask.shape)]
+        self.discard_objects()
+
+    def new_object(self):
+        self.mask = np.zeros_like(self.mask)
+
+    def add_point_interaction(self, index_itk, include_interaction):
+        dist = sum((g - c) ** 2 for g, c in zip(self.grid, index_itk[::-1]))
+        self.mask[dist < 10 ** 2] = 1 if include_interaction else 0
+
+    def reset_interactions(self):
+        self.mask[:] = 0
+
+    def get_result_array(self):
+        return self.mask
+
+
+def percentiles(times: list[float]) -> str:
+    t = np.array(times) * 1000
+    return f'{np.median(t):8.2f} {np.percentile(t, 95):8.2f}'
+
+
+def run(shape, n_clicks: int, result_mode: str, codec: str):
+    client = TestClient(app)
+    session_id = session_manager.create_session(SphereModel())
+    metadata = json.dumps({ "dimensions": list(shape[::-1]), "components_per_pixel": 1, "dtype": "uint8" })
+    client.post(f'/v2/upload_raw/{session_id}', data={ "metadata": metadata },
+                files={ "file": ("image", gzip.compress(np.zeros(shape, np.uint8).tobytes())) })
+    rng = np.random.default_rng(0)
+    points = [ [ int(rng.integers(0, n)) for n in shape[::-1] ] for _ in range(n_clicks) ]
+    results = []
+
+    # REST with the legacy JSON body, and with the binary body
+    for name, headers in [('REST json+base64', {}),
+                          (f'REST {codec}', { "X-Result-Codec": codec, "X-Result-Mode": result_mode })]:
+        times, sizes = [], []
+        for point in points:
+            t0 = time.perf_counter()
+            r = client.get(f'/v2/process_point_interaction/{session_id}', headers=headers,
+                           params={ "point": point, "foreground": True })
+            times.append(time.perf_counter() - t0)
+            sizes.append(len(r.content))
+        results.append((name, times, sizes))
+        client.get(f'/v2/reset_interactions/{session_id}')
+
+    # WebSocket with binary frames
+    times, sizes = [], []
+    with client.websocket_connect(f'/v2/ws/{session_id}') as ws:
+        for i, point in enumerate(points):
+            t0 = time.perf_counter()
+            ws.send_json({ "id": i, "type": "point", "point": point, "foreground": True,
+                           "result_mode": result_mode, "codec": codec })
+            frame = ws.receive_bytes()
+            times.append(time.perf_counter() - t0)
+            sizes.append(len(frame))
+            assert unpack_frame(frame)[0]["id"] == i
+    results.append((f'WebSocket {codec}', times, sizes))
+    session_manager.delete_session(session_id)
+
+    print(f'{n_clicks} clicks on a {shape} image, result mode {result_mode}')
+    print(f'{"transport":32s} {"p50 ms":>8s} {"p95 ms":>8s} {"mean bytes":>12s}')
+    for name, times, sizes in results:
+        print(f'{name:32s} {percentiles(times)} {np.mean(sizes):12.0f}')
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark REST and WebSocket interaction round trips")
+    parser.add_argument("--shape", type=int, nargs=3, default=[64, 128, 128], help="Image shape in array order (z y x)")
+    parser.add_argument("--clicks", type=int, default=50, help="Number of clicks per transport")
+    parser.add_argument("--result-mode", default="delta", choices=["full", "delta"], help="Result mode of the binary transports")
+    parser.add_argument("--codec", default="packbits+zlib", help="Result codec of the binary transports")
+    args = parser.parse_args()
+    run(tuple(args.shape), args.clicks, args.result_mode, args.codec)
@@ -0,0 +1,153 @@
+"""
+Stand-in model wrappers for benchmarking the server without network weights. They follow the
+ModelWrapper contract of the real models (ID, DIMENSIONS, INTERACTIONS, per-object state) and
+have a configurable synthetic cost and mask pattern, so that the request handling, encoding
+and scheduling overheads can be measured on a CPU-only machine. Importing this module
+registers them, so that sessions can be started with /v2/start_session/<ID>.
+"""
+import time
+import numpy as np
+import SimpleITK as sitk
+from itksnap_dls.segment import ModelWrapper, register_model_wrapper, model_registry
+from itksnap_dls.segment import SegmentServerConfig, ProgressCallback, global_config, no_progress
+
+# Patterns that the fake models paint at each click
+PATTERNS = [ "sphere", "blob", "slab", "noise" ]
+
+
+def busy_wait(seconds: float, hold_cpu: bool):
+    """
+    Spend the given time like an inference would: either holding a CPU core, or waiting with
+    the GIL released, as a GPU inference does.
+    """
+    if seconds <= 0:
+        return
+    if not hold_cpu:
+        time.sleep(seconds)
+        return
+    end = time.perf_counter() + seconds
+    x = np.ones(4096, dtype=np.float32)
+    while time.perf_counter() < end:
+        x = np.sqrt(x * x + 1.0)
+
+
+class FakeModel(ModelWrapper):
+    """
+    Base of the stand-in models. The costs and the mask pattern are class attributes, set for
+    all fake models with FakeModel.configure.
+    """
+
+    CHANNELS = []
+    OBJECT_ATTRS = [ "mask" ]
+
+    # Synthetic costs in seconds: loading the shared weights, encoding an uploaded image, and
+    # each inference; inferences either hold a CPU core or release the GIL like a GPU would
+    load_seconds = 0.0
+    encode_seconds = 0.0
+    inference_seconds = 0.005
+    hold_cpu = False
+
+    # Pattern painted at each click and its radius in voxels
+    pattern = "sphere"
+    radius = 12
+
+    @classmethod
+    def configure(cls, **kwargs):
+        for key, value in kwargs.items():
+            if not hasattr(FakeModel, key):
+                raise AttributeError(f'Unknown fake model setting {key}')
+            setattr(FakeModel, key, value)
+
+    @classmethod
+    def load_shared(cls, config: SegmentServerConfig, progress: ProgressCallback = no_progress):
+        busy_wait(cls.load_seconds, hold_cpu=False)
+        return {}
+
+    def __init__(self, config: SegmentServerConfig = global_config, progress: ProgressCallback = no_progress):
+        super().__init__()
+        model_registry.get(type(self), config, progress)
+        self.mask = None
+        self.rng = np.random.default_rng(0)
+
+    def set_image_array(self, array: np.ndarray, components: int = 1):
+        shape = array.shape[:-1] if components > 1 else array.shape
+        self.mask = np.zeros(shape, dtype=np.uint8)
+        self.discard_objects()
+
+    def set_image(self, sitk_image: sitk.Image):
+        self.set_image_array(sitk.GetArrayViewFromImage(sitk_image), sitk_image.GetNumberOfComponentsPerPixel())
+
+    def encode_image(self):
+        busy_wait(self.encode_seconds, hold_cpu=self.hold_cpu)
+
+    def new_object(self):
+        self.mask = np.zeros_like(self.mask)
+
+    def reset_interactions(self):
+        self.mask[:] = 0
+
+    def get_result_array(self) -> np.ndarray:
+        return self.mask
+
+    def paint(self, center: list[int], value: int, ndim: int):
+        """Paint the pattern around a point in array order, in the last ndim axes around it."""
+        lo = [ max(0, c - self.radius) if i >= self.mask.ndim - ndim else c
+               for i, c in enumerate(center) ]
+        hi = [ min(n, c + self.radius + 1) if i >= self.mask.ndim - ndim else c + 1
+               for i, (c, n) in enumerate(zip(center, self.mask.shape)) ]
+        box = tuple(slice(l, h) for l, h in zip(lo, hi))
+        if self.pattern == "slab":
+            # Whole slices, which makes large changes
+            box = tuple(b if i == 0 else slice(None) for i, b in enumerate(box))
+            self.mask[box] = value
+            return
+        grid = np.ogrid[box]
+        dist = sum((g - c) ** 2 for g, c in zip(grid, center)) / self.radius ** 2
+        if self.pattern == "blob":
+            dist = dist + self.rng.normal(0, 0.1, dist.shape)
+        elif self.pattern == "noise":
+            dist = dist + self.rng.uniform(-1, 1, dist.shape)
+        region = self.mask[box]
+        region[dist < 1.0] = value
+
+
+@register_model_wrapper
+class FakeVolumeModel(FakeModel):
+    """Stand-in for a 3D model with point, scribble and lasso prompts, like nnInteractive."""
+
+    ID = "FakeVolume"
+    DIMENSIONS = 3
+    INTERACTIONS = [ "point", "scribble", "lasso" ]
+
+    def add_point_interaction(self, index_itk, include_interaction):
+        busy_wait(self.inference_seconds, self.hold_cpu)
+        self.paint(list(index_itk[::-1]), 1 if include_interaction else 0, 3)
+
+    def add_point_interactions(self, points: list[dict]):
+        # One inference for all the points, like the real 3D model
+        busy_wait(self.inference_seconds, self.hold_cpu)
+        for point in points:
+            self.paint(list(point["index_itk"][::-1]), 1 if point["include_interaction"] else 0, 3)
+
+    def add_scribble_interaction(self, sitk_image, include_interaction):
+        busy_wait(self.inference_seconds, self.hold_cpu)
+        self.mask[sitk.GetArrayViewFromImage(sitk_image) > 0] = 1 if include_interaction else 0
+
+    def add_lasso_interaction(self, sitk_image, include_interaction):
+        self.add_scribble_interaction(sitk_image, include_interaction)
+
+
+@register_model_wrapper
+class FakeSliceModel(FakeModel):
+    """
+    Stand-in for a 2D model with point prompts on the slice of the click, like SAM2. Its
+    image encoding cost is paid in the background after an upload.
+    """
+
+    ID = "FakeSlice"
+    DIMENSIONS = 2
+    INTERACTIONS = [ "point" ]
+
+    def add_point_interaction(self, index_itk, include_interaction):
+        busy_wait(self.inference_seconds, self.hold_cpu)
+        self.paint(list(index_itk[::-1]), 1 if include_interaction else 0, 2)
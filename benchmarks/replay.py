@@ -0,0 +1,244 @@
+"""
+Replays the client traffic recorded with --record-requests against a running server, with
+many simulated annotators, to find out how many one machine can serve. Each recorded session
+is one annotator, who repeats its requests with the recorded gaps between them, scaled by
+--speed; --users runs that many copies of the recording at once, staggered by --stagger
+seconds. Uploaded images and scribble or lasso prompts are replaced by synthetic stand-ins of
+the recorded size and type. The report has the latency percentiles and error rates by route,
+and how far requests fell behind their schedule, which grows once the server is saturated.
+
+    python -m itksnap_dls --record-requests traffic.jsonl ...
+    python -m benchmarks.replay traffic.jsonl --url http://localhost:8911 --users 8 --speed 2
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import time
+import zlib
+import httpx
+import numpy as np
+from itksnap_dls.codec import DEFAULT_UPLOAD_DTYPE
+
+# Routes whose request body is an image or a prompt, which are replaced by stand-ins
+UPLOAD_ROUTES = [ "/v2/upload_raw/{session_id}", "/upload_raw/{session_id}", "/v2/upload_stream/{session_id}" ]
+PROMPT_ROUTES = [ "/process_scribble_interaction/{session_id}", "/process_lasso_interaction/{session_id}" ]
+
+
+def load_recording(path: str) -> dict[str, list[dict]]:
+    """Read a recording and split it into the requests of each session, in time order."""
+    sessions = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                sessions.setdefault(record.get("session") or "-", []).append(record)
+    for records in sessions.values():
+        records.sort(key=lambda r: r["t"])
+    return sessions
+
+
+def image_shape(metadata: str) -> tuple[tuple, np.dtype]:
+    """Array shape (ITK array order, components last) and pixel type of the recorded metadata."""
+    meta = json.loads(metadata)
+    shape = tuple(meta["dimensions"][::-1])
+    if meta.get("components_per_pixel", 1) > 1:
+        shape = shape + (meta["components_per_pixel"],)
+    return shape, np.dtype(meta.get("dtype", DEFAULT_UPLOAD_DTYPE))
+
+
+class StandIns:
+    """
+    Synthetic images and prompts with the recorded size and type. They are generated before the
+    replay starts, so that generating large images does not delay the simulated users.
+    """
+
+    def __init__(self):
+        self.images = {}
+        self.prompts = {}
+
+    def prepare(self, records: list[dict], seed: str):
+        for record in records:
+            if record.get("metadata") and record["route"] in UPLOAD_ROUTES:
+                self.image(record["metadata"], seed + str(record.get("returns", {}).get("image_hash")))
+            elif record.get("metadata") and record["route"] in PROMPT_ROUTES:
+                self.prompt(record["metadata"])
+
+    def image(self, metadata: str, seed: str) -> bytes:
+        key = (metadata, seed)
+        if key not in self.images:
+            # A random slice that is repeated with a different offset on each slice, which is
+            # quick to generate and compresses about as poorly as a real image
+            shape, dtype = image_shape(metadata)
+            rng = np.random.default_rng(zlib.crc32(seed.encode()))
+            tile = rng.integers(0, 100, shape[1:], dtype=np.int32)
+            image = np.empty(shape, dtype=dtype)
+            for z in range(shape[0]):
+                image[z] = (tile + z).astype(dtype)
+            self.images[key] = gzip.compress(image.tobytes(), compresslevel=1)
+        return self.images[key]
+
+    def prompt(self, metadata: str) -> bytes:
+        """A small cube at a random place, like a scribble or the inside of a lasso."""
+        if metadata not in self.prompts:
+            shape, dtype = image_shape(metadata)
+            rng = np.random.default_rng(zlib.crc32(metadata.encode()))
+            mask = np.zeros(shape, dtype=dtype)
+            center = [ int(rng.integers(0, n)) for n in shape ]
+            mask[tuple(slice(max(0, c - 5), c + 6) for c in center)] = 1
+            self.prompts[metadata] = gzip.compress(mask.tobytes(), compresslevel=1)
+        return self.prompts[metadata]
+
+
+class Results:
+    """Latencies, errors and schedule lag of the replayed requests, by route."""
+
+    def __init__(self):
+        self.latency = {}
+        self.errors = {}
+        self.lag = []
+
+    def add(self, route: str, seconds: float, error: str, lag: float):
+        self.latency.setdefault(route, []).append(seconds)
+        if error is not None:
+            self.errors.setdefault(route, {}).setdefault(error, 0)
+            self.errors[route][error] += 1
+        self.lag.append(lag)
+
+    def report(self, elapsed: float) -> dict:
+        def summary(times, errors):
+            t = np.array(times) * 1000
+            n_errors = sum(errors.values())
+            return { "n": len(t), "errors": n_errors, "error_rate": n_errors / len(t),
+                     "p50_ms": float(np.percentile(t, 50)), "p95_ms": float(np.percentile(t, 95)),
+                     "p99_ms": float(np.percentile(t, 99)), "max_ms": float(t.max()),
+                     **({ "error_kinds": errors } if errors else {}) }
+        all_times = [ t for times in self.latency.values() for t in times ]
+        all_errors = {}
+        for errors in self.errors.values():
+            for kind, n in errors.items():
+                all_errors[kind] = all_errors.get(kind, 0) + n
+        lag = np.array(self.lag) * 1000
+        return { "elapsed_seconds": elapsed, "requests_per_second": len(all_times) / elapsed,
+                 "overall": summary(all_times, all_errors),
+                 "lag_ms": { "p50": float(np.percentile(lag, 50)), "p95": float(np.percentile(lag, 95)),
+                             "max": float(lag.max()) },
+                 "routes": { route: summary(times, self.errors.get(route, {}))
+                             for route, times in sorted(self.latency.items()) } }
+
+
+class SimulatedUser:
+    """Replays the requests of one recorded session."""
+
+    def __init__(self, records: list[dict], client: httpx.AsyncClient, stand_ins: StandIns, image_seed: str,
+                 ids: dict, results: Results, speed: float, max_gap: float):
+        self.records = records
+        self.client = client
+        self.stand_ins = stand_ins
+        self.image_seed = image_seed
+        self.results = results
+        self.speed = speed
+        self.max_gap = max_gap
+
+        # Session IDs and image hashes of this copy of the recording, by their recorded aliases,
+        # which are shared with the other sessions of the copy (e.g., by /v2/use_image)
+        self.ids = ids
+
+    def build_request(self, record: dict) -> dict:
+        path_params = { k: self.ids.get(v, v) for k, v in record["path_params"].items() }
+        request = { "method": record["method"], "url": record["route"].format(**path_params),
+                    "params": [ tuple(q) for q in record["query"] ], "headers": dict(record["headers"]) }
+        metadata = record.get("metadata")
+        if record["route"] in UPLOAD_ROUTES and metadata:
+            image = self.stand_ins.image(metadata, self.image_seed + str(record.get("returns", {}).get("image_hash")))
+            if "upload_stream" in record["route"]:
+                request.update(content=image)
+                request["headers"]["X-Image-Metadata"] = metadata
+            else:
+                request.update(files={ "file": ("image", image) }, data={ "metadata": metadata })
+        elif record["route"] in PROMPT_ROUTES and metadata:
+            request.update(files={ "file": ("prompt", self.stand_ins.prompt(metadata)) },
+                           data={ "metadata": metadata })
+        return request
+
+    async def run(self, start: float):
+        t_prev, t_due = self.records[0]["t"], 0.0
+        for record in self.records:
+            # Wait for the recorded gap, which is shortened by --max-gap and scaled by --speed
+            t_due += min(record["t"] - t_prev, self.max_gap) / self.speed
+            t_prev = record["t"]
+            delay = start + t_due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            lag = max(0.0, -delay)
+
+            t0 = time.perf_counter()
+            error = None
+            try:
+                response = await self.client.request(**self.build_request(record))
+                if response.status_code >= 400:
+                    error = f'HTTP {response.status_code}'
+                elif record.get("returns"):
+                    content = response.json()
+                    for key, alias in record["returns"].items():
+                        if key in content:
+                            self.ids[alias] = content[key]
+            except (httpx.HTTPError, ValueError) as e:
+                error = type(e).__name__
+            self.results.add(record["route"], time.perf_counter() - t0, error, lag)
+
+
+async def replay(sessions: dict[str, list[dict]], url: str, users: int, speed: float, max_gap: float,
+                 stagger: float, shared_images: bool, timeout: float) -> dict:
+    results = Results()
+    stand_ins = StandIns()
+    seeds = [ "" if shared_images else f'{copy}/' for copy in range(users) ]
+    for seed in set(seeds):
+        for records in sessions.values():
+            stand_ins.prepare(records, seed)
+    
+    t_first = min(records[0]["t"] for records in sessions.values())
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits) as client:
+        start = time.perf_counter()
+        tasks = []
+        for copy in range(users):
+            ids = {}
+            for records in sessions.values():
+                # Sessions start at their recorded offset, each copy of the recording later
+                offset = copy * stagger + min(records[0]["t"] - t_first, max_gap) / speed
+                user = SimulatedUser(records, client, stand_ins, seeds[copy], ids, results, speed, max_gap)
+                tasks.append(user.run(start + offset))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+    return results.report(elapsed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded client traffic against a server")
+    parser.add_argument("recording", help="File written by the server with --record-requests")
+    parser.add_argument("--url", default="http://localhost:8911", help="URL of the server (default: http://localhost:8911)")
+    parser.add_argument("--users", type=int, default=1, help="Number of copies of the recording to replay at once")
+    parser.add_argument("--stagger", type=float, default=1.0, help="Seconds between the starts of the copies")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay this many times faster than recorded")
+    parser.add_argument("--max-gap", type=float, default=float("inf"), metavar="SECONDS",
+                        help="Shorten recorded idle gaps to at most this many seconds before scaling")
+    parser.add_argument("--shared-images", action="store_true",
+                        help="Use the same stand-in image in all copies, as if the annotators worked on the same images")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Request timeout in seconds")
+    parser.add_argument("--output", "-o", help="Write the report to this JSON file")
+    args = parser.parse_args()
+
+    sessions = load_recording(args.recording)
+    report = asyncio.run(replay(sessions, args.url, args.users, args.speed, args.max_gap,
+                                args.stagger, args.shared_images, args.timeout))
+
+    print(f'{sum(map(len, sessions.values())) * args.users} requests from {len(sessions) * args.users} sessions '
+          f'in {report["elapsed_seconds"]:.1f} s, {report["requests_per_second"]:.1f} requests/s')
+    print(f'Schedule lag: p50 {report["lag_ms"]["p50"]:.1f} ms, p95 {report["lag_ms"]["p95"]:.1f} ms')
+    print(f'{"route":48s} {"n":>6s} {"errors":>7s} {"p50 ms":>8s} {"p95 ms":>8s} {"p99 ms":>8s}')
+    for route, r in [ ("all", report["overall"]) ] + list(report["routes"].items()):
+        print(f'{route:48s} {r["n"]:6d} {r["error_rate"]:7.1%} {r["p50_ms"]:8.1f} {r["p95_ms"]:8.1f} {r["p99_ms"]:8.1f}')
+    if args.output:
+        with open(args.output, 'wt') as f:
+            json.dump(report, f, indent=2)
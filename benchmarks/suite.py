@@ -0,0 +1,285 @@
+"""
+Benchmark suite that drives the server in process with the stand-in models of fake_models,
+so that it runs on a CPU-only machine without downloading weights. For each volume size it
+measures session creation, image upload and decoding, point interaction latency with the
+result encodings clients use, and the throughput of several sessions clicking at once. The
+server-side stage timings (decompress, set_image, inference, history, encode) are taken from
+the request log. Results are written as JSON, which --compare checks against an earlier run.
+
+    python -m benchmarks.suite --sizes 128x128x128 256x256x256 512x512x600 --output bench.json
+    python -m benchmarks.suite --quick --output new.json --compare bench.json
+"""
+import argparse
+import concurrent.futures
+import datetime
+import gzip
+import json
+import logging
+import os
+import platform
+import subprocess
+import time
+import numpy as np
+import torch
+from fastapi.testclient import TestClient
+from itksnap_dls.metrics import request_log
+from itksnap_dls.segment import global_config
+from itksnap_dls.server import app
+from .fake_models import FakeModel, FakeVolumeModel, PATTERNS
+
+# Result encodings of the interaction benchmark, as (name, result mode, codec), where the
+# codec None is the legacy JSON response with the gzipped raw mask voxels encoded as base64
+ENCODINGS = [ ("json+base64", "full", None),
+              ("full packbits+zlib", "full", "packbits+zlib"),
+              ("delta packbits+zlib", "delta", "packbits+zlib") ]
+
+
+class StageLog(logging.Handler):
+    """Collects the stage timings that the server writes to the request log."""
+
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.records = []
+
+    def emit(self, record: logging.LogRecord):
+        self.records.append(json.loads(record.getMessage()))
+
+    def __enter__(self):
+        self.level_before = request_log.level
+        request_log.addHandler(self)
+        request_log.setLevel(logging.DEBUG)
+        return self
+
+    def __exit__(self, *exc):
+        request_log.removeHandler(self)
+        request_log.setLevel(self.level_before)
+
+    def take(self) -> list[dict]:
+        records, self.records = self.records, []
+        return records
+
+
+def summarize(times: list[float], stages: list[dict] = ()) -> dict:
+    """Latency percentiles in milliseconds, and the median of each server-side stage."""
+    t = np.array(times) * 1000
+    summary = { "n": len(t), "p50_ms": float(np.median(t)), "p95_ms": float(np.percentile(t, 95)),
+                "mean_ms": float(np.mean(t)) }
+    for key in sorted({ k for s in stages for k in s if k.startswith('t_') }):
+        summary[f'{key[2:]}_ms'] = float(np.median([ s[key] for s in stages if key in s ]) * 1000)
+    return summary
+
+
+def make_image(shape, dtype: str, seed: int = 0) -> np.ndarray:
+    """A smooth phantom with a few bright spheres and mild noise, in array order (z, y, x)."""
+    rng = np.random.default_rng(seed)
+    grid = np.ogrid[tuple(slice(0, n) for n in shape)]
+    image = np.zeros(shape, dtype=np.float32)
+    image += grid[0] * (200.0 / shape[0])
+    for _ in range(4):
+        center = [ rng.uniform(0.2, 0.8) * n for n in shape ]
+        dist = sum(((g - c) / (0.15 * n)) ** 2 for g, c, n in zip(grid, center, shape))
+        image[dist < 1.0] += 500
+    image += rng.normal(0, 10, shape).astype(np.float32)
+    return image.astype(dtype)
+
+
+def start_session(client: TestClient, model_id: str) -> str:
+    r = client.get(f'/v2/start_session/{model_id}')
+    r.raise_for_status()
+    return r.json()["session_id"]
+
+
+def upload(client: TestClient, session_id: str, body: bytes, shape, dtype: str):
+    metadata = json.dumps({ "dimensions": list(shape[::-1]), "components_per_pixel": 1, "dtype": dtype })
+    r = client.post(f'/v2/upload_stream/{session_id}', content=body, headers={ "X-Image-Metadata": metadata })
+    r.raise_for_status()
+
+
+def click(client: TestClient, session_id: str, point: list[int], result_mode: str, codec: str):
+    params = { "point": point, "foreground": True }
+    if codec is not None:
+        params.update(result_mode=result_mode, codec=codec)
+    r = client.get(f'/v2/process_point_interaction/{session_id}', params=params)
+    r.raise_for_status()
+    return r
+
+
+def random_points(shape, n: int, seed: int) -> list[list[int]]:
+    rng = np.random.default_rng(seed)
+    return [ [ int(rng.integers(0, m)) for m in shape[::-1] ] for _ in range(n) ]
+
+
+def bench_sessions(client, log, model_id: str, repeat: int) -> dict:
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        session_id = start_session(client, model_id)
+        times.append(time.perf_counter() - t0)
+        client.get(f'/v2/end_session/{session_id}')
+    log.take()
+    return summarize(times)
+
+
+def bench_upload(client, log, model_id: str, image: np.ndarray, repeat: int) -> dict:
+    # Change a voxel for each upload, so that the image store does not recognize the image
+    times = []
+    session_id = start_session(client, model_id)
+    log.take()
+    for i in range(repeat):
+        image.flat[0] = i + 1
+        body = gzip.compress(image.tobytes(), compresslevel=1)
+        t0 = time.perf_counter()
+        upload(client, session_id, body, image.shape, image.dtype.name)
+        times.append(time.perf_counter() - t0)
+    client.get(f'/v2/end_session/{session_id}')
+    return summarize(times, [ r for r in log.take() if r["endpoint"] == "upload" ])
+
+
+def bench_interactions(client, log, model_id: str, body: bytes, image: np.ndarray, n_clicks: int) -> list[dict]:
+    results = []
+    session_id = start_session(client, model_id)
+    upload(client, session_id, body, image.shape, image.dtype.name)
+    points = random_points(image.shape, n_clicks, seed=1)
+    for name, result_mode, codec in ENCODINGS:
+        client.get(f'/v2/reset_interactions/{session_id}')
+        log.take()
+        times, sizes = [], []
+        for point in points:
+            t0 = time.perf_counter()
+            r = click(client, session_id, point, result_mode, codec)
+            times.append(time.perf_counter() - t0)
+            sizes.append(len(r.content))
+        summary = summarize(times, [ r for r in log.take() if r["endpoint"] == "handle_point_interaction" ])
+        results.append({ "encoding": name, "response_bytes": float(np.mean(sizes)), **summary })
+    client.get(f'/v2/end_session/{session_id}')
+    return results
+
+
+def bench_concurrent(client, log, model_id: str, body: bytes, image: np.ndarray, n_sessions: int, n_clicks: int) -> dict:
+    # All sessions use the same image, which the image store shares between them
+    session_ids = [ start_session(client, model_id) for _ in range(n_sessions) ]
+    for session_id in session_ids:
+        upload(client, session_id, body, image.shape, image.dtype.name)
+    log.take()
+
+    def session(i: int):
+        times = []
+        for point in random_points(image.shape, n_clicks, seed=100 + i):
+            t0 = time.perf_counter()
+            click(client, session_ids[i], point, "delta", "packbits+zlib")
+            times.append(time.perf_counter() - t0)
+        return times
+
+    t0 = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(n_sessions) as pool:
+        times = [ t for ts in pool.map(session, range(n_sessions)) for t in ts ]
+    elapsed = time.perf_counter() - t0
+    for session_id in session_ids:
+        client.get(f'/v2/end_session/{session_id}')
+    summary = summarize(times, [ r for r in log.take() if r["endpoint"] == "handle_point_interaction" ])
+    return { "sessions": n_sessions, "clicks_per_second": len(times) / elapsed, **summary }
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run([ "git", "rev-parse", "--short", "HEAD" ], capture_output=True, text=True,
+                                cwd=os.path.dirname(__file__)).stdout.strip() or None
+    except OSError:
+        commit = None
+    return { "commit": commit, "date": datetime.datetime.now().isoformat(timespec='seconds'),
+             "python": platform.python_version(), "numpy": np.__version__, "torch": torch.__version__,
+             "machine": platform.machine(), "processor": platform.processor(), "cpus": os.cpu_count(),
+             "workers": global_config.n_worker_threads }
+
+
+def run_suite(sizes, model_id: str, dtype: str, n_clicks: int, n_sessions: int, repeat: int) -> dict:
+    results = []
+    with TestClient(app) as client, StageLog() as log:
+        for size in sizes:
+            shape = tuple(size[::-1])
+            image = make_image(shape, dtype)
+            body = gzip.compress(image.tobytes(), compresslevel=1)
+            common = { "model": model_id, "size": list(size) }
+            print(f'Benchmarking {model_id} on {"x".join(map(str, size))} {dtype}')
+
+            results.append({ "benchmark": "session_create", **common, **bench_sessions(client, log, model_id, repeat) })
+            results.append({ "benchmark": "upload", **common, "upload_bytes": len(body),
+                             **bench_upload(client, log, model_id, image, repeat) })
+            for r in bench_interactions(client, log, model_id, body, image, n_clicks):
+                results.append({ "benchmark": "interaction", **common, **r })
+            results.append({ "benchmark": "concurrent", **common,
+                             **bench_concurrent(client, log, model_id, body, image, n_sessions, n_clicks) })
+    return results
+
+
+def result_key(r: dict) -> tuple:
+    return (r["benchmark"], r["model"], tuple(r["size"]), r.get("encoding"))
+
+
+def compare(results: list[dict], baseline: list[dict], threshold: float) -> list[str]:
+    """Report the benchmarks whose median latency grew by more than the threshold fraction."""
+    before = { result_key(r): r for r in baseline }
+    regressions = []
+    for r in results:
+        b = before.get(result_key(r))
+        if b is not None and r["p50_ms"] > b["p50_ms"] * (1 + threshold):
+            regressions.append(f'{" ".join(str(k) for k in result_key(r) if k)}: '
+                               f'p50 {b["p50_ms"]:.2f} -> {r["p50_ms"]:.2f} ms')
+    return regressions
+
+
+def parse_size(spec: str) -> list[int]:
+    size = [ int(n) for n in spec.lower().split('x') ]
+    if len(size) != 3:
+        raise argparse.ArgumentTypeError(f'invalid size "{spec}", expected XxYxZ')
+    return size
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the server with stand-in models")
+    parser.add_argument("--sizes", type=parse_size, nargs="+",
+                        help="Volume sizes in ITK order (x y z), e.g. 512x512x600 (default: 128x128x128 256x256x256 512x512x600)")
+    parser.add_argument("--quick", action="store_true", help="Small volumes and few repeats, for a smoke test")
+    parser.add_argument("--model", default=FakeVolumeModel.ID, help="Stand-in model to use (FakeVolume or FakeSlice)")
+    parser.add_argument("--dtype", default="int16", help="Pixel type of the uploaded images")
+    parser.add_argument("--clicks", type=int, default=30, help="Clicks per interaction benchmark and per concurrent session")
+    parser.add_argument("--sessions", type=int, default=4, help="Number of concurrent sessions")
+    parser.add_argument("--repeat", type=int, default=5, help="Repeats of the session creation and upload benchmarks")
+    parser.add_argument("--inference-ms", type=float, default=5.0, help="Synthetic inference cost")
+    parser.add_argument("--encode-ms", type=float, default=0.0, help="Synthetic image encoding cost")
+    parser.add_argument("--load-ms", type=float, default=0.0, help="Synthetic model loading cost")
+    parser.add_argument("--hold-cpu", action="store_true", help="Spend the inference cost on the CPU rather than waiting like a GPU")
+    parser.add_argument("--pattern", default="sphere", choices=PATTERNS, help="Mask pattern painted at each click")
+    parser.add_argument("--radius", type=int, default=12, help="Radius of the painted pattern in voxels")
+    parser.add_argument("--workers", type=int, default=global_config.n_worker_threads, help="Server worker threads")
+    parser.add_argument("--output", "-o", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare the median latencies with")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Fraction by which a median may grow before it is reported")
+    args = parser.parse_args()
+    if args.quick:
+        args.clicks, args.repeat = 10, 2
+    if args.sizes is None:
+        args.sizes = [[64, 64, 64], [128, 128, 128]] if args.quick else [[128, 128, 128], [256, 256, 256], [512, 512, 600]]
+
+    FakeModel.configure(inference_seconds=args.inference_ms / 1000, encode_seconds=args.encode_ms / 1000,
+                        load_seconds=args.load_ms / 1000, hold_cpu=args.hold_cpu,
+                        pattern=args.pattern, radius=args.radius)
+    global_config.n_worker_threads = args.workers
+    results = run_suite(args.sizes, args.model, args.dtype, args.clicks, args.sessions, args.repeat)
+    report = { "environment": environment(), "settings": { k: v for k, v in vars(args).items()
+                                                          if k not in ("output", "compare") },
+               "results": results }
+
+    print(f'{"benchmark":16s} {"size":>14s} {"encoding":22s} {"p50 ms":>8s} {"p95 ms":>8s}')
+    for r in results:
+        print(f'{r["benchmark"]:16s} {"x".join(map(str, r["size"])):>14s} {r.get("encoding", ""):22s} '
+              f'{r["p50_ms"]:8.2f} {r["p95_ms"]:8.2f}')
+    if args.output:
+        with open(args.output, 'wt') as f:
+            json.dump(report, f, indent=2)
+        print(f'Results written to {args.output}')
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f)["results"], args.threshold)
+        print('\n'.join([ 'Regressions:' ] + regressions) if regressions else 'No regressions')
+        exit(1 if regressions else 0)
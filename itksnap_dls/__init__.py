@@ -1 +1,7 @@
-from .server import app
+# The app is imported on first use, so that the command line and the tools in this package
+# do not pay for importing the server
+def __getattr__(name):
+    if name == "app":
+        from .server import app
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
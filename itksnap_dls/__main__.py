@@ -1,10 +1,14 @@
-import uvicorn
 import argparse
 import socket
 import ipaddress
-from .server import app
-from .segment import global_config
-import torch.cuda
+import logging
+from .config import global_config
+
+def parse_session_pool_spec(spec: str):
+    model_id, sep, n = spec.partition('=')
+    if not sep or not n.isdigit():
+        raise argparse.ArgumentTypeError(f'invalid value "{spec}", expected MODEL=N')
+    return model_id, int(n)
 
 def get_args():
     parser = argparse.ArgumentParser(description="ITK-SNAP deep learning segmentation server configuration")
@@ -36,7 +40,7 @@ def get_args():
     parser.add_argument(
         "--device",
         type=str,
-        default="cuda" if torch.cuda.is_available() else "cpu",
+        default=None,
         choices=["cpu", "cuda", "mps"],
         help="Torch device to use (default: 'cuda' if available, else 'cpu')"
     )
@@ -66,21 +70,91 @@ def get_args():
                         action="store_true",
                         help="Run initial setup, including downloading models, but not starting the server")
 
-    return parser.parse_args()
+    # Worker threads
+    parser.add_argument("--workers",
+                        type=int, default=4,
+                        help="Number of threads that run model inference and encoding for client requests (default: 4)")
 
-def print_gpu_info():
-    if torch.cuda.is_available():
-        device = torch.device("cuda")
-        gpu_name = torch.cuda.get_device_name(device)
-        gpu_index = torch.cuda.current_device()
-        print(f"    Using GPU {gpu_index}: {gpu_name}")
-    else:
-        print(f"    No GPU available, using CPU.")
+    # Batching of SAM2 prompts across sessions
+    parser.add_argument("--batch-window-ms",
+                        type=float, default=2.0,
+                        help="Collect SAM2 prompt decoder requests from different sessions for this many milliseconds and run them as one batch, 0 to disable (default: 2)")
+
+    # SAM2 image embedding cache
+    parser.add_argument("--embedding-cache-gb",
+                        type=float, default=1.0, metavar="GB",
+                        help="Memory budget of the SAM2 image embedding cache shared across sessions, 0 to disable (default: 1)")
+    parser.add_argument("--embedding-spill-dir",
+                        type=str, default=None,
+                        help="Directory to which embeddings evicted from the cache are written and reloaded from")
+    parser.add_argument("--embedding-spill-gb",
+                        type=float, default=None, metavar="GB",
+                        help="Disk budget of the embedding spill directory (default: no limit)")
+
+    # Undo history
+    parser.add_argument("--history-interval",
+                        type=int, default=10, metavar="N",
+                        help="Snapshot the segmentation state every N interactions for undo/redo, smaller values make undo replay fewer interactions but slow down every interaction (default: 10)")
+    parser.add_argument("--history-memory-gb",
+                        type=float, default=0.25, metavar="GB",
+                        help="Memory budget of the undo snapshots of each segmented object (default: 0.25)")
+
+    # SAM2 volume sessions
+    parser.add_argument("--volume-embedding-gb",
+                        type=float, default=0.5, metavar="GB",
+                        help="Memory budget of the slice embeddings precomputed by each SAM2 volume session (default: 0.5)")
+
+    # Request logging and debugging
+    parser.add_argument("--log-requests",
+                        action="store_true",
+                        help="Log the stage timings and payload sizes of each request as JSON lines (they are always collected in /metrics)")
+    parser.add_argument("--profile-dir",
+                        type=str, metavar="DIR",
+                        help="Write the request profiles armed with /v2/admin/profile to this directory (default: a directory in the system temp dir)")
+    parser.add_argument("--record-requests",
+                        type=str, metavar="FILE",
+                        help="Record the client requests to this file as JSON lines, without image content, for replaying them with benchmarks/replay.py")
+    parser.add_argument("--sam2-debug-dump-dir",
+                        type=str, metavar="DIR",
+                        help="Write the prompts and raw mask of each SAM2 click to this directory, for debugging")
+
+    # Waiting for sessions that are loading
+    parser.add_argument("--session-ready-timeout",
+                        type=float, default=60.0, metavar="SECONDS",
+                        help="How long requests wait for a loading session before asking the client to retry (default: 60)")
+
+    # Pinned memory for uploads
+    parser.add_argument("--pin-upload-memory",
+                        action="store_true",
+                        help="Decode uploaded images into pinned host memory for faster transfer to the GPU")
+
+    # Prepared session pool
+    parser.add_argument("--session-pool",
+                        type=parse_session_pool_spec, action="append", default=[], metavar="MODEL=N",
+                        help="Keep N warmed-up sessions ready for the given model ID (e.g., nnInteractive=2). Can be repeated.")
+
+    # Session eviction
+    parser.add_argument("--session-ttl",
+                        type=float, metavar="SECONDS",
+                        help="End sessions that have been idle for longer than this many seconds")
+    parser.add_argument("--host-memory-budget",
+                        type=float, metavar="GB",
+                        help="Evict least recently used sessions when session host memory exceeds this budget")
+    parser.add_argument("--gpu-memory-budget",
+                        type=float, metavar="GB",
+                        help="Evict least recently used sessions when session GPU memory exceeds this budget")
+    parser.add_argument("--hibernate-dir",
+                        type=str, metavar="DIR",
+                        help="Hibernate sessions to this directory instead of evicting them for memory, restoring them on their next request")
+    parser.add_argument("--hibernate-after",
+                        type=float, metavar="SECONDS",
+                        help="Hibernate sessions that have been idle for longer than this many seconds (requires --hibernate-dir)")
+
+    return parser.parse_args()
 
 def print_banner(host: str, port: int):
     print(f'***************** ITK-SNAP Deep Learning Extensions Server ******************')
 
-    print_gpu_info()
     urls = []
     
     # Get all network interfaces
@@ -111,7 +185,6 @@ def print_banner(host: str, port: int):
 def print_banner_ngrok(url: str):
     print(f'***************** ITK-SNAP Deep Learning Extensions Server ******************')
 
-    print_gpu_info()
     
     # Remove https:// from the URL
     if url.startswith("https://"):
@@ -148,15 +221,49 @@ if __name__ == "__main__":
     global_config.hf_models_path = args.models_path
     global_config.https_verify = not args.insecure
     global_config.https_enabled = not args.no_network
+    global_config.n_worker_threads = args.workers
+    global_config.sam2_batch_window = args.batch_window_ms / 1000.0
+    global_config.sam2_embedding_cache_budget = int(args.embedding_cache_gb * 2**30)
+    global_config.sam2_embedding_spill_dir = args.embedding_spill_dir
+    if args.embedding_spill_gb is not None:
+        global_config.sam2_embedding_spill_budget = int(args.embedding_spill_gb * 2**30)
+    global_config.sam2_volume_embedding_budget = int(args.volume_embedding_gb * 2**30)
+    global_config.history_snapshot_interval = args.history_interval
+    global_config.history_memory_budget = int(args.history_memory_gb * 2**30)
+    global_config.sam2_debug_dump_dir = args.sam2_debug_dump_dir
+    global_config.profile_dir = args.profile_dir
+    global_config.record_requests_path = args.record_requests
+    global_config.session_ready_timeout = args.session_ready_timeout
+    global_config.pin_upload_memory = args.pin_upload_memory
+    global_config.session_pool_sizes = dict(args.session_pool)
+    global_config.session_idle_ttl = args.session_ttl
+    if args.host_memory_budget is not None:
+        global_config.host_memory_budget = int(args.host_memory_budget * 2**30)
+    if args.gpu_memory_budget is not None:
+        global_config.device_memory_budget = int(args.gpu_memory_budget * 2**30)
+    global_config.hibernate_dir = args.hibernate_dir
+    global_config.session_hibernate_after = args.hibernate_after
+    
+    # Send the request log to the console
+    if args.log_requests:
+        from .metrics import request_log
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        request_log.addHandler(handler)
+        request_log.setLevel(logging.DEBUG)
     
     # Special mode to run setup only
     if args.setup_only:
-        from .segment import nnInteractiveWrapper, SAM2Wrapper
+        from .segment import nnInteractiveWrapper, SAM2Wrapper, model_manifest
         print(f'Running setup only, downloading models to {args.models_path}')
+        global_config.use_manifest = False
         nni = nnInteractiveWrapper(config=global_config)
+        model_manifest.record(nnInteractiveWrapper.ID, nni.model_path, global_config)
         print(f'nnInteractive Setup complete. Models are available at {nni.model_path}')
         sam = SAM2Wrapper(config=global_config)
+        model_manifest.record(SAM2Wrapper.ID, sam.model_path, global_config)
         print(f'SAM Setup complete.')
+        print(f'Model manifest written to {model_manifest.path(global_config)}')
         exit(0)
         
     # Create an ngrok session if requested
@@ -184,6 +291,9 @@ if __name__ == "__main__":
         # Print how to access the server
         print_banner(args.host, port=args.port)
     
+    # Import the server, which leaves the deep learning frameworks to a background thread
+    import uvicorn
+    from .server import app
     if args.use_colors:
         uvicorn.run(app, host=args.host, port=args.port, use_colors=True)
     else:
@@ -0,0 +1,93 @@
+import threading
+import time
+from concurrent.futures import Future
+
+
+class BatchScheduler:
+    """
+    Collects requests submitted from different threads within a short time window and runs 
+    them together through a single call to a batch function. Only requests with the same 
+    key (e.g., tensor shapes) are batched together. The batch function takes a list of 
+    payloads and returns a list of results in the same order.
+    """
+    
+    def __init__(self, run_batch, window: float = 0.002, max_batch_size: int = 16, name: str = "batch-scheduler"):
+        self.run_batch = run_batch
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.name = name
+        self.pending = []
+        self.cond = threading.Condition()
+        self.thread = None
+        
+        # Statistics
+        self.n_requests = 0
+        self.n_batches = 0
+        self.batch_sizes = {}
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        
+    def submit(self, key, payload):
+        """Submit a request and block until its result is available."""
+        future = Future()
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+                self.thread.start()
+            self.pending.append((key, payload, future, time.perf_counter()))
+            self.cond.notify()
+        return future.result()
+    
+    def _next_batch(self):
+        with self.cond:
+            while not self.pending:
+                self.cond.wait()
+                
+            # Wait for more requests until the window since the oldest request closes
+            deadline = self.pending[0][3] + self.window
+            while len(self.pending) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+                
+            # Take the requests that can be batched with the oldest one
+            key = self.pending[0][0]
+            batch, rest = [], []
+            for item in self.pending:
+                (batch if item[0] == key and len(batch) < self.max_batch_size else rest).append(item)
+            self.pending = rest
+            return batch
+    
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            t_start = time.perf_counter()
+            try:
+                results = self.run_batch([item[1] for item in batch])
+                for item, result in zip(batch, results):
+                    item[2].set_result(result)
+            except Exception as e:
+                for item in batch:
+                    item[2].set_exception(e)
+                    
+            # Update statistics
+            with self.cond:
+                waits = [t_start - item[3] for item in batch]
+                self.n_requests += len(batch)
+                self.n_batches += 1
+                self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+                self.total_wait += sum(waits)
+                self.max_wait = max(self.max_wait, max(waits))
+                
+    def stats(self) -> dict:
+        with self.cond:
+            return {
+                "requests": self.n_requests,
+                "batches": self.n_batches,
+                "mean_batch_size": self.n_requests / self.n_batches if self.n_batches else 0.0,
+                "batch_sizes": dict(sorted(self.batch_sizes.items())),
+                "mean_queue_wait": self.total_wait / self.n_requests if self.n_requests else 0.0,
+                "max_queue_wait": self.max_wait,
+                "queue_depth": len(self.pending)
+            }
@@ -0,0 +1,159 @@
+import collections
+import hashlib
+import os
+import threading
+import numpy as np
+import torch
+
+
+class EmbeddingCache:
+    """
+    Content-addressed cache of image embeddings, shared across sessions. Entries are kept in
+    memory up to a byte budget and evicted in least recently used order. If a spill directory
+    is given, evicted entries are written there and loaded back on a later hit, with the
+    oldest files removed when the directory exceeds its own budget (None for no limit).
+    """
+
+    def __init__(self, budget: int, device: str = None, spill_dir: str = None, spill_budget: int = None):
+        self.budget = budget
+        self.device = device
+        self.spill_dir = spill_dir
+        self.spill_budget = spill_budget
+        self.entries = collections.OrderedDict()
+        self.spilled = collections.OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+        # Statistics
+        self.n_hits = 0
+        self.n_disk_hits = 0
+        self.n_misses = 0
+        self.n_evictions = 0
+
+        # Pick up the entries spilled by previous runs, oldest first
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            files = [ e for e in os.scandir(spill_dir) if e.name.endswith('.pt') ]
+            for entry in sorted(files, key=lambda e: e.stat().st_mtime):
+                self.spilled[entry.name[:-3]] = entry.stat().st_size
+
+    @staticmethod
+    def key(model_id: str, array: np.ndarray) -> str:
+        """Hash of the model ID and the pixel data, shape and type of an image."""
+        h = hashlib.blake2b(digest_size=20)
+        h.update(f'{model_id}:{array.shape}:{array.dtype.str}'.encode())
+        h.update(np.ascontiguousarray(array).data)
+        return h.hexdigest()
+
+    def _spill_path(self, key: str) -> str:
+        return os.path.join(self.spill_dir, f'{key}.pt')
+
+    def __contains__(self, key: str) -> bool:
+        with self.lock:
+            return key in self.entries
+
+    def get(self, key: str):
+        """Return the cached value for a key, or None."""
+        with self.lock:
+            item = self.entries.get(key)
+            if item is not None:
+                self.entries.move_to_end(key)
+                self.n_hits += 1
+                return item[0]
+            if key not in self.spilled:
+                self.n_misses += 1
+                return None
+            self.spilled.pop(key)
+
+        # Load the spilled entry back into memory
+        try:
+            value = torch.load(self._spill_path(key), map_location=self.device, weights_only=True)
+            os.remove(self._spill_path(key))
+        except (OSError, RuntimeError) as e:
+            print(f'Failed to load spilled embedding {key}: {e}')
+            with self.lock:
+                self.n_misses += 1
+            return None
+        nbytes = sum(t.element_size() * t.nelement() for t in _tensors(value))
+        with self.lock:
+            self.n_disk_hits += 1
+        self.put(key, value, nbytes)
+        return value
+
+    def put(self, key: str, value, nbytes: int):
+        """Add a value of the given size to the cache, evicting the least recently used entries."""
+        if nbytes > self.budget:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return
+            self.entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            evicted = []
+            while self.nbytes > self.budget:
+                old_key, (old_value, old_nbytes) = self.entries.popitem(last=False)
+                self.nbytes -= old_nbytes
+                self.n_evictions += 1
+                evicted.append((old_key, old_value))
+
+        # Write the evicted entries to disk outside of the lock
+        if self.spill_dir:
+            for old_key, old_value in evicted:
+                self._spill(old_key, old_value)
+
+    def _spill(self, key: str, value):
+        path = self._spill_path(key)
+        try:
+            torch.save(_to_cpu(value), path + '.tmp')
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            print(f'Failed to spill embedding {key}: {e}')
+            return
+
+        # Remove the oldest spilled entries beyond the disk budget
+        with self.lock:
+            self.spilled[key] = os.path.getsize(path)
+            removed = []
+            while self.spill_budget is not None and sum(self.spilled.values()) > self.spill_budget:
+                removed.append(self.spilled.popitem(last=False)[0])
+        for old_key in removed:
+            try:
+                os.remove(self._spill_path(old_key))
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.nbytes,
+                "budget": self.budget,
+                "spilled_entries": len(self.spilled),
+                "spilled_bytes": sum(self.spilled.values()),
+                "hits": self.n_hits,
+                "disk_hits": self.n_disk_hits,
+                "misses": self.n_misses,
+                "evictions": self.n_evictions,
+            }
+
+
+def _tensors(value):
+    if isinstance(value, torch.Tensor):
+        yield value
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            yield from _tensors(v)
+    elif isinstance(value, dict):
+        for v in value.values():
+            yield from _tensors(v)
+
+
+def _to_cpu(value):
+    if isinstance(value, torch.Tensor):
+        return value.cpu()
+    elif isinstance(value, (list, tuple)):
+        return type(value)(_to_cpu(v) for v in value)
+    elif isinstance(value, dict):
+        return { k: _to_cpu(v) for k, v in value.items() }
+    return value
@@ -0,0 +1,73 @@
+import importlib
+from .config import SegmentServerConfig, global_config, ProgressCallback, no_progress
+
+# Model that the legacy /start_session endpoint starts a session with
+DEFAULT_MODEL_ID = "nnInteractive"
+
+# Static description of the models that sessions can be started with, so that they can be
+# listed without importing torch and the other frameworks that the wrappers need. Each model's
+# wrapper class is given as module:class and is only imported when a session is started.
+MODEL_CATALOG = {
+    "nnInteractive": {
+        "channels": [1], "dimensions": 3, "interactions": [ "point", "box", "scribble", "lasso" ],
+        "wrapper": "itksnap_dls.segment:nnInteractiveWrapper"
+    },
+    "SAM2": {
+        "channels": [1, 3], "dimensions": 2, "interactions": [ "point" ],
+        "wrapper": "itksnap_dls.segment:SAM2Wrapper"
+    },
+    "SAM2Volume": {
+        "channels": [1, 3], "dimensions": 3, "interactions": [ "point" ],
+        "wrapper": "itksnap_dls.segment:SAM2VolumeWrapper"
+    },
+}
+
+# Wrapper classes that were imported or registered, by model ID
+model_wrappers = {}
+
+
+def register_model_wrapper(wrapper_class):
+    """
+    Make a model wrapper class available to clients, or replace the catalog entry of a model
+    by its imported class. The class is constructed with the config and a progress callback
+    when a session is started with its ID.
+    """
+    MODEL_CATALOG[wrapper_class.ID] = {
+        "channels": wrapper_class.CHANNELS, "dimensions": wrapper_class.DIMENSIONS,
+        "interactions": wrapper_class.INTERACTIONS,
+        "wrapper": f'{wrapper_class.__module__}:{wrapper_class.__qualname__}'
+    }
+    model_wrappers[wrapper_class.ID] = wrapper_class
+    return wrapper_class
+
+
+def get_model_listing():
+    """Return a list of available models and their capabilities."""
+    model_list = []
+    for model_id, entry in MODEL_CATALOG.items():
+        model_info = {
+            "id": model_id,
+            "channels": entry["channels"],
+            "dimensions": entry["dimensions"],
+            "interactions": entry["interactions"]
+        }
+        model_list.append(model_info)
+    return model_list
+
+
+def get_model_wrapper_class(repo_id: str):
+    """The wrapper class of a model, importing its module on first use."""
+    wrapper_class = model_wrappers.get(repo_id)
+    if wrapper_class is None:
+        entry = MODEL_CATALOG.get(repo_id)
+        if entry is None:
+            raise ValueError(f"Unknown model repo ID: {repo_id}")
+        module, _, name = entry["wrapper"].partition(':')
+        wrapper_class = model_wrappers[repo_id] = getattr(importlib.import_module(module), name)
+    return wrapper_class
+
+
+def instantiate_model_wrapper(repo_id: str, config: SegmentServerConfig = global_config,
+                              progress: ProgressCallback = no_progress):
+    """Instantiate a model wrapper based on the given repo ID."""
+    return get_model_wrapper_class(repo_id)(config, progress)
@@ -0,0 +1,70 @@
+import collections
+import threading
+
+
+class PendingClick:
+    """A point prompt waiting for its session's model, and the response to send for it."""
+
+    def __init__(self, point: dict, label: str, seq: int, encode, coalesce: bool = True):
+        # Keyword arguments of add_point_interaction, the object the point is for, and the 
+        # function that encodes the result for the client, called with the session
+        self.point = point
+        self.label = label
+        self.encode = encode
+
+        # Position of the request among the session's requests, and whether it may be merged
+        self.seq = seq
+        self.coalesce = coalesce
+
+        # Set once the click was applied; superseded clicks get no result
+        self.done = False
+        self.superseded = False
+        self.response = None
+        self.error = None
+
+
+class ClickCoalescer:
+    """
+    Merges the point prompts that queue up for a session while its model is busy into one
+    inference, and skips encoding results that a later click has already superseded. Only
+    clicks for the same object that were not separated by another request are merged.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # Statistics
+        self.n_clicks = 0
+        self.n_inferences = 0
+        self.n_superseded = 0
+
+    @staticmethod
+    def can_merge(click: PendingClick, following: PendingClick) -> bool:
+        """Whether a click can run in one inference with the request that followed it."""
+        return (click.coalesce and following.coalesce and following.seq == click.seq + 1 
+                and following.label == click.label)
+
+    def take_batch(self, queue: collections.deque) -> list[PendingClick]:
+        """Take the clicks at the head of a session's queue that can run as one inference."""
+        batch = [ queue.popleft() ] if queue else []
+        while queue and self.can_merge(batch[-1], queue[0]):
+            batch.append(queue.popleft())
+        return batch
+
+    def record(self, n_clicks: int, n_superseded: int):
+        with self.lock:
+            self.n_clicks += n_clicks
+            self.n_inferences += 1
+            self.n_superseded += n_superseded
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "clicks": self.n_clicks,
+                "inferences": self.n_inferences,
+                "saved_inferences": self.n_clicks - self.n_inferences,
+                "superseded_results": self.n_superseded
+            }
+
+
+click_coalescer = ClickCoalescer()  # Singleton instance
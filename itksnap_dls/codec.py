@@ -0,0 +1,197 @@
+import numpy as np
+import gzip
+import zlib
+import hashlib
+import json
+import struct
+
+# Optional fast compressors
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+def changed_region(current: np.ndarray, previous: np.ndarray, out: np.ndarray = None) -> tuple[slice, ...]:
+    """
+    Find the bounding box of the voxels that differ between two masks of the same shape.
+    Returns a tuple of slices in array (numpy) order, or None if the masks are identical.
+    If out is given, the voxel-wise difference is written into it (it may be previous).
+    """
+    diff = np.not_equal(current, previous, out=out)
+    region = []
+    for axis in range(diff.ndim):
+        other_axes = tuple(a for a in range(diff.ndim) if a != axis)
+        nz = np.flatnonzero(diff.any(axis=other_axes))
+        if len(nz) == 0:
+            return None
+        region.append(slice(int(nz[0]), int(nz[-1]) + 1))
+    return tuple(region)
+
+
+def region_to_itk(region: tuple[slice, ...], ndim: int) -> dict:
+    """Describe a numpy-order region as an ITK-order index and size."""
+    if region is None:
+        return { "index": [0] * ndim, "size": [0] * ndim }
+    return { "index": [s.start for s in region][::-1], 
+             "size": [s.stop - s.start for s in region][::-1] }
+
+
+# Layouts turn a binary mask into bytes. Voxels are taken in array (C) order, so that the 
+# first ITK axis is the fastest
+def layout_raw(mask: np.ndarray):
+    """One byte per voxel."""
+    return np.ascontiguousarray(mask, dtype=np.uint8).reshape(-1)
+
+def layout_packbits(mask: np.ndarray):
+    """One bit per voxel, least significant bit first."""
+    return np.packbits(mask.reshape(-1), bitorder='little')
+
+def layout_rle(mask: np.ndarray):
+    """Lengths of alternating runs of zeros and ones as little-endian uint32, starting with zeros."""
+    flat = mask.reshape(-1)
+    if flat.size == 0:
+        return np.zeros(0, dtype='<u4')
+    edges = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    bounds = np.concatenate(([0], edges, [flat.size]))
+    runs = np.diff(bounds)
+    if flat[0]:
+        runs = np.concatenate(([0], runs))
+    return runs.astype('<u4')
+
+LAYOUTS = { "raw": layout_raw, "packbits": layout_packbits, "rle": layout_rle }
+
+# Compressors, using fast levels since encoding is on the interaction hot path
+COMPRESSORS = {
+    "zlib": lambda b: zlib.compress(b, 1),
+    "gzip": lambda b: gzip.compress(b, compresslevel=1),
+}
+if zstandard is not None:
+    COMPRESSORS["zstd"] = lambda b: zstandard.ZstdCompressor(level=1).compress(b)
+if lz4 is not None:
+    COMPRESSORS["lz4"] = lambda b: lz4.frame.compress(b)
+
+
+def available_codecs() -> list[str]:
+    """List the codec names supported by this server, in the form layout[+compressor]."""
+    return [ layout + (f'+{comp}' if comp else '') 
+             for layout in LAYOUTS for comp in [None] + list(COMPRESSORS) ]
+
+
+def check_codec(codec: str):
+    """Raise a ValueError if the codec is not supported."""
+    layout, _, comp = codec.partition('+')
+    if layout not in LAYOUTS or (comp and comp not in COMPRESSORS):
+        raise ValueError(f'Unsupported codec "{codec}", available codecs: {", ".join(available_codecs())}')
+
+
+def encode_mask(mask: np.ndarray, codec: str) -> bytes:
+    """Encode a binary mask with a codec given as layout[+compressor], e.g., "packbits+zstd"."""
+    check_codec(codec)
+    layout, _, comp = codec.partition('+')
+    data = LAYOUTS[layout](mask).view(np.uint8)
+    return COMPRESSORS[comp](data) if comp else data.tobytes()
+
+
+def pack_frame(header: dict, payload: bytes = b'') -> bytes:
+    """
+    Binary WebSocket frame: the length of a JSON header as a little-endian uint32, the 
+    header, and the payload (e.g., an encoded mask) in the rest of the frame.
+    """
+    data = json.dumps(header).encode()
+    return struct.pack('<I', len(data)) + data + payload
+
+
+def unpack_frame(frame: bytes) -> tuple[dict, bytes]:
+    """Split a frame made by pack_frame into its header and payload."""
+    (n,) = struct.unpack_from('<I', frame)
+    return json.loads(frame[4:4 + n]), frame[4 + n:]
+
+
+# Pixel types that clients may declare for uploaded images
+UPLOAD_DTYPES = [ "uint8", "int8", "uint16", "int16", "uint32", "int32", "float32", "float64" ]
+
+# Pixel type of uploaded images whose metadata does not give one
+DEFAULT_UPLOAD_DTYPE = "float32"
+
+# Metadata fields that, with the pixel data, identify an image in the image store
+IMAGE_KEY_FIELDS = [ "dimensions", "components_per_pixel", "dtype", "spacing", "origin", "direction" ]
+
+
+def image_key_header(metadata: dict) -> bytes:
+    """
+    Header hashed before the pixel data to identify an image: the JSON object of the key
+    fields (null if not given, float32 for a missing pixel type) with sorted keys, and a newline.
+    """
+    header = { k: metadata.get(k) for k in IMAGE_KEY_FIELDS }
+    header["dtype"] = metadata.get("dtype", DEFAULT_UPLOAD_DTYPE)
+    return json.dumps(header, sort_keys=True).encode() + b'\n'
+
+
+def allocate_array(shape, dtype, pinned: bool = False) -> np.ndarray:
+    """Allocate an uninitialized array, optionally in page-locked memory for fast GPU transfer."""
+    if pinned:
+        import torch
+        if torch.cuda.is_available():
+            nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            buffer = torch.empty(nbytes, dtype=torch.uint8, pin_memory=True).numpy()
+            return buffer.view(dtype).reshape(shape)
+    return np.empty(shape, dtype=dtype)
+
+
+class ImageDecoder:
+    """
+    Decompresses a gzipped raw image upload incrementally into a preallocated array, so that 
+    neither the whole compressed nor the whole decompressed payload is held as bytes. The 
+    metadata gives the dimensions in ITK order, the number of components per pixel and,
+    optionally, the pixel type (float32 if not given). The SHA-256 hash of the image's key
+    header and its uncompressed pixel data is computed along the way, to identify the image
+    in the image store.
+    """
+    
+    # Maximum number of decompressed bytes produced per step
+    CHUNK_SIZE = 2**22
+    
+    def __init__(self, metadata: dict, pinned: bool = False):
+        dtype = metadata.get('dtype', DEFAULT_UPLOAD_DTYPE)
+        if dtype not in UPLOAD_DTYPES:
+            raise ValueError(f'Unsupported pixel type "{dtype}", supported types: {", ".join(UPLOAD_DTYPES)}')
+        self.components = metadata['components_per_pixel']
+        shape = metadata['dimensions'][::-1] + ([self.components] if self.components != 1 else [])
+        self.array = allocate_array(shape, np.dtype(dtype).newbyteorder('<'), pinned)
+        self.buffer = self.array.reshape(-1).view(np.uint8)
+        self.offset = 0
+        self.received = 0
+        self.inflater = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+        self.hasher = hashlib.sha256(image_key_header(metadata))
+        
+    def _write(self, data: bytes):
+        n = len(data)
+        if self.offset + n > self.buffer.size:
+            raise ValueError(f'Image data exceeds the {self.buffer.size} bytes given by the metadata')
+        self.buffer[self.offset:self.offset + n] = np.frombuffer(data, dtype=np.uint8)
+        self.hasher.update(data)
+        self.offset += n
+        
+    def feed(self, chunk: bytes):
+        """Decompress the next chunk of the gzipped upload."""
+        self.received += len(chunk)
+        data = chunk
+        while data:
+            self._write(self.inflater.decompress(data, self.CHUNK_SIZE))
+            data = self.inflater.unconsumed_tail
+            
+    def finish(self) -> np.ndarray:
+        """Check that the whole image was received and return it."""
+        self._write(self.inflater.flush())
+        if self.offset != self.buffer.size:
+            raise ValueError(f'Received {self.offset} bytes of image data, expected {self.buffer.size}')
+        return self.array
+    
+    def hexdigest(self) -> str:
+        """SHA-256 hash of the image's key header and the uncompressed pixel data received so far."""
+        return self.hasher.hexdigest()
@@ -0,0 +1,73 @@
+import typing
+
+# Server configuration
+class SegmentServerConfig:
+    hf_models_path: str = None
+    device: str = None
+    n_cpu_threads = 2
+    
+    # Number of threads that run model work for client requests
+    n_worker_threads = 4
+    
+    # Window in seconds over which SAM2 prompt decoder requests from different sessions 
+    # are collected into one batch (0 to disable batching), and the maximum batch size
+    sam2_batch_window: float = 0.002
+    sam2_max_batch_size: int = 16
+    
+    # Byte budget of the SAM2 image embedding cache shared across sessions (0 to disable), and
+    # an optional directory with its own byte budget to which evicted embeddings are spilled
+    sam2_embedding_cache_budget: int = 1024 ** 3
+    sam2_embedding_spill_dir: str = None
+    sam2_embedding_spill_budget: int = None
+    
+    # Undo history: number of interactions between snapshots of an object's state, and the
+    # byte budget of the packed snapshots of each object (None for no limit)
+    history_snapshot_interval: int = 10
+    history_memory_budget: int = 256 * 1024 ** 2
+    
+    # Byte budget of the slice embeddings that each SAM2 volume session precomputes
+    sam2_volume_embedding_budget: int = 512 * 1024 ** 2
+    
+    # Directory that the SAM2 prompts and raw mask of each click are written to, for debugging
+    sam2_debug_dump_dir: str = None
+    
+    # Seconds that requests wait for a session that is still loading before asking the client to retry
+    session_ready_timeout: float = 60.0
+    https_verify = True
+    https_enabled = True
+    
+    # Resolve models from the local manifest written by --setup-only, without network access
+    use_manifest = True
+    verify_model_hashes = True
+    
+    # Decode uploaded images into pinned host memory for faster transfer to the GPU
+    pin_upload_memory = False
+    
+    # Number of warmed-up sessions to keep ready for each model ID
+    session_pool_sizes: dict[str, int] = {}
+    
+    # Session eviction: idle time in seconds and memory budgets in bytes (None for no limit)
+    session_idle_ttl: float = None
+    host_memory_budget: int = None
+    device_memory_budget: int = None
+    
+    # Session hibernation: directory that idle sessions are written to (None to disable), and 
+    # the idle time in seconds after which a session is hibernated (None to only hibernate 
+    # sessions that would otherwise be evicted to meet the memory budgets)
+    hibernate_dir: str = None
+    session_hibernate_after: float = None
+    
+    # Directory that request profiles are written to (None for a directory in the system temp dir)
+    profile_dir: str = None
+    
+    # File that client requests are recorded to for replaying them (None to not record)
+    record_requests_path: str = None
+
+# Global config
+global_config = SegmentServerConfig()
+
+# Callback for reporting model loading progress as a fraction and a message
+ProgressCallback = typing.Callable[[float, str], None]
+
+def no_progress(fraction: float, message: str):
+    pass
@@ -0,0 +1,89 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from .session import session_manager
+from .profiling import request_profiler
+
+
+class SessionExecutor:
+    """
+    Runs blocking CPU/GPU work off the asyncio event loop in a dedicated thread pool. Work 
+    for the same session is serialized in arrival order by the session's lock, while work 
+    for different sessions proceeds in parallel. Model loading runs in a separate pool, so
+    that slow downloads do not hold up interactions.
+    """
+    
+    def __init__(self, max_workers: int = 4, max_loaders: int = 2):
+        self.max_workers = max_workers
+        self.max_loaders = max_loaders
+        self.executor = None
+        self.loader = None
+        
+    def configure(self, max_workers: int):
+        self.max_workers = max_workers
+        
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="itksnap-dls")
+        return self.executor
+    
+    async def run_unlocked(self, fn, *args, **kwargs):
+        """Run work that is not tied to a session in the worker pool."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_executor(), functools.partial(fn, *args, **kwargs))
+        
+    async def run_loader(self, fn, *args, **kwargs):
+        """Run model construction in the loader pool."""
+        if self.loader is None:
+            self.loader = ThreadPoolExecutor(max_workers=self.max_loaders, thread_name_prefix="itksnap-dls-loader")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.loader, functools.partial(fn, *args, **kwargs))
+        
+    def submit_background(self, fn, *args, **kwargs):
+        """Start work in the worker pool without waiting for it, logging any failure."""
+        def report(future):
+            if future.exception() is not None:
+                print(f'Background task {getattr(fn, "__qualname__", fn)} failed: {future.exception()!r}')
+        future = self._get_executor().submit(fn, *args, **kwargs)
+        future.add_done_callback(report)
+        return future
+        
+    async def run(self, entry, fn, *args, **kwargs):
+        """Run work for a session in the worker pool, after earlier work for the session is done."""
+        entry.n_requests += 1
+        entry.n_queued += 1
+        try:
+            await entry.lock.acquire()
+        finally:
+            entry.n_queued -= 1
+        try:
+            # The session may have been hibernated while this request waited for the lock
+            if entry.state == "hibernated":
+                await self.run_unlocked(session_manager.restore, entry)
+                
+            # Profile the work if a capture is armed for the session
+            capture = request_profiler.take(entry)
+            if capture is not None:
+                return await self.run_unlocked(request_profiler.run, *capture, getattr(fn, '__name__', 'request'), 
+                                               fn, *args, **kwargs)
+            return await self.run_unlocked(fn, *args, **kwargs)
+        finally:
+            entry.lock.release()
+        
+    async def run_maintenance(self, entry, fn, *args, **kwargs):
+        """
+        Run background work on a session, such as hibernating or restoring it, under the 
+        session's lock. Unlike run, this is not counted as a request of the session, so it does
+        not separate queued clicks or use up a profiler capture armed for the session.
+        """
+        async with entry.lock:
+            return await self.run_unlocked(fn, *args, **kwargs)
+        
+    def shutdown(self):
+        for pool in (self.executor, self.loader):
+            if pool is not None:
+                pool.shutdown(wait=False)
+        self.executor = self.loader = None
+
+
+session_executor = SessionExecutor()  # Singleton instance
@@ -0,0 +1,242 @@
+import zlib
+import numpy as np
+from .lazy import is_tensor, is_blosc2_array, loaded_torch
+
+# Optional fast compressor
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def nonzero_region(array: np.ndarray) -> tuple[slice, ...]:
+    """Bounding box of the nonzero values of an array as a tuple of slices, or None if all are zero."""
+    region = []
+    for axis in range(array.ndim):
+        other_axes = tuple(a for a in range(array.ndim) if a != axis)
+        nz = np.flatnonzero(array.any(axis=other_axes))
+        if len(nz) == 0:
+            return None
+        region.append(slice(int(nz[0]), int(nz[-1]) + 1))
+    return tuple(region)
+
+
+class PackedArray:
+    """
+    Compact copy of a numpy array or tensor. Only the bounding box of the nonzero values is
+    kept, one bit per value if the values are binary and compressed otherwise.
+    """
+
+    def __init__(self, array):
+        self.device = array.device if is_tensor(array) else None
+        if self.device is not None:
+            array = array.detach().cpu().numpy()
+        self.shape, self.dtype = array.shape, array.dtype
+        self.region = nonzero_region(array) if array.ndim > 0 else ()
+        block = np.ascontiguousarray(array[self.region]) if self.region is not None else array[:0]
+        self.binary = block.dtype in (np.bool_, np.uint8) and not np.any(block > 1)
+        if self.binary:
+            self.data = np.packbits(block.reshape(-1), bitorder='little').tobytes()
+        elif zstandard is not None:
+            self.data = zstandard.ZstdCompressor(level=1).compress(block.tobytes())
+        else:
+            self.data = zlib.compress(block.tobytes(), 1)
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.data)
+
+    def unpack(self):
+        array = np.zeros(self.shape, dtype=self.dtype)
+        if self.region is not None:
+            block_shape = array[self.region].shape
+            if self.binary:
+                bits = np.unpackbits(np.frombuffer(self.data, dtype=np.uint8), count=int(np.prod(block_shape)), bitorder='little')
+                block = bits.astype(self.dtype)
+            elif zstandard is not None:
+                block = np.frombuffer(zstandard.ZstdDecompressor().decompress(self.data), dtype=self.dtype)
+            else:
+                block = np.frombuffer(zlib.decompress(self.data), dtype=self.dtype)
+            array[self.region] = block.reshape(block_shape)
+        return loaded_torch().from_numpy(array).to(self.device) if self.device is not None else array
+
+
+class PackedBlosc2Array:
+    """Copy of a blosc2 array, which is already compressed, as its serialized frame."""
+
+    def __init__(self, array):
+        self.data = array.to_cframe()
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.data)
+
+    def unpack(self):
+        import blosc2
+        return blosc2.ndarray_from_cframe(self.data, copy=True)
+
+
+def pack_state(value):
+    """Copy a model state, packing the arrays and tensors it contains."""
+    if is_blosc2_array(value):
+        return PackedBlosc2Array(value)
+    elif isinstance(value, np.ndarray) or is_tensor(value):
+        return PackedArray(value)
+    elif isinstance(value, dict):
+        return { k: pack_state(v) for k, v in value.items() }
+    elif isinstance(value, (list, tuple)):
+        return type(value)(pack_state(v) for v in value)
+    elif isinstance(value, set):
+        return set(value)
+    elif hasattr(value, 'copy'):
+        return value.copy()
+    return value
+
+
+def unpack_state(value):
+    """Restore a model state packed by pack_state, as new arrays and tensors."""
+    if isinstance(value, (PackedArray, PackedBlosc2Array)):
+        return value.unpack()
+    elif isinstance(value, dict):
+        return { k: unpack_state(v) for k, v in value.items() }
+    elif isinstance(value, (list, tuple)):
+        return type(value)(unpack_state(v) for v in value)
+    elif isinstance(value, set):
+        return set(value)
+    elif hasattr(value, 'copy'):
+        return value.copy()
+    return value
+
+
+def packed_size(value) -> int:
+    if isinstance(value, (PackedArray, PackedBlosc2Array)):
+        return value.nbytes
+    elif isinstance(value, dict):
+        return sum(packed_size(v) for v in value.values())
+    elif isinstance(value, (list, tuple)):
+        return sum(packed_size(v) for v in value)
+    return 0
+
+
+class PackedStep:
+    """
+    A history step that applies an interaction given by an array, such as the image of a
+    scribble. The array is used as is when the step is first applied, and packed when the
+    step is recorded, so that steps waiting in the history hold little memory.
+    """
+
+    def __init__(self, apply, array: np.ndarray):
+        self.apply = apply
+        self.array = array
+        self.packed = None
+
+    def pack(self):
+        if self.packed is None:
+            self.packed, self.array = PackedArray(self.array), None
+
+    @property
+    def nbytes(self) -> int:
+        return self.packed.nbytes if self.packed is not None else self.array.nbytes
+
+    def __call__(self):
+        return self.apply(self.array if self.packed is None else self.packed.unpack())
+
+
+def step_size(step) -> int:
+    return step.nbytes if isinstance(step, PackedStep) else 0
+
+
+class InteractionHistory:
+    """
+    Undo/redo history of the interactions applied to one object. Every interval steps, and
+    whenever undo or redo leaves a position, a packed snapshot of the object's state is
+    taken, and the oldest snapshots are dropped when they exceed the memory budget. Moving
+    to a position in the history restores the nearest snapshot at or before it and replays
+    the steps from there. Snapshots are costly for large states, so clicks only pay for them
+    every interval steps, while going back to a position that undo or redo left is free.
+    Position zero is the empty object. Packed steps count towards the budget too, but only
+    snapshots are dropped to meet it.
+    """
+
+    def __init__(self, interval: int = 10, budget: int = None):
+        self.interval = max(1, interval)
+        self.budget = budget
+        self.steps = []
+        self.position = 0
+        self.snapshots = {}
+        self.snapshot_bytes = 0
+        self.step_bytes = 0
+
+    @property
+    def nbytes(self) -> int:
+        return self.snapshot_bytes + self.step_bytes
+
+    def _drop_snapshot(self, position: int):
+        self.snapshot_bytes -= packed_size(self.snapshots.pop(position))
+
+    def _snapshot(self, seg):
+        if self.position in self.snapshots:
+            return
+        snapshot = seg.snapshot_object()
+        self.snapshots[self.position] = snapshot
+        self.snapshot_bytes += packed_size(snapshot)
+        while self.budget is not None and self.nbytes > self.budget and len(self.snapshots) > 1:
+            self._drop_snapshot(min(self.snapshots))
+
+    def record(self, step, seg):
+        """Record a step (a callable that applies an interaction) that was just applied to seg."""
+        self.record_all([ step ], seg)
+
+    def record_all(self, steps: list, seg):
+        """
+        Record steps that were just applied to seg together, e.g. clicks merged into one
+        inference. Each is undone separately, but a snapshot can only be taken after the last.
+        """
+        # New steps discard the steps that were undone
+        self.step_bytes -= sum(step_size(s) for s in self.steps[self.position:])
+        del self.steps[self.position:]
+        for p in [ p for p in self.snapshots if p > self.position ]:
+            self._drop_snapshot(p)
+        for step in steps:
+            if isinstance(step, PackedStep):
+                step.pack()
+            self.step_bytes += step_size(step)
+            self.steps.append(step)
+        start, self.position = self.position, self.position + len(steps)
+        if self.position // self.interval > start // self.interval:
+            self._snapshot(seg)
+
+    def _goto(self, position: int, seg):
+        # Snapshot the position being left, so that coming back to it replays no steps
+        if self.position > 0:
+            self._snapshot(seg)
+        base = max((p for p in self.snapshots if p <= position), default=0)
+        if self.position <= position and base <= self.position:
+            # Replay forward from the current state
+            base = self.position
+        elif base in self.snapshots:
+            seg.restore_object(self.snapshots[base])
+        else:
+            seg.reset_interactions()
+        for step in self.steps[base:position]:
+            step()
+        self.position = position
+        if position > base and position % self.interval == 0:
+            self._snapshot(seg)
+
+    def undo(self, seg) -> bool:
+        if self.position == 0:
+            return False
+        self._goto(self.position - 1, seg)
+        return True
+
+    def redo(self, seg) -> bool:
+        if self.position == len(self.steps):
+            return False
+        self._goto(self.position + 1, seg)
+        return True
+
+    def stats(self) -> dict:
+        return { "position": self.position, "steps": len(self.steps),
+                 "snapshots": len(self.snapshots), "snapshot_bytes": self.snapshot_bytes,
+                 "step_bytes": self.step_bytes }
@@ -0,0 +1,79 @@
+import threading
+import numpy as np
+
+
+class StoredImage:
+    """An uploaded image shared read-only by the sessions that reference it."""
+
+    def __init__(self, image_hash: str, array: np.ndarray, components: int):
+        self.image_hash = image_hash
+        self.array = array
+        self.components = components
+        self.refcount = 0
+
+        # Read-only data derived from the image by a model (e.g., its preprocessed form), by model ID
+        self.derived = {}
+
+        # Sessions must not write into an image that other sessions use
+        self.array.flags.writeable = False
+
+    def info(self) -> dict:
+        return { "image_hash": self.image_hash, "shape": list(self.array.shape),
+                 "dtype": self.array.dtype.name, "components": self.components, "sessions": self.refcount }
+
+
+class ImageStore:
+    """
+    Uploaded images keyed by the SHA-256 hash of their metadata and uncompressed pixel data
+    (see codec.image_key_header), so that sessions working on the same image share one copy and clients can skip uploading an
+    image the server already has. An image is freed when the last session using it leaves.
+    """
+
+    def __init__(self):
+        self.images: dict[str, StoredImage] = {}
+        self.lock = threading.Lock()
+        self.n_deduplicated = 0
+
+    def has(self, image_hash: str) -> bool:
+        with self.lock:
+            return image_hash in self.images
+
+    def add(self, image_hash: str, array: np.ndarray, components: int) -> StoredImage:
+        """Store an image and take a reference to it. An identical stored image is used instead if present."""
+        with self.lock:
+            stored = self.images.get(image_hash)
+            if stored is None:
+                stored = self.images[image_hash] = StoredImage(image_hash, array, components)
+            else:
+                self.n_deduplicated += 1
+            stored.refcount += 1
+            return stored
+
+    def acquire(self, image_hash: str) -> StoredImage:
+        """Take a reference to a stored image, or return None if there is no such image."""
+        with self.lock:
+            stored = self.images.get(image_hash)
+            if stored is not None:
+                stored.refcount += 1
+            return stored
+
+    def release(self, image_hash: str):
+        """Drop a reference to a stored image, freeing the image with the last one."""
+        with self.lock:
+            stored = self.images.get(image_hash)
+            if stored is not None:
+                stored.refcount -= 1
+                if stored.refcount <= 0:
+                    del self.images[image_hash]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "images": len(self.images),
+                "host_bytes": sum(s.array.nbytes for s in self.images.values()),
+                "references": sum(s.refcount for s in self.images.values()),
+                "deduplicated_uploads": self.n_deduplicated
+            }
+
+
+image_store = ImageStore()  # Singleton instance
@@ -0,0 +1,20 @@
+import sys
+
+
+def loaded_torch():
+    """
+    The torch module if it was imported, otherwise None. The server only imports torch when
+    models are loaded, and before that there are no tensors or device memory to deal with.
+    """
+    return sys.modules.get("torch")
+
+
+def is_tensor(value) -> bool:
+    torch = loaded_torch()
+    return torch is not None and isinstance(value, torch.Tensor)
+
+
+def is_blosc2_array(value) -> bool:
+    """Whether a value is a compressed blosc2 array, which nnInteractive uses for large interaction tensors."""
+    blosc2 = sys.modules.get("blosc2")
+    return blosc2 is not None and isinstance(value, blosc2.NDArray)
@@ -0,0 +1,142 @@
+import bisect
+import contextlib
+import json
+import logging
+import threading
+import time
+from .profiling import record_range
+
+# Log of per-request timings, as one JSON object per request. It is off unless the server is
+# started with --log-requests, and the records are only built when it is enabled.
+request_log = logging.getLogger("itksnap_dls.requests")
+
+# Histogram buckets for durations in seconds and for payload sizes in bytes
+SECONDS_BUCKETS = [ 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0 ]
+BYTES_BUCKETS = [ 2 ** k for k in range(8, 33, 2) ]
+
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ''
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{n}="{escape(v)}"' for n, v in zip(names, values)) + '}'
+
+
+class Histogram:
+    """A histogram with a fixed set of label names, rendered in the Prometheus text format."""
+
+    def __init__(self, name: str, help: str, labelnames: list[str], buckets: list[float]):
+        self.name, self.help = name, help
+        self.labelnames = list(labelnames)
+        self.buckets = list(buckets)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [ [0] * (len(self.buckets) + 1), 0.0 ]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def render(self) -> list[str]:
+        lines = [ f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram' ]
+        with self.lock:
+            series = [ (labels, list(counts), total) for labels, (counts, total) in self.series.items() ]
+        for labels, counts, total in sorted(series, key=lambda s: tuple(map(str, s[0]))):
+            cumulative = 0
+            for bound, count in zip(self.buckets + [ '+Inf' ], counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames + ["le"], labels + (bound,))} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, labels)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}')
+        return lines
+
+
+class Collector:
+    """A gauge or counter whose values are read from the server state when metrics are scraped."""
+
+    def __init__(self, name: str, help: str, kind: str, fn):
+        self.name, self.help, self.kind = name, help, kind
+        self.fn = fn
+
+    def render(self) -> list[str]:
+        lines = [ f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}' ]
+        for labels, value in self.fn():
+            lines.append(f'{self.name}{_format_labels(list(labels), list(labels.values()))} {value}')
+        return lines
+
+
+class MetricsRegistry:
+    """The metrics served by /metrics, in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def histogram(self, name: str, help: str, labelnames: list[str], buckets: list[float] = SECONDS_BUCKETS) -> Histogram:
+        histogram = Histogram(name, help, labelnames, buckets)
+        self.metrics.append(histogram)
+        return histogram
+
+    def collector(self, name: str, help: str, fn, kind: str = "gauge") -> Collector:
+        """Add a metric computed at scrape time by fn, which returns a list of (labels dict, value)."""
+        collector = Collector(name, help, kind, fn)
+        self.metrics.append(collector)
+        return collector
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                print(f'Failed to collect metric {metric.name}: {e!r}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()  # Singleton instance
+
+# Time spent in each stage of handling a request, and the sizes of the uploads and responses
+stage_seconds = metrics.histogram(
+    "itksnap_dls_stage_seconds", "Time spent in each stage of handling a request",
+    [ "endpoint", "model", "stage" ])
+payload_bytes = metrics.histogram(
+    "itksnap_dls_payload_bytes", "Size of the images uploaded and the results sent",
+    [ "endpoint", "model", "direction" ], BYTES_BUCKETS)
+
+
+class StageTimer:
+    """
+    Times the stages of handling one request, e.g. decompress, set_image, inference and encode,
+    recording each stage in the stage histogram and the whole request in the request log.
+    """
+
+    def __init__(self, endpoint: str, model_id: str, start: float = None):
+        self.endpoint, self.model_id = endpoint, model_id or ""
+        self.last = start if start is not None else time.perf_counter()
+        self.fields = {}
+
+    def lap(self, stage: str):
+        """End a stage that started at the end of the previous one."""
+        now = time.perf_counter()
+        stage_seconds.observe(now - self.last, self.endpoint, self.model_id, stage)
+        self.fields[f't_{stage}'] = now - self.last
+        self.last = now
+
+    @contextlib.contextmanager
+    def stage(self, stage: str):
+        """Time a stage that runs in the with block, and label it in the profiler trace if one is taken."""
+        self.last = time.perf_counter()
+        with record_range(stage):
+            yield
+        self.lap(stage)
+
+    def size(self, direction: str, nbytes: int):
+        payload_bytes.observe(nbytes, self.endpoint, self.model_id, direction)
+        self.fields[f'{direction}_bytes'] = nbytes
+
+    def log(self, **fields):
+        if request_log.isEnabledFor(logging.DEBUG):
+            request_log.debug(json.dumps({ "endpoint": self.endpoint, "model": self.model_id, **self.fields, **fields },
+                                         default=str))
@@ -0,0 +1,170 @@
+import contextlib
+import itertools
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from .lazy import loaded_torch
+
+# Whether the current thread runs a request that is being profiled
+_local = threading.local()
+
+
+def record_range(name: str):
+    """
+    Label a range in the torch profiler trace, e.g. a stage of handling a request. This is a
+    no-op unless the current thread runs a request that is being profiled.
+    """
+    if getattr(_local, 'active', False):
+        return loaded_torch().profiler.record_function(name)
+    return contextlib.nullcontext()
+
+
+class StackSampler:
+    """Samples the Python stack of one thread at a fixed interval from a background thread."""
+
+    def __init__(self, thread_id: int, interval: float = 0.001):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self.n_samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='itksnap-dls-sampler', daemon=True)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            key = ';'.join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.n_samples += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self) -> dict:
+        """Stop sampling and return the sampled stacks in folded form, root first, with their counts."""
+        self.stopped.set()
+        self.thread.join()
+        stacks = sorted(self.stacks.items(), key=lambda s: -s[1])
+        return { "interval": self.interval, "samples": self.n_samples, "stacks": dict(stacks) }
+
+
+class ProfileCapture:
+    """A capture armed for the next requests of a session or of all sessions of a model."""
+
+    def __init__(self, capture_id: str, session_id: str, model_id: str, n_requests: int, sampling: bool):
+        self.capture_id = capture_id
+        self.session_id = session_id
+        self.model_id = model_id
+        self.remaining = n_requests
+        self.sampling = sampling
+        self.n_captured = 0
+
+    def matches(self, entry) -> bool:
+        return ((self.session_id is None or self.session_id == entry.session_id) and
+                (self.model_id is None or self.model_id == entry.model_id))
+
+    def info(self) -> dict:
+        return { "capture_id": self.capture_id, "session_id": self.session_id, "model_id": self.model_id,
+                 "remaining": self.remaining, "captured": self.n_captured, "sampling": self.sampling }
+
+
+class RequestProfiler:
+    """
+    Profiles the next requests of a session or model with torch.profiler and, optionally, a
+    sampling profiler of the Python stack, writing a Chrome trace (.trace.json) and the sampled
+    stacks (.samples.json) per request to the output directory. Checking whether a request is
+    to be profiled is a single attribute test while no capture is armed.
+    """
+
+    def __init__(self):
+        self.output_dir = os.path.join(tempfile.gettempdir(), 'itksnap-dls-profiles')
+        self.captures: list[ProfileCapture] = []
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+
+    def configure(self, output_dir: str):
+        if output_dir:
+            self.output_dir = output_dir
+
+    def arm(self, session_id: str = None, model_id: str = None, n_requests: int = 1, sampling: bool = True) -> ProfileCapture:
+        capture = ProfileCapture(f'{time.strftime("%Y%m%d-%H%M%S")}-{next(self.ids)}',
+                                 session_id, model_id, n_requests, sampling)
+        with self.lock:
+            self.captures.append(capture)
+        return capture
+
+    def take(self, entry) -> tuple[ProfileCapture, int]:
+        """Return the capture that the next request of a session belongs to and its number in it, if any."""
+        if not self.captures:
+            return None
+        with self.lock:
+            for capture in self.captures:
+                if capture.matches(entry):
+                    capture.remaining -= 1
+                    capture.n_captured += 1
+                    if capture.remaining <= 0:
+                        self.captures.remove(capture)
+                    return capture, capture.n_captured
+        return None
+
+    def run(self, capture: ProfileCapture, index: int, name: str, fn, *args, **kwargs):
+        """Run a request's work in the current thread under the profilers and write the results."""
+        import torch
+        os.makedirs(self.output_dir, exist_ok=True)
+        base = os.path.join(self.output_dir, f'{capture.capture_id}-{index:03d}-{name}')
+        activities = [ torch.profiler.ProfilerActivity.CPU ]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        sampler = StackSampler(threading.get_ident()) if capture.sampling else None
+        samples = None
+        prof = torch.profiler.profile(activities=activities, record_shapes=True)
+        try:
+            with prof:
+                _local.active = True
+                if sampler is not None:
+                    sampler.start()
+                try:
+                    with torch.profiler.record_function(name):
+                        return fn(*args, **kwargs)
+                finally:
+                    _local.active = False
+                    samples = sampler.stop() if sampler is not None else None
+        finally:
+            # The trace can only be exported once the profiler has stopped
+            try:
+                prof.export_chrome_trace(base + '.trace.json')
+                if samples is not None:
+                    with open(base + '.samples.json', 'wt') as f:
+                        json.dump(samples, f)
+                print(f'Wrote profile of {name} to {base}.*.json')
+            except (OSError, RuntimeError) as e:
+                print(f'Failed to write profile {base}: {e!r}')
+
+    def list_files(self) -> list[dict]:
+        if not os.path.isdir(self.output_dir):
+            return []
+        files = [ e for e in os.scandir(self.output_dir) if e.is_file() and e.name.endswith('.json') ]
+        return [ { "name": e.name, "bytes": e.stat().st_size, "modified": e.stat().st_mtime }
+                 for e in sorted(files, key=lambda e: e.name) ]
+
+    def path(self, name: str) -> str:
+        """Path of an output file, or None if there is no such file."""
+        if os.path.basename(name) != name or not name.endswith('.json'):
+            return None
+        path = os.path.join(self.output_dir, name)
+        return path if os.path.isfile(path) else None
+
+    def stats(self) -> dict:
+        with self.lock:
+            return { "output_dir": self.output_dir, "armed": [ c.info() for c in self.captures ] }
+
+
+request_profiler = RequestProfiler()  # Singleton instance
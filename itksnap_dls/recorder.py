@@ -0,0 +1,178 @@
+import contextvars
+import hashlib
+import json
+import threading
+import time
+from urllib.parse import parse_qsl
+
+# Fields that the endpoint handling the current request adds to its record
+_notes = contextvars.ContextVar('request_recorder_notes', default=None)
+
+# Request headers that are recorded; the others, and all request and response content, are not
+RECORDED_HEADERS = [ "x-result-mode", "x-result-codec" ]
+
+# Requests that are not recorded, because they monitor the server rather than serve annotators
+EXCLUDED_PATHS = ( "/metrics", "/v2/server_stats", "/v2/admin" )
+
+# JSON responses up to this size are read for the session IDs and image hashes they return
+MAX_PARSED_RESPONSE = 65536
+
+
+class RequestRecorder:
+    """
+    Records the requests that clients make, one JSON line per request, for replaying the traffic
+    with benchmarks/replay.py. A record has the time of the request, the route and its
+    parameters, the recorded headers, the size and SHA-256 hash of the request body, the status
+    and the time taken. Session IDs and image hashes are replaced by aliases such as s1 and i1,
+    and image and prompt content is never written, only its size, hash and metadata.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.file = None
+        self.lock = threading.Lock()
+        self.t_start = None
+
+        # Aliases of session IDs and image hashes, and the last session of each client host
+        self.aliases = {}
+        self.n_aliases = { "s": 0, "i": 0 }
+        self.client_sessions = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.file is not None
+
+    def configure(self, path: str):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            self.path = path
+            if path:
+                self.file = open(path, 'at', buffering=1)
+                self.t_start = time.time()
+                print(f'Recording requests to {path}')
+
+    def alias(self, value: str, prefix: str) -> str:
+        """The alias of a session ID (prefix s) or image hash (prefix i), assigned on first use."""
+        with self.lock:
+            alias = self.aliases.get(value)
+            if alias is None:
+                self.n_aliases[prefix] += 1
+                alias = self.aliases[value] = f'{prefix}{self.n_aliases[prefix]}'
+            return alias
+
+    @staticmethod
+    def note(**fields):
+        """Add fields, such as the metadata of an uploaded image, to the current request's record."""
+        notes = _notes.get()
+        if notes is not None:
+            notes.update(fields)
+
+    def record(self, scope: dict, t_request: float, seconds: float, status: int,
+               request_bytes: int, request_hash: str, response_bytes: int, response: bytes, notes: dict):
+        route = scope.get("route")
+        path_params = dict(scope.get("path_params", {}))
+        if "session_id" in path_params:
+            path_params["session_id"] = self.alias(path_params["session_id"], "s")
+        if "image_hash" in path_params:
+            path_params["image_hash"] = self.alias(path_params["image_hash"], "i")
+
+        # Aliases of the session IDs and image hashes that the response returned
+        returns = {}
+        if response:
+            try:
+                content = json.loads(response)
+                for key, prefix in [ ("session_id", "s"), ("image_hash", "i") ]:
+                    if isinstance(content, dict) and isinstance(content.get(key), str):
+                        returns[key] = self.alias(content[key], prefix)
+            except ValueError:
+                pass
+
+        # Attribute requests without a session, e.g. /v2/has_image, to the client's last session
+        client = scope["client"][0] if scope.get("client") else None
+        session = path_params.get("session_id") or returns.get("session_id")
+        if session is not None:
+            self.client_sessions[client] = session
+        else:
+            session = self.client_sessions.get(client)
+
+        headers = { k.decode('latin-1'): v.decode('latin-1') for k, v in scope["headers"] }
+        entry = {
+            "t": round(t_request - self.t_start, 4),
+            "session": session,
+            "method": scope["method"],
+            "route": route.path if route is not None else scope["path"],
+            "path_params": path_params,
+            "query": parse_qsl(scope["query_string"].decode('latin-1'), keep_blank_values=True),
+            "headers": { k: headers[k] for k in RECORDED_HEADERS if k in headers },
+            "request_bytes": request_bytes,
+            "request_sha256": request_hash,
+            "status": status,
+            "seconds": round(seconds, 5),
+            "response_bytes": response_bytes,
+            **({ "returns": returns } if returns else {}),
+            **notes
+        }
+        with self.lock:
+            if self.file is not None:
+                self.file.write(json.dumps(entry) + '\n')
+
+
+class RecordingMiddleware:
+    """
+    ASGI middleware that passes the requests and responses through unchanged, recording them
+    with the request recorder if it is enabled. Request bodies are hashed as they stream past,
+    so uploads are not buffered.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not request_recorder.enabled or scope["path"].startswith(EXCLUDED_PATHS):
+            return await self.app(scope, receive, send)
+
+        t_request, t0 = time.time(), time.perf_counter()
+        request_hash = hashlib.sha256()
+        request_bytes, response_bytes = 0, 0
+        status, response = 500, bytearray()
+        parse_response = False
+
+        async def recording_receive():
+            nonlocal request_bytes
+            message = await receive()
+            if message["type"] == "http.request":
+                body = message.get("body", b'')
+                request_hash.update(body)
+                request_bytes += len(body)
+            return message
+
+        async def recording_send(message):
+            nonlocal status, response_bytes, parse_response
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                parse_response = any(k.lower() == b'content-type' and v.startswith(b'application/json')
+                                     for k, v in message.get("headers", []))
+            elif message["type"] == "http.response.body":
+                body = message.get("body", b'')
+                response_bytes += len(body)
+                if parse_response and len(response) + len(body) <= MAX_PARSED_RESPONSE:
+                    response.extend(body)
+            await send(message)
+
+        notes = {}
+        token = _notes.set(notes)
+        try:
+            await self.app(scope, recording_receive, recording_send)
+        finally:
+            _notes.reset(token)
+            try:
+                request_recorder.record(scope, t_request, time.perf_counter() - t0, status, request_bytes,
+                                        request_hash.hexdigest() if request_bytes else None,
+                                        response_bytes, bytes(response), notes)
+            except Exception as e:
+                print(f'Failed to record request {scope["path"]}: {e!r}')
+
+
+request_recorder = RequestRecorder()  # Singleton instance
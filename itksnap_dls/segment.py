@@ -3,21 +3,26 @@ import torch
 import SimpleITK as sitk
 import os
 import requests
-import typing
 import json
+import hashlib
+import threading
+import time
+import functools
+import logging
 import numpy as np
-from transformers import Sam2Processor, Sam2Model
+from .batching import BatchScheduler
+from .cache import EmbeddingCache
+from .image_store import StoredImage
+from .history import pack_state, unpack_state
+from .lazy import is_blosc2_array
+from .metrics import request_log, stage_seconds
+from .profiling import record_range
+from .config import SegmentServerConfig, global_config, ProgressCallback, no_progress
+from .catalog import register_model_wrapper, get_model_listing, instantiate_model_wrapper
 
-# Server configuration
-class SegmentServerConfig:
-    hf_models_path: str = None
-    device: str = None
-    n_cpu_threads = 2
-    https_verify = True
-    https_enabled = True
-
-# Global config
-global_config = SegmentServerConfig()
+# Use the GPU if there is one, unless a device was configured
+if global_config.device is None:
+    global_config.device = "cuda" if torch.cuda.is_available() else "cpu"
 
 # Configure the HTTP backend to use requests with custom settings
 def config_hf_backend():
@@ -39,6 +44,165 @@ def config_hf_backend():
         print('*** Warning: HTTPS verification is disabled! ***')
         
         
+def memory_footprint(objects) -> tuple[int, int]:
+    """Approximate (host, device) bytes held by the arrays, tensors and images among objects."""
+    host, device, seen = 0, 0, set()
+    stack = list(objects)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, torch.Tensor):
+            nbytes = obj.element_size() * obj.nelement()
+            if obj.device.type == 'cpu':
+                host += nbytes
+            else:
+                device += nbytes
+        elif isinstance(obj, np.ndarray):
+            host += obj.nbytes
+        elif is_blosc2_array(obj):
+            # Compressed in memory, e.g. nnInteractive's interactions of large images
+            host += obj.cbytes
+        elif isinstance(obj, sitk.Image):
+            host += obj.GetNumberOfPixels() * obj.GetNumberOfComponentsPerPixel() * obj.GetSizeOfPixelComponent()
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+        elif isinstance(obj, dict):
+            stack.extend(obj.values())
+    return host, device
+
+
+class ModelManifest:
+    """
+    Local record of the resolved snapshot path and file hashes of each model, written by 
+    --setup-only. Sessions resolve weights from it with no calls to the Hugging Face Hub.
+    The hashes of a model are verified the first time it is resolved in a process.
+    """
+    
+    FILENAME = "itksnap_dls_manifest.json"
+    
+    def __init__(self):
+        self.verified = set()
+        self.lock = threading.Lock()
+        
+    def path(self, config: SegmentServerConfig = global_config) -> str:
+        from huggingface_hub import constants
+        return os.path.join(config.hf_models_path or constants.HF_HUB_CACHE, self.FILENAME)
+        
+    def load(self, config: SegmentServerConfig = global_config) -> dict:
+        try:
+            with open(self.path(config), 'rt') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        
+    @staticmethod
+    def hash_file(filename: str) -> str:
+        sha = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            while chunk := f.read(2**24):
+                sha.update(chunk)
+        return sha.hexdigest()
+    
+    @staticmethod
+    def list_files(folder: str) -> list[str]:
+        files = []
+        for root, dirs, filenames in os.walk(folder, followlinks=True):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            files += [ os.path.relpath(os.path.join(root, fn), folder) for fn in filenames if not fn.startswith('.') ]
+        return sorted(files)
+        
+    def record(self, model_id: str, model_path: str, config: SegmentServerConfig = global_config):
+        """Record the resolved path of a model and the hashes of its files."""
+        with self.lock:
+            manifest = self.load(config)
+            manifest[model_id] = {
+                "path": os.path.abspath(model_path),
+                "files": { fn: self.hash_file(os.path.join(model_path, fn)) for fn in self.list_files(model_path) }
+            }
+            filename = self.path(config)
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename + '.tmp', 'wt') as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(filename + '.tmp', filename)
+            self.verified.add(model_id)
+        
+    def resolve(self, model_id: str, config: SegmentServerConfig = global_config) -> str:
+        """Return the local path of a model, or None if it is not in the manifest."""
+        if not config.use_manifest:
+            return None
+        entry = self.load(config).get(model_id)
+        if entry is None or not os.path.isdir(entry["path"]):
+            return None
+        with self.lock:
+            if config.verify_model_hashes and model_id not in self.verified:
+                t0 = time.perf_counter()
+                for fn, sha in entry["files"].items():
+                    full_path = os.path.join(entry["path"], fn)
+                    if not os.path.exists(full_path) or self.hash_file(full_path) != sha:
+                        raise RuntimeError(f'Model file {full_path} is missing or does not match the manifest, '
+                                           f'run with --setup-only to download the model again')
+                print(f'Verified {len(entry["files"])} files of model {model_id} in {time.perf_counter()-t0:0.2f} seconds')
+                self.verified.add(model_id)
+        return entry["path"]
+
+
+# Global model manifest
+model_manifest = ModelManifest()
+
+
+class ModelRegistry:
+    """
+    Process-wide registry of loaded networks. Each model is loaded once per device
+    and its weights are shared read-only by every session that uses it, so that
+    sessions only carry their own image, target buffer and prompt state.
+    """
+    
+    def __init__(self):
+        self.models = {}
+        self.lock = threading.Lock()
+        self.load_locks = {}
+        
+    def get(self, wrapper_class, config: SegmentServerConfig = global_config, progress: ProgressCallback = no_progress):
+        """Return the shared resources for a wrapper class, loading them on first use."""
+        key = (wrapper_class.ID, str(config.device))
+        with self.lock:
+            if key in self.models:
+                return self.models[key]
+            load_lock = self.load_locks.setdefault(key, threading.Lock())
+        
+        # Load outside of the registry lock so that different models can load in parallel
+        with load_lock:
+            if key not in self.models:
+                t0 = time.perf_counter()
+                shared = wrapper_class.load_shared(config, progress)
+                with self.lock:
+                    self.models[key] = shared
+                print(f'Model {wrapper_class.ID} loaded on {config.device} in {time.perf_counter()-t0:0.2f} seconds')
+            return self.models[key]
+        
+    def is_loaded(self, model_id: str) -> bool:
+        with self.lock:
+            return any(k[0] == model_id for k in self.models)
+        
+    def batching_stats(self) -> dict:
+        """Batch size and queue wait statistics of the inference schedulers of loaded models."""
+        with self.lock:
+            return { f'{model_id}@{device}': shared["scheduler"].stats() 
+                     for (model_id, device), shared in self.models.items() if shared.get("scheduler") }
+        
+    def cache_stats(self) -> dict:
+        """Occupancy and hit rates of the embedding caches of loaded models."""
+        with self.lock:
+            return { f'{model_id}@{device}': shared["embedding_cache"].stats() 
+                     for (model_id, device), shared in self.models.items() if shared.get("embedding_cache") }
+
+
+# Global model registry
+model_registry = ModelRegistry()
+        
+        
 class ModelWrapper:
     # Properties supported by this model
     ID: str = ""
@@ -52,8 +216,130 @@ class ModelWrapper:
     # Supported interaction types
     INTERACTIONS: list[str] = []
     
+    # Label of the object that a session starts with
+    DEFAULT_OBJECT = "default"
+    
+    # Attributes that hold the segmentation of one object, swapped when switching objects
+    OBJECT_ATTRS: list[str] = []
+    
     def __init__(self):
+        # The object being segmented, and the saved state of the other objects by label
+        self.current_object = self.DEFAULT_OBJECT
+        self.objects = {}
+    
+    @classmethod
+    def load_shared(cls, config: SegmentServerConfig, progress: ProgressCallback = no_progress):
+        """Load the network weights and anything else that can be shared between sessions."""
+        raise NotImplementedError
+    
+    def warm_up(self):
+        """Run a dummy inference so that lazy allocations and autotuning happen ahead of time."""
         pass
+    
+    def memory_footprint(self) -> tuple[int, int]:
+        """Approximate (host, device) bytes of per-session state, excluding shared weights."""
+        return memory_footprint(vars(self).values())
+    
+    def set_image(self, sitk_image: sitk.Image):
+        raise NotImplementedError
+    
+    def set_image_array(self, array: np.ndarray, components: int = 1):
+        """
+        Set the image from a numpy array in ITK array order, with the components in the last 
+        axis if there are more than one. Wrappers override this to avoid a SimpleITK round trip.
+        """
+        self.set_image(sitk.GetImageFromArray(array, isVector=components > 1))
+        
+    def set_shared_image(self, stored: StoredImage):
+        """
+        Set the image from the shared image store. The array is read-only and shared with other
+        sessions; wrappers may also share what they derive from it through stored.derived.
+        """
+        self.set_image_array(stored.array, stored.components)
+        
+    def encode_image(self):
+        """
+        Compute the per-image state that the first interaction needs, such as image embeddings.
+        This is called in the background after an upload; models without such state do nothing.
+        """
+        pass
+    
+    def embedding_ready(self) -> bool:
+        """Whether interactions can run without waiting for encode_image to finish."""
+        return True
+    
+    def get_object_state(self) -> dict:
+        """Return the segmentation state of the current object."""
+        return { attr: getattr(self, attr, None) for attr in self.OBJECT_ATTRS }
+    
+    def set_object_state(self, state: dict):
+        for attr, value in state.items():
+            setattr(self, attr, value)
+    
+    def new_object(self):
+        """Start an empty segmentation of a new object on the current image."""
+        raise NotImplementedError
+    
+    def select_object(self, label: str):
+        """
+        Make an object current, creating it if needed. All objects share the image, so 
+        switching between them only swaps their segmentation state.
+        """
+        if label == self.current_object:
+            return
+        self.objects[self.current_object] = self.get_object_state()
+        state = self.objects.pop(label, None)
+        if state is None:
+            self.new_object()
+        else:
+            self.set_object_state(state)
+        self.current_object = label
+        
+    def snapshot_object(self):
+        """Packed copy of the current object's state, which restore_object brings back."""
+        return pack_state(self.get_object_state())
+    
+    def restore_object(self, snapshot):
+        self.set_object_state(unpack_state(snapshot))
+        
+    def add_point_interactions(self, points: list[dict]):
+        """
+        Apply several point prompts, given as keyword arguments of add_point_interaction, that 
+        arrived while the model was busy. Models that take several prompts at once override 
+        this to run one inference for all of them.
+        """
+        for point in points:
+            self.add_point_interaction(**point)
+        
+    def delete_object(self, label: str) -> bool:
+        """Discard an object other than the current one."""
+        return self.objects.pop(label, None) is not None
+        
+    def object_labels(self) -> list[str]:
+        return [ self.current_object ] + list(self.objects)
+    
+    def discard_objects(self):
+        """Forget the other objects, whose segmentations do not apply to a new image."""
+        self.objects = {}
+        
+    def save_session_state(self) -> dict:
+        """
+        Return the state of all objects, and anything else that load_session_state needs to
+        bring the session back in a new wrapper that was given the same image.
+        """
+        objects = dict(self.objects)
+        objects[self.current_object] = self.get_object_state()
+        return { "current_object": self.current_object, "objects": objects }
+    
+    def load_session_state(self, state: dict):
+        objects = dict(state["objects"])
+        self.current_object = state["current_object"]
+        self.set_object_state(objects.pop(self.current_object))
+        self.objects = objects
+    
+    def get_result_array(self) -> np.ndarray:
+        """Return the current segmentation as a numpy array (view) in ITK array order."""
+        return sitk.GetArrayFromImage(self.get_result())
         
 
 class nnInteractiveWrapper(ModelWrapper):
@@ -67,19 +353,34 @@ class nnInteractiveWrapper(ModelWrapper):
     CHANNELS = [1]
     INTERACTIONS = [ "point", "box", "scribble", "lasso" ]
     
-    def __init__(self, config: SegmentServerConfig = global_config):
-        super().__init__()
-
-        # Set the environment variables so that nnUnet does not complain
-        os.environ['nnUNet_raw'] = '/nnUNet_raw'
-        os.environ['nnUNet_preprocessed'] = '/nnUNet_preprocessed'
-        os.environ['nnUNet_results'] = '/nnUNet_results'
+    # Inference session attributes that hold the loaded network and its configuration.
+    # These are shared by reference between sessions, everything else is per session.
+    SHARED_SESSION_ATTRS = [
+        "network", "plans_manager", "configuration_manager", "label_manager", "dataset_json", 
+        "trainer_name", "pad_mode_data", "preferred_scribble_thickness", "point_interaction", 
+        "interaction_decay", "allowed_mirroring_axes", "num_interaction_channels", 
+        "supported_interactions", "channel_mapping", "license" ]
+    
+    # Inference session attributes that hold the interactions and segmentation of one object
+    OBJECT_SESSION_ATTRS = [
+        "interactions", "_dirty_channels", "current_interaction_intensity", "_undo_log", 
+        "_last_paste_bbox", "new_interaction_centers", "new_interaction_zoom_out_factors" ]
+    OBJECT_ATTRS = [ "target_tensor" ]
+    
+    # Other private inference session attributes that sharing preprocessed images relies on.
+    # These and the object attributes are checked for, since they change between releases
+    PRIVATE_SESSION_ATTRS = [
+        "_reset_session", "_initialize_interactions", "_finish_preprocessing_and_initialize_interactions",
+        "original_image_shape", "preprocessed_image", "target_buffer" ]
+    
+    @classmethod
+    def _new_inference_session(cls, config: SegmentServerConfig):
         
         # Import nnInteractiveInferenceSession here to prevent slow startup
         from nnInteractive.inference.inference_session import nnInteractiveInferenceSession
         
         # Create an interactive session
-        self.session = nnInteractiveInferenceSession(
+        session = nnInteractiveInferenceSession(
             device=torch.device(config.device),
             use_torch_compile=False,
             verbose=False,
@@ -88,60 +389,213 @@ class nnInteractiveWrapper(ModelWrapper):
             use_pinned_memory=True
         )
         
-        # Set it as the default session factory - to allow -k flag
-        config_hf_backend()
+        # Fail rather than corrupt shared or per-object state with an untested nnInteractive
+        missing = [ attr for attr in cls.PRIVATE_SESSION_ATTRS + cls.OBJECT_SESSION_ATTRS if not hasattr(session, attr) ]
+        if missing:
+            from importlib.metadata import version
+            raise RuntimeError(f'nnInteractive {version("nnInteractive")} is not supported, its inference session '
+                               f'lacks {", ".join(missing)}. Install nnInteractive 2.6 (pip install "nnInteractive==2.6.*")')
+        return session
+    
+    @classmethod
+    def load_shared(cls, config: SegmentServerConfig, progress: ProgressCallback = no_progress):
 
-        # Download the model, optionally
-        self.model_path = hf.snapshot_download(
-            repo_id=self.HF_REPO_ID,
-            allow_patterns=[f"{self.HF_MODEL_NAME}/*"],
-            local_dir=config.hf_models_path)
-        
-        # Append the model name
-        self.model_path = os.path.join(self.model_path, self.HF_MODEL_NAME)
+        # Set the environment variables so that nnUnet does not complain
+        os.environ['nnUNet_raw'] = '/nnUNet_raw'
+        os.environ['nnUNet_preprocessed'] = '/nnUNet_preprocessed'
+        os.environ['nnUNet_results'] = '/nnUNet_results'
+        
+        # Use the locally recorded model if available
+        model_path = model_manifest.resolve(cls.ID, config)
+        if model_path is None:
+            
+            # Set it as the default session factory - to allow -k flag
+            config_hf_backend()
+
+            # Download the model, optionally
+            progress(0.1, 'Downloading model')
+            model_path = hf.snapshot_download(
+                repo_id=cls.HF_REPO_ID,
+                allow_patterns=[f"{cls.HF_MODEL_NAME}/*"],
+                local_dir=config.hf_models_path)
+            
+            # Append the model name
+            model_path = os.path.join(model_path, cls.HF_MODEL_NAME)
 
         # Print where the model was downloaded to
-        print(f'nnInteractive model available in {self.model_path}')
+        print(f'nnInteractive model available in {model_path}')
+        
+        # Load the model into a template session, whose network is then shared with all sessions
+        progress(0.5, 'Loading network')
+        template = cls._new_inference_session(config)
+        template.initialize_from_trained_model_folder(model_path)
+        return { "model_path": model_path, "template": template }
+    
+    def __init__(self, config: SegmentServerConfig = global_config, progress: ProgressCallback = no_progress):
+        super().__init__()
+        
+        # Get the shared network, loading it if this is the first session
+        shared = model_registry.get(nnInteractiveWrapper, config, progress)
+        progress(0.9, 'Creating session')
+        self.model_path = shared["model_path"]
+        
+        # Create a lightweight interactive session that references the shared network
+        self.session = self._new_inference_session(config)
+        template = shared["template"]
+        for attr in self.SHARED_SESSION_ATTRS:
+            if hasattr(template, attr):
+                setattr(self.session, attr, getattr(template, attr))
         
-        # Load the model
-        self.session.initialize_from_trained_model_folder(self.model_path)
+        # Image from the shared image store, if the image was set from there
+        self.stored_image = None
+        
+        # Held while the inference session is used, since encode_image waits for the image
+        # preprocessing in a background thread, outside of the session executor's lock
+        self.session_lock = threading.RLock()
 
-    def set_image(self, sitk_image):
+    def memory_footprint(self) -> tuple[int, int]:
+        # Include the image and interaction buffers held by the inference session, except
+        # for the preprocessed image when it is shared with other sessions through the store
+        attrs = ["preprocessed_image", "interactions", "target_buffer"]
+        if self.stored_image is not None and self.stored_image.derived.get(self.ID) is self.session.preprocessed_image:
+            attrs.remove("preprocessed_image")
+        session_state = [ getattr(self.session, attr, None) for attr in attrs ]
+        return memory_footprint(list(vars(self).values()) + session_state)
+
+    def warm_up(self):
         
-        # Read the image
+        # Segment a small random volume; the network always runs on full-size patches
+        dummy = sitk.GetImageFromArray(np.random.default_rng(0).random((32, 32, 32), dtype=np.float32))
+        self.set_image(dummy)
+        self.add_point_interaction([16, 16, 16], include_interaction=True)
+        self.reset_interactions()
+
+    def set_image(self, sitk_image):
+        self.set_image_array(sitk.GetArrayFromImage(sitk_image), sitk_image.GetNumberOfComponentsPerPixel())
         self.input_image = sitk_image
-        img = sitk.GetArrayFromImage(self.input_image)[None]  # Ensure shape (1, x, y, z)
+        
+    def set_image_array(self, array: np.ndarray, components: int = 1):
         
         # Validate input dimensions
-        if img.ndim != 4:
+        img = array[None]  # Ensure shape (1, x, y, z)
+        if img.ndim != 4 or components != 1:
             raise ValueError("Input image must be 4D with shape (1, x, y, z)")
 
-        # Set the image for this session
-        self.session.set_image(img)
-        print(f'Image set of size {img.shape}')
-        self.target_tensor = torch.zeros(img.shape[1:], dtype=torch.uint8)  # Must be 3D (x, y, z)
-        self.session.set_target_buffer(self.target_tensor)
+        # Set the image for this session, the array is passed to nnInteractive in its native dtype
+        with self.session_lock:
+            self.input_image = None
+            self.stored_image = None
+            self.discard_objects()
+            self.session.set_image(img)
+            request_log.debug('Image set of size %s', img.shape)
+            self.target_tensor = torch.zeros(img.shape[1:], dtype=torch.uint8)  # Must be 3D (x, y, z)
+            self.session.set_target_buffer(self.target_tensor)
+        
+    def set_shared_image(self, stored: StoredImage):
+        with self.session_lock:
+            # Preprocess the image unless another session has already done so
+            preprocessed = stored.derived.get(self.ID)
+            if preprocessed is None:
+                self.set_image_array(stored.array, stored.components)
+                self.stored_image = stored
+                return
+            
+            # Reuse the preprocessed image, which nnInteractive only reads, and set up this 
+            # session's interactions and target buffer as nnInteractive's set_image would
+            self.input_image = None
+            self.stored_image = stored
+            self.discard_objects()
+            self.session._reset_session()
+            self.session.original_image_shape = (1, *stored.array.shape)
+            self.session.preprocessed_image = preprocessed
+            self.session._initialize_interactions(preprocessed)
+            request_log.debug('Image set of size %s from the image store', self.session.original_image_shape)
+            self.target_tensor = torch.zeros(stored.array.shape, dtype=torch.uint8)
+            self.session.set_target_buffer(self.target_tensor)
+        
+    def get_object_state(self) -> dict:
+        with self.session_lock:
+            # The interactions are only allocated once preprocessing is done
+            self.session._finish_preprocessing_and_initialize_interactions()
+            state = super().get_object_state()
+            state["session"] = { attr: getattr(self.session, attr, None) for attr in self.OBJECT_SESSION_ATTRS }
+            return state
+    
+    def set_object_state(self, state: dict):
+        with self.session_lock:
+            # Finish preprocessing first, so that it does not overwrite the interactions set here
+            self.session._finish_preprocessing_and_initialize_interactions()
+            state = dict(state)
+            for attr, value in state.pop("session").items():
+                setattr(self.session, attr, value)
+            super().set_object_state(state)
+            self.session.set_target_buffer(self.target_tensor)
+        
+    def snapshot_object(self):
+        # nnInteractive's own single-level undo log is not kept in snapshots
+        state = self.get_object_state()
+        state["session"]["_undo_log"] = None
+        return pack_state(state)
+        
+    def new_object(self):
+        with self.session_lock:
+            if self.session.preprocessed_image is None:
+                return
+            
+            # New interactions and target buffer for the preprocessed image that all objects share
+            self.target_tensor = torch.zeros_like(self.target_tensor)
+            self.session._initialize_interactions(self.session.preprocessed_image)
+            self.session.set_target_buffer(self.target_tensor)
+            self.session._undo_log = None
+            self.session._last_paste_bbox = None
+            self.session.current_interaction_intensity = 1.0
+        
+    def encode_image(self):
+        
+        # Wait for the preprocessing and share its result with other sessions on the same image.
+        # This runs in the background, so the lock keeps it from racing with the first click
+        with self.session_lock:
+            stored = self.stored_image
+            if stored is not None and self.ID not in stored.derived:
+                self.session._finish_preprocessing_and_initialize_interactions()
+                stored.derived.setdefault(self.ID, self.session.preprocessed_image)
         
     def add_point_interaction(self, index_itk, include_interaction):        
-        self.session.add_point_interaction(tuple(index_itk[::-1]), 
-                                           include_interaction=include_interaction)
+        with self.session_lock, record_range("nninteractive_point"):
+            self.session.add_point_interaction(tuple(index_itk[::-1]), 
+                                               include_interaction=include_interaction)
+        
+    def add_point_interactions(self, points: list[dict]):
+        # Place all the points, then predict once around all of them
+        with self.session_lock, record_range("nninteractive_point"):
+            for i, point in enumerate(points):
+                self.session.add_point_interaction(tuple(point["index_itk"][::-1]), 
+                                                   include_interaction=point["include_interaction"],
+                                                   run_prediction=i == len(points) - 1)
     
     def add_scribble_interaction(self, sitk_image, include_interaction):  
         img = sitk.GetArrayFromImage(sitk_image)      
-        self.session.add_scribble_interaction(img, include_interaction=include_interaction)
+        with self.session_lock, record_range("nninteractive_scribble"):
+            self.session.add_scribble_interaction(img, include_interaction=include_interaction)
     
     def add_lasso_interaction(self, sitk_image, include_interaction):  
         img = sitk.GetArrayFromImage(sitk_image)      
-        self.session.add_lasso_interaction(img, include_interaction=include_interaction)
+        with self.session_lock, record_range("nninteractive_lasso"):
+            self.session.add_lasso_interaction(img, include_interaction=include_interaction)
     
     def reset_interactions(self):
-        self.target_tensor = torch.zeros(self.target_tensor.shape, dtype=torch.uint8)
-        self.session.set_target_buffer(self.target_tensor)
-        self.session.reset_interactions()
+        # The inference session zeroes the target buffer in place
+        with self.session_lock:
+            self.session.reset_interactions()
+        
+    def get_result_array(self) -> np.ndarray:
+        # The target buffer is a CPU tensor, so this is a view with no copy
+        return self.target_tensor.numpy()
         
     def get_result(self):
-        result = sitk.GetImageFromArray(self.target_tensor)
-        result.CopyInformation(self.input_image)
+        result = sitk.GetImageFromArray(self.get_result_array())
+        if self.input_image is not None:
+            result.CopyInformation(self.input_image)
         return result
 
 class SAM2Wrapper(ModelWrapper):
@@ -153,82 +607,236 @@ class SAM2Wrapper(ModelWrapper):
     CHANNELS = [1,3]
     INTERACTIONS = [ "point" ]
     ID = "SAM2"
+    OBJECT_ATTRS = [ "mask_arr", "mask_pt", "all_points", "all_labels" ]
     
-    def __init__(self, config: SegmentServerConfig = global_config):
+    @classmethod
+    def load_shared(cls, config: SegmentServerConfig, progress: ProgressCallback = no_progress):
+
+        # Use the locally recorded model if available, otherwise resolve it through the Hub
+        model_path = model_manifest.resolve(cls.ID, config)
+        if model_path is None:
+            # Set it as the default session factory - to allow -k flag
+            config_hf_backend()
+        
+        source = model_path or cls.HF_REPO_ID
+        lfo = model_path is not None or not config.https_enabled
+        progress(0.1, 'Loading model')
+        from transformers import Sam2Processor, Sam2Model
+        model = Sam2Model.from_pretrained(source, local_files_only=lfo).to(config.device)
+        model.eval()
+        progress(0.8, 'Loading processor')
+        processor = Sam2Processor.from_pretrained(source, local_files_only=lfo)
+        
+        # Find the snapshot that the model was loaded from in the local cache
+        if model_path is None:
+            model_path = hf.snapshot_download(cls.HF_REPO_ID, local_files_only=True)
+            
+        # Scheduler that batches prompt decoder passes across sessions
+        scheduler = None
+        if config.sam2_batch_window > 0:
+            scheduler = BatchScheduler(functools.partial(cls.decode_prompt_batch, model), 
+                                       window=config.sam2_batch_window, 
+                                       max_batch_size=config.sam2_max_batch_size,
+                                       name="sam2-prompt-batcher")
+            
+        # Cache of image embeddings, so that images seen before only need the prompt decoder
+        embedding_cache = None
+        if config.sam2_embedding_cache_budget > 0:
+            embedding_cache = EmbeddingCache(config.sam2_embedding_cache_budget, device=model.device,
+                                             spill_dir=config.sam2_embedding_spill_dir, 
+                                             spill_budget=config.sam2_embedding_spill_budget)
+        return { "model_path": model_path, "model": model, "processor": processor, 
+                 "scheduler": scheduler, "embedding_cache": embedding_cache }
+    
+    @staticmethod
+    def decode_prompt_batch(model, requests):
+        """Run the prompt decoder for a list of (image_embeddings, points, labels) in one pass."""
+        n_levels = len(requests[0][0])
+        embeddings = [ torch.cat([r[0][i] for r in requests]) for i in range(n_levels) ]
+        points = torch.cat([r[1] for r in requests])
+        labels = torch.cat([r[2] for r in requests])
+        with torch.no_grad():
+            outputs = model(image_embeddings=embeddings, input_points=points, input_labels=labels, multimask_output=False)
+        return [ outputs.pred_masks[i:i+1] for i in range(len(requests)) ]
+    
+    def __init__(self, config: SegmentServerConfig = global_config, progress: ProgressCallback = no_progress):
         super().__init__()
         self.config = config
 
-        # Set it as the default session factory - to allow -k flag
-        config_hf_backend()
+        # The model and processor are shared read-only between all SAM2 sessions
+        shared = model_registry.get(SAM2Wrapper, config, progress)
+        self.model_path = shared["model_path"]
+        self.model = shared["model"]
+        self.processor = shared["processor"]
+        self.scheduler = shared["scheduler"]
+        self.embedding_cache = shared["embedding_cache"]
+        
+        # The image and its embeddings. The embeddings are computed by encode_image, which may 
+        # run in the background while the session's requests proceed in another thread
+        self.image_arr = None
+        self.image_key = None
+        self.image_embeddings_pt = None
+        self.image_sizes = None
+        self.image_lock = threading.Lock()
+        self.encode_lock = threading.Lock()
+        self.mask_arr = None
         
-        lfo = not config.https_enabled
-        self.model = Sam2Model.from_pretrained(self.HF_REPO_ID,local_files_only=lfo).to(self.config.device)
-        self.processor = Sam2Processor.from_pretrained(self.HF_REPO_ID, local_files_only=lfo)
+    def memory_footprint(self) -> tuple[int, int]:
+        # Embeddings held by the shared cache are accounted for by its own budget
+        state = dict(vars(self))
+        if self.embedding_cache is not None and self.image_key in self.embedding_cache:
+            state.pop("image_embeddings_pt", None)
+        return memory_footprint(state.values())
+        
+    def warm_up(self):
+        
+        # Run the image encoder and the prompt decoder on a small random image
+        dummy = sitk.GetImageFromArray(np.random.default_rng(0).random((256, 256), dtype=np.float32) * 255)
+        self.set_image(dummy)
+        self.add_point_interaction([128, 128], include_interaction=True)
+        self.set_image(dummy)
         
     def set_image(self, sitk_image: sitk.Image):
+        self.set_image_array(sitk.GetArrayFromImage(sitk_image), sitk_image.GetNumberOfComponentsPerPixel())
         
-        # Get the image header information for returning masks later
+        # Keep the image header information for returning masks later
         self.image_itk = sitk_image
+        
+    def set_image_array(self, array: np.ndarray, components: int = 1):
+        self.image_itk = None
 
         # Read image and validate input dimensions
-        if sitk_image.GetNumberOfComponentsPerPixel() == 3:
-            self.image_arr = sitk.GetArrayFromImage(sitk_image)[None, :, :, :]  # Add batch dimension
-        elif sitk_image.GetNumberOfComponentsPerPixel() == 1:
-            self.image_arr = sitk.GetArrayFromImage(sitk_image)[None, :, :, None]  # Add batch and channel dimension
+        if components == 3 and array.ndim == 3:
+            image_arr = array[None, :, :, :]  # Add batch dimension
+        elif components == 1 and array.ndim == 2:
+            image_arr = array[None, :, :, None]  # Add batch and channel dimension
         else:
-            raise ValueError("Input image must have 1 or 3 components per pixel")
+            raise ValueError("Input image must be 2D with 1 or 3 components per pixel")
+        
+        # Key of the image in the embedding cache, which includes the model snapshot
+        image_key = None
+        if self.embedding_cache is not None:
+            image_key = EmbeddingCache.key(f'{self.ID}:{self.model_path}', image_arr)
         
         # Reset the mask and the embeddings
-        self.mask_pt = None
-        self.image_embeddings_pt = None
-        self.image_sizes = None
-        self.all_points = None
-        self.all_labels = None
+        with self.image_lock:
+            self.image_arr, self.image_key = image_arr, image_key
+            self.image_embeddings_pt = None
+            self.image_sizes = None
+        self.reset_interactions()
+        self.discard_objects()
+        
+    def encode_image(self):
+        # Callers wait for an encoding that is already running rather than starting their own
+        with self.encode_lock:
+            with self.image_lock:
+                image_arr, image_key = self.image_arr, self.image_key
+                if image_arr is None or self.image_embeddings_pt is not None:
+                    return
+            
+            # Reuse the embeddings of an identical image seen before by any session
+            entry = self.embedding_cache.get(image_key) if self.embedding_cache is not None else None
+            if entry is None:
+                entry = self.run_image_encoder(image_arr)
+                if self.embedding_cache is not None:
+                    self.embedding_cache.put(image_key, entry, sum(memory_footprint([entry])))
+            
+            # Keep the embeddings unless the image was replaced in the meantime
+            with self.image_lock:
+                if self.image_arr is image_arr:
+                    self.image_embeddings_pt = entry["embeddings"]
+                    self.image_sizes = entry["original_sizes"]
+                    
+    def run_image_encoder(self, image_arr: np.ndarray) -> dict:
+        """Compute the embeddings of an image with batch and channel dimensions."""
+        t0 = time.perf_counter()
+        with record_range("sam2_image_processor"):
+            inputs = self.processor(images=image_arr, return_tensors="pt")
+        with record_range("host_to_device"):
+            inputs = inputs.to(self.model.device)
+        with torch.no_grad(), record_range("sam2_image_encoder"):
+            embeddings = self.model.get_image_embeddings(inputs["pixel_values"])
+        stage_seconds.observe(time.perf_counter() - t0, "encode_image", self.ID, "image_encoder")
+        request_log.debug('SAM2 image encoder ran in %0.3f seconds', time.perf_counter() - t0)
+        return { "embeddings": list(embeddings), "original_sizes": inputs["original_sizes"] }
+                    
+    def embedding_ready(self) -> bool:
+        return self.image_embeddings_pt is not None
+    
+    def save_session_state(self) -> dict:
+        state = super().save_session_state()
+        
+        # Embeddings held by the shared cache are found there again by encode_image
+        with self.image_lock:
+            cached = self.embedding_cache is not None and self.image_key in self.embedding_cache
+            if self.image_embeddings_pt is not None and not cached:
+                state["embeddings"] = { "embeddings": self.image_embeddings_pt, "original_sizes": self.image_sizes }
+        return state
+    
+    def load_session_state(self, state: dict):
+        super().load_session_state(state)
+        entry = state.get("embeddings")
+        if entry is not None:
+            with self.image_lock:
+                self.image_embeddings_pt = entry["embeddings"]
+                self.image_sizes = entry["original_sizes"]
+    
+    def predict_mask(self, embeddings: list[torch.Tensor], image_sizes: torch.Tensor, 
+                     points: torch.Tensor, labels: torch.Tensor) -> np.ndarray:
+        """Run the prompt decoder for the given points and return the mask at the image size."""
+        
+        # Run the prompt decoder, batched with other sessions if enabled
+        with record_range("sam2_prompt_processor"):
+            inputs = self.processor(
+                original_sizes=image_sizes, 
+                input_points=points, 
+                input_labels=labels, 
+                return_tensors="pt").to(self.model.device)
+        request = (embeddings, inputs["input_points"], inputs["input_labels"])
+        with record_range("sam2_prompt_decoder"):
+            if self.scheduler is not None:
+                key = (tuple(request[1].shape), tuple(tuple(e.shape) for e in request[0]))
+                pred_masks = self.scheduler.submit(key, request)
+            else:
+                pred_masks = self.decode_prompt_batch(self.model, [request])[0]
+            
+        # Store the raw mask and the prompts for debugging
+        dump_dir = self.config.sam2_debug_dump_dir
+        if dump_dir:
+            sitk.WriteImage(sitk.GetImageFromArray(pred_masks.squeeze().detach().cpu().numpy()), 
+                            os.path.join(dump_dir, 'masksam.nii.gz'))
+            with open(os.path.join(dump_dir, 'sam_inputs.json'), 'wt') as f:
+                json.dump({ 'points': points.detach().cpu().numpy().tolist(),
+                            'labels': labels.detach().cpu().numpy().tolist() }, f, indent=2)
+
+        # Resize the mask to original image size and return it as numpy array
+        with record_range("sam2_postprocess"):
+            m = self.processor.post_process_masks(
+                pred_masks.cpu(), 
+                inputs["original_sizes"])
+            return np.array(m[0][0,0,:,:])
         
     def add_point_interaction(self, index_itk: list[int], include_interaction: bool):
+        self.add_point_interactions([{ "index_itk": index_itk, "include_interaction": include_interaction }])
+        
+    def add_point_interactions(self, points: list[dict]):
         
-        # Map the ITK index to expected format
-        input_points = torch.tensor([[[[index_itk[0], index_itk[1]]]]], dtype=torch.float32)
-        input_labels = torch.tensor([[[1 if include_interaction else 0]]])
+        # Map the ITK indices to expected format
+        input_points = torch.tensor([[[ p["index_itk"][:2] for p in points ]]], dtype=torch.float32)
+        input_labels = torch.tensor([[[ 1 if p["include_interaction"] else 0 for p in points ]]])
         
         # Append these to the existing interactions
         self.all_points = input_points if self.all_points is None else torch.cat([self.all_points, input_points], dim=-2)
         self.all_labels = input_labels if self.all_labels is None else torch.cat([self.all_labels, input_labels], dim=-1)
         
         # Prepare inputs
-        print(f'Interactions {self.all_points.detach().cpu().numpy().squeeze()} with labels {self.all_labels.detach().cpu().numpy().squeeze()}')
-        inputs = self.processor(
-            images=self.image_arr if self.image_embeddings_pt is None else None,
-            original_sizes=self.image_sizes if self.image_embeddings_pt is not None else None, 
-            input_points=self.all_points, 
-            input_labels=self.all_labels, 
-            return_tensors="pt").to(self.model.device)
-    
-        # Run inference
-        with torch.no_grad():
-            outputs = self.model(**inputs, 
-                                 multimask_output=False,
-                                 # input_masks=self.mask_pt,
-                                 image_embeddings=self.image_embeddings_pt)
-            
-        # DEBUG: store the mask in raw form
-        sitk.WriteImage(sitk.GetImageFromArray(outputs.pred_masks.squeeze().detach().cpu().numpy()), '/tmp/masksam.nii.gz')
-        with open('/tmp/sam_inputs.json', 'wt') as f:
-            json.dump({ 'points': self.all_points.detach().cpu().numpy().tolist(),
-                        'labels': self.all_labels.detach().cpu().numpy().tolist() }, f, indent=2)
-
-        # Get and store the best mask
-        # self.mask_pt = outputs.pred_masks[:,0,:,:]
+        if request_log.isEnabledFor(logging.DEBUG):
+            request_log.debug('Interactions %s with labels %s', self.all_points.detach().cpu().numpy().squeeze(), 
+                              self.all_labels.detach().cpu().numpy().squeeze())
         
-        # Store the image embeddings for next interaction
-        self.image_embeddings_pt = outputs.image_embeddings
-        self.image_sizes = inputs["original_sizes"]
-
-        # Resize the mask to original image size and store as numpy array
-        m = self.processor.post_process_masks(
-            outputs.pred_masks.cpu(), 
-            inputs["original_sizes"])
-        self.mask_arr = np.array(m[0][0,0,:,:])
+        # Wait for the image embeddings, which are usually computed in the background at upload
+        self.encode_image()
+        self.mask_arr = self.predict_mask(self.image_embeddings_pt, self.image_sizes, self.all_points, self.all_labels)
     
     def reset_interactions(self):
         
@@ -236,34 +844,233 @@ class SAM2Wrapper(ModelWrapper):
         self.mask_pt = None
         self.all_points = None
         self.all_labels = None
+        self.mask_arr = np.zeros(self.image_arr.shape[1:3], dtype=np.uint8) if self.image_arr is not None else None
+        
+    def new_object(self):
+        self.reset_interactions()
+    
+    def get_result_array(self) -> np.ndarray:
+        return self.mask_arr
     
     def get_result(self) -> sitk.Image:
         # Generate an ITK image for the mask
-        mask_itk = sitk.GetImageFromArray(self.mask_arr.astype(np.uint8))
-        mask_itk.CopyInformation(self.image_itk)
+        mask_itk = sitk.GetImageFromArray(self.get_result_array().astype(np.uint8))
+        if self.image_itk is not None:
+            mask_itk.CopyInformation(self.image_itk)
         return mask_itk
 
-def get_model_listing():
-    """Return a list of available models and their capabilities."""
-    models = [ nnInteractiveWrapper, SAM2Wrapper ]
-    model_list = []
-    for model in models:
-        model_info = {
-            "id": model.ID,
-            "channels": model.CHANNELS,
-            "dimensions": model.DIMENSIONS,
-            "interactions": model.INTERACTIONS
-        }
-        model_list.append(model_info)   
-    return model_list
 
+class SAM2VolumeWrapper(SAM2Wrapper):
+    """
+    SAM2 on the slices of a 3D image that is uploaded once. Each point interaction gives the
+    axis (in ITK index order) of the slice it was placed on, and the slice index is taken from
+    the point. Slice embeddings are precomputed in a background thread, from the current slice 
+    outward, within a per-session memory budget. The result is a volume holding the masks of 
+    all the slices that were segmented.
+    """
+    
+    DIMENSIONS = 3
+    ID = "SAM2Volume"
+    OBJECT_ATTRS = [ "prompts", "result_arr" ]
+    
+    def __init__(self, config: SegmentServerConfig = global_config, progress: ProgressCallback = no_progress):
+        super().__init__(config, progress)
+        self.volume = None
+        self.result_arr = None
+        
+        # Points and labels of each (axis, slice), and the embeddings of the slices
+        self.prompts = {}
+        self.slice_embeddings = {}
+        self.slice_nbytes = None
+        
+        # The slice the user is working on, the image generation, and the precompute thread
+        self.focus = (2, 0)
+        self.generation = 0
+        self.precompute_thread = None
+        self.pending_clicks = 0
+        
+    def warm_up(self):
+        
+        # Run the image encoder and the prompt decoder on a small random volume
+        dummy = sitk.GetImageFromArray(np.random.default_rng(0).random((2, 256, 256), dtype=np.float32) * 255)
+        self.set_image(dummy)
+        self.add_point_interaction([128, 128, 0], include_interaction=True)
+        self.set_image(dummy)
+        
+    def set_image_array(self, array: np.ndarray, components: int = 1):
+        self.image_itk = None
+        
+        # Validate input dimensions
+        if not (components == 1 and array.ndim == 3) and not (components == 3 and array.ndim == 4):
+            raise ValueError("Input image must be 3D with 1 or 3 components per pixel")
+        
+        # Replace the volume, which makes the background thread drop its work
+        with self.image_lock:
+            self.volume = array
+            self.generation += 1
+            self.slice_embeddings = {}
+            self.focus = (2, array.shape[0] // 2)
+        self.result_arr = np.zeros(array.shape[:3], dtype=np.uint8)
+        self.prompts = {}
+        self.discard_objects()
+        
+    @staticmethod
+    def slice_index(axis: int, index: int) -> tuple:
+        """Numpy index of a slice along an axis given in ITK order."""
+        return (slice(None),) * (2 - axis) + (index,)
+        
+    def encode_slice(self, axis: int, index: int, generation: int = None) -> dict:
+        """Return the embeddings of a slice, computing them if needed."""
+        with self.encode_lock:
+            with self.image_lock:
+                entry = self.slice_embeddings.get((axis, index))
+                if entry is not None or (generation is not None and generation != self.generation):
+                    return entry
+                volume, generation = self.volume, self.generation
+            
+            # Add the batch dimension, and the channel dimension for grayscale images
+            image_arr = volume[self.slice_index(axis, index)]
+            image_arr = image_arr[None] if image_arr.ndim == 3 else image_arr[None, :, :, None]
+            entry = self.run_image_encoder(image_arr)
+            with self.image_lock:
+                if generation == self.generation:
+                    self.slice_embeddings[(axis, index)] = entry
+                    self.slice_nbytes = self.slice_nbytes or sum(memory_footprint([entry]))
+            return entry
+        
+    def next_slice_to_encode(self):
+        """
+        Pick the missing slice nearest to the focus among the slices that fit in the budget, 
+        evicting a slice outside of that window to make room. Called with the image lock held.
+        """
+        axis, center = self.focus
+        n = self.volume.shape[2 - axis]
+        capacity = max(1, self.config.sam2_volume_embedding_budget // self.slice_nbytes) if self.slice_nbytes else 1
+        window = [ center + d * sign for d in range(n) for sign in ((1,) if d == 0 else (1, -1)) 
+                   if 0 <= center + d * sign < n ][:capacity]
+        wanted = { (axis, i) for i in window }
+        
+        # Evict the slice farthest from the focus, slices on other axes first
+        def evict():
+            evictable = [ k for k in self.slice_embeddings if k not in wanted ]
+            if evictable:
+                del self.slice_embeddings[max(evictable, key=lambda k: (k[0] != axis, abs(k[1] - center)))]
+            return bool(evictable)
+        
+        # Slices encoded on demand may have taken the cache over its budget
+        while len(self.slice_embeddings) > capacity and evict():
+            pass
+        for i in window:
+            if (axis, i) not in self.slice_embeddings:
+                if len(self.slice_embeddings) >= capacity and not evict():
+                    return None
+                return (axis, i)
+        return None
+        
+    def precompute(self, generation: int):
+        while True:
+            with self.image_lock:
+                # Give way to clicks waiting for their slice
+                if self.pending_clicks > 0:
+                    target = ()
+                else:
+                    target = self.next_slice_to_encode() if generation == self.generation else None
+                if target is None:
+                    self.precompute_thread = None
+                    return
+            if target:
+                self.encode_slice(*target, generation)
+            else:
+                time.sleep(0.001)
+                
+    def start_precompute(self):
+        with self.image_lock:
+            if self.volume is not None and self.precompute_thread is None:
+                self.precompute_thread = threading.Thread(target=self.precompute, args=(self.generation,),
+                                                          name='sam2-volume-precompute', daemon=True)
+                self.precompute_thread.start()
+    
+    def encode_image(self):
+        # Return right away, the slices are encoded by the precompute thread
+        self.start_precompute()
+        
+    def embedding_ready(self) -> bool:
+        with self.image_lock:
+            return self.focus in self.slice_embeddings
+    
+    def save_session_state(self) -> dict:
+        state = super().save_session_state()
+        with self.image_lock:
+            state["slice_embeddings"] = dict(self.slice_embeddings)
+            state["focus"] = self.focus
+        return state
+    
+    def load_session_state(self, state: dict):
+        super().load_session_state(state)
+        with self.image_lock:
+            self.slice_embeddings = dict(state["slice_embeddings"])
+            for entry in self.slice_embeddings.values():
+                self.slice_nbytes = self.slice_nbytes or sum(memory_footprint([entry]))
+            self.focus = state["focus"]
+        
+    def add_point_interaction(self, index_itk: list[int], include_interaction: bool, axis: int = 2):
+        self.add_point_interactions([{ "index_itk": index_itk, "include_interaction": include_interaction, "axis": axis }])
+        
+    def add_point_interactions(self, points: list[dict]):
+        # Segment each slice once, for runs of points on the same slice
+        while points:
+            axis = points[0].get("axis", 2)
+            if axis not in (0, 1, 2):
+                raise ValueError("Slice axis must be 0, 1 or 2")
+            index = int(points[0]["index_itk"][axis])
+            n = 1
+            while n < len(points) and points[n].get("axis", 2) == axis and int(points[n]["index_itk"][axis]) == index:
+                n += 1
+            self.add_slice_points(axis, index, points[:n])
+            points = points[n:]
+            
+    def add_slice_points(self, axis: int, index: int, points: list[dict]):
+        
+        # Move the focus to the slice of the points, so that precomputation continues around it
+        with self.image_lock:
+            self.focus = (axis, index)
+            self.pending_clicks += 1
+        try:
+            entry = self.encode_slice(axis, index)
+        finally:
+            with self.image_lock:
+                self.pending_clicks -= 1
+        self.start_precompute()
+        
+        # The points within the slice, in the order of the slice's columns and rows
+        xy = [ [ c for i, c in enumerate(p["index_itk"]) if i != axis ] for p in points ]
+        input_points = torch.tensor([[xy]], dtype=torch.float32)
+        input_labels = torch.tensor([[[ 1 if p["include_interaction"] else 0 for p in points ]]])
+        
+        # Append these to the existing interactions on this slice
+        points, labels = self.prompts.get((axis, index), (None, None))
+        points = input_points if points is None else torch.cat([points, input_points], dim=-2)
+        labels = input_labels if labels is None else torch.cat([labels, input_labels], dim=-1)
+        self.prompts[(axis, index)] = (points, labels)
+        
+        # Segment the slice and store the mask in the result volume
+        mask = self.predict_mask(entry["embeddings"], entry["original_sizes"], points, labels)
+        self.result_arr[self.slice_index(axis, index)] = mask
+        
+    def reset_interactions(self):
+        self.prompts = {}
+        if self.result_arr is not None:
+            self.result_arr[:] = 0
+            
+    def new_object(self):
+        self.prompts = {}
+        if self.result_arr is not None:
+            self.result_arr = np.zeros_like(self.result_arr)
+            
+    def get_result_array(self) -> np.ndarray:
+        return self.result_arr
+    
 
-def instantiate_model_wrapper(repo_id: str, config: SegmentServerConfig = global_config) -> ModelWrapper:
-    """Instantiate a model wrapper based on the given repo ID."""
-    if repo_id == nnInteractiveWrapper.ID:
-        return nnInteractiveWrapper(config)
-    elif repo_id == SAM2Wrapper.ID:
-        return SAM2Wrapper(config)
-    else:
-        raise ValueError(f"Unknown model repo ID: {repo_id}")
-
+# Register the wrapper classes, which replaces their static catalog entries
+for wrapper_class in [ nnInteractiveWrapper, SAM2Wrapper, SAM2VolumeWrapper ]:
+    register_model_wrapper(wrapper_class)
@@ -1,18 +1,32 @@
 from typing import Callable
-from fastapi import FastAPI, UploadFile, File, Request, Response, HTTPException, Form, Query
+from fastapi import FastAPI, UploadFile, File, Request, Response, HTTPException, Form, Query, Header
+from fastapi import WebSocket, WebSocketDisconnect
 from fastapi.routing import APIRoute
 from fastapi.exceptions import RequestValidationError
+from fastapi.responses import PlainTextResponse, FileResponse
 from importlib.metadata import version
-from .session import session_manager, PREPARED_SESSION_ID
-from .segment import get_model_listing, instantiate_model_wrapper, nnInteractiveWrapper
-import SimpleITK as sitk
+from .session import session_manager, session_pool, Session
+from .codec import changed_region, region_to_itk, encode_mask, check_codec, available_codecs, ImageDecoder
+from .codec import pack_frame
+from .config import global_config, ProgressCallback, no_progress
+from .catalog import get_model_listing, instantiate_model_wrapper, DEFAULT_MODEL_ID
+from .execution import session_executor
+from .image_store import image_store, StoredImage
+from .coalesce import click_coalescer, PendingClick
+from .metrics import metrics, request_log, StageTimer
+from .profiling import request_profiler
+from .recorder import request_recorder, RecordingMiddleware
+from .lazy import loaded_torch
+from .history import PackedStep
 import base64
 import numpy as np
 import gzip
+import zlib
 import time
 import json
 import asyncio
 import logging
+import threading
 from contextlib import asynccontextmanager
 
 # API debugging
@@ -37,26 +51,188 @@ class ValidationErrorLoggingRoute(APIRoute):
 # app.router.route_class = ValidationErrorLoggingRoute
 
 # This is a task that creates a new segmentation session
-async def create_segment_session(repo_id: str):
+async def create_segment_session(repo_id: str, progress: ProgressCallback = no_progress):
     t0 = time.perf_counter()
-    seg = instantiate_model_wrapper(repo_id)
+    seg = await session_executor.run_loader(instantiate_model_wrapper, repo_id, progress=progress)
     t1 = time.perf_counter()
     logging.getLogger("uvicorn.info").info(
         f'New segmentation session initialized in {(t1-t0):0.2f} seconds')
     return seg    
 
+# This is a task that creates the model for a session that was started in the loading state
+async def load_session_model(entry: Session):
+    try:
+        # Grab a prepared segmentation session if one is available, otherwise create one
+        seg = session_pool.acquire(entry.model_id)
+        if seg is None:
+            seg = await create_segment_session(entry.model_id, progress=entry.set_progress)
+        entry.set_ready(seg)
+    except Exception as e:
+        logging.getLogger("uvicorn.error").error(f'Failed to create session {entry.session_id}: {e}')
+        entry.set_failed(str(e))
+
+# This creates the model wrapper of a hibernated session that is being restored, in a worker thread
+def create_restored_session(repo_id: str):
+    seg = session_pool.acquire(repo_id)
+    return seg if seg is not None else instantiate_model_wrapper(repo_id)
+
+# Get a session for a request, waiting for it to finish loading or to be restored from hibernation
+async def get_ready_entry(session_id: str) -> Session:
+    entry = session_manager.get_entry(session_id)
+    if entry is None or entry.state == "ready":
+        return entry
+    if entry.state == "hibernated":
+        await session_executor.run_maintenance(entry, session_manager.restore, entry)
+        return entry
+    
+    # Wait for the model to load, then ask the client to retry
+    if entry.state == "loading":
+        try:
+            await asyncio.wait_for(asyncio.shield(entry.loading_task), global_config.session_ready_timeout)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=503, detail=entry.status(), headers={"Retry-After": "2"})
+    if entry.state == "failed":
+        raise HTTPException(status_code=500, detail=entry.status())
+    return entry
+
+# This creates a segmentation session for the prepared session pool, running in a worker thread
+def prepare_segment_session(repo_id: str):
+    t0 = time.perf_counter()
+    seg = instantiate_model_wrapper(repo_id)
+    seg.warm_up()
+    t1 = time.perf_counter()
+    logging.getLogger("uvicorn.info").info(
+        f'Prepared segmentation session for {repo_id} in {(t1-t0):0.2f} seconds')
+    return seg
+
+# Import the model wrappers and the frameworks they use (torch, SimpleITK, huggingface_hub) in 
+# the background once the server is up, so that /status and /v2/models are served right away 
+# and the first session does not wait for the imports. SAM2's transformers classes are only 
+# imported when a SAM2 model is loaded.
+def import_frameworks():
+    t0 = time.perf_counter()
+    from . import segment
+    import torch
+    if torch.cuda.is_available():
+        device = torch.cuda.current_device()
+        print(f'Using GPU {device}: {torch.cuda.get_device_name(device)}')
+    else:
+        print(f'No GPU available, using {global_config.device}.')
+    logging.getLogger("uvicorn.info").info(
+        f'Imported deep learning frameworks in {time.perf_counter()-t0:0.2f} seconds')
+
+# Periodically evict or hibernate idle sessions and enforce memory budgets
+async def evict_sessions_periodically(interval: float = 30.0):
+    while True:
+        await asyncio.sleep(interval)
+        for entry in await session_executor.run_unlocked(session_manager.evict):
+            await session_executor.run_maintenance(entry, session_manager.hibernate, entry)
+
 # Create a lifestyle function
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # Configure the worker threads
+    session_executor.configure(global_config.n_worker_threads)
+    
+    # Configure session eviction
+    session_manager.configure(idle_ttl=global_config.session_idle_ttl,
+                              host_memory_budget=global_config.host_memory_budget,
+                              device_memory_budget=global_config.device_memory_budget)
+    session_manager.configure_hibernation(global_config.hibernate_dir, 
+                                          global_config.session_hibernate_after, create_restored_session)
+    eviction_task = asyncio.create_task(evict_sessions_periodically())
+    
+    # Configure where request profiles are written, and the request recorder
+    request_profiler.configure(global_config.profile_dir)
+    request_recorder.configure(global_config.record_requests_path)
+    
+    # Import the frameworks in the background, then start filling the prepared session pool
+    threading.Thread(target=import_frameworks, name='itksnap-dls-imports', daemon=True).start()
+    session_pool.configure(prepare_segment_session, global_config.session_pool_sizes)
     yield
+    eviction_task.cancel()
+    session_executor.shutdown()
 
 # Create the app
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(RecordingMiddleware)
 
 @app.get("/status")
 def check_status():
     return {"status": "ok", "version": version("itksnap-dls")}
 
+@app.get("/v2/server_stats")
+def server_stats():
+    """
+    Report session memory usage, eviction counters, inference batching and embedding cache statistics.
+    """
+    from .segment import model_registry
+    return {"sessions": session_manager.stats(), "batching": model_registry.batching_stats(),
+            "coalescing": click_coalescer.stats(),
+            "embedding_cache": model_registry.cache_stats(), "images": image_store.stats()}
+
+@app.get("/metrics")
+def get_metrics():
+    """
+    Server metrics in the Prometheus text format: histograms of the time spent in each stage of
+    handling a request and of the payload sizes, by endpoint and model, and the current sessions,
+    queue depths and device memory.
+    """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+def torch_allocated_bytes():
+    values = []
+    torch = loaded_torch()
+    if torch is None:
+        return values
+    if torch.cuda.is_available():
+        for i in range(torch.cuda.device_count()):
+            values.append(({"device": f"cuda:{i}"}, torch.cuda.memory_allocated(i)))
+    if torch.backends.mps.is_available():
+        values.append(({"device": "mps"}, torch.mps.current_allocated_memory()))
+    return values
+
+metrics.collector("itksnap_dls_sessions", "Number of sessions in each state",
+                  lambda: [ ({"state": s}, n) for s, n in session_manager.queue_stats()["states"].items() ])
+metrics.collector("itksnap_dls_queued_requests", "Requests waiting for their session to finish earlier work",
+                  lambda: [ ({}, session_manager.queue_stats()["queued_requests"]) ])
+metrics.collector("itksnap_dls_pending_clicks", "Point prompts waiting for their session's model",
+                  lambda: [ ({}, session_manager.queue_stats()["pending_clicks"]) ])
+metrics.collector("itksnap_dls_torch_allocated_bytes", "Memory allocated by torch on each device",
+                  torch_allocated_bytes)
+metrics.collector("itksnap_dls_saved_inferences_total", "Inferences saved by merging queued clicks",
+                  lambda: [ ({}, click_coalescer.stats()["saved_inferences"]) ], kind="counter")
+
+@app.post("/v2/admin/profile")
+def arm_profile(session_id: str = None, model_id: str = None, requests: int = Query(1, ge=1, le=100), 
+                sampling: bool = True):
+    """
+    Profile the next requests of a session, or of all sessions of a model, with torch.profiler
+    and, if sampling is set, a sampling profiler of the Python stack. Each profiled request writes
+    a Chrome trace and a file of sampled stacks, which are listed by /v2/admin/profiles.
+    """
+    if session_id is not None and session_manager.get_entry(session_id) is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    capture = request_profiler.arm(session_id, model_id, requests, sampling)
+    return capture.info()
+
+@app.get("/v2/admin/profiles")
+def list_profiles():
+    """
+    List the profile files that were written, and the captures that are still armed.
+    """
+    return {"files": request_profiler.list_files(), **request_profiler.stats()}
+
+@app.get("/v2/admin/profiles/{name}")
+def get_profile(name: str):
+    """
+    Download a profile file. Traces (.trace.json) open in chrome://tracing or Perfetto.
+    """
+    path = request_profiler.path(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, media_type="application/json", filename=name)
+
 @app.get("/v2/models")
 async def list_models_v2():
     """
@@ -66,192 +242,747 @@ async def list_models_v2():
     """
     mlist = get_model_listing()
     return {"models": mlist}
+
+@app.get("/v2/codecs")
+def list_codecs():
+    """
+    List the result codecs that clients can request with the codec parameter.
+    """
+    return {"codecs": available_codecs()}
     
 @app.get("/v2/start_session/{model_id}")
-async def start_session_v2(model_id: str):
+async def start_session_v2(model_id: str, wait: bool = True):
     """
     Start a new segmentation session with the specified model.
     repo_id: The Huggingface repository ID of the model to use.
+    wait: If false, return the session id right away while the model loads in the background.
+    Use /v2/session_status to follow the loading progress.
     """
+    if model_id not in [m["id"] for m in get_model_listing()]:
+        raise HTTPException(status_code=404, detail=f"Unknown model repo ID: {model_id}")
+    
+    # Create the session in the loading state and construct the model in the background
+    session_id = session_manager.create_session(None, model_id=model_id)
+    entry = session_manager.get_entry(session_id)
+    entry.loading_task = asyncio.create_task(load_session_model(entry))
     
-    # Grab a hopefully existing prepared segmentation session and assign to client session
-    s = await create_segment_session(model_id)
-    session_id = session_manager.create_session(s)
+    # Optionally wait for the model to be ready
+    if wait:
+        try:
+            await asyncio.shield(entry.loading_task)
+        except asyncio.CancelledError:
+            # The client went away without learning the session ID, so no one can use it. The
+            # model finishes loading in the background and is discarded with the entry
+            session_manager.delete_session(session_id)
+            raise
+        if entry.state == "failed":
+            session_manager.delete_session(session_id)
+            raise HTTPException(status_code=500, detail=entry.message)
 
     # Return the session id    
-    return {"session_id": session_id}
+    return {"session_id": session_id, "state": entry.state}
+
+
+@app.get("/v2/session_status/{session_id}")
+def session_status(session_id: str):
+    """
+    Report whether a session is loading, ready or failed, with the loading progress, and 
+    whether the embedding of the uploaded image is ready for interactions.
+    """
+    entry = session_manager.get_entry(session_id)
+    if entry is None:
+       return {"error": "Invalid session"}
+    return entry.status()
 
 
 @app.get("/start_session")
 async def start_session():
-    return await start_session_v2(model_id=nnInteractiveWrapper.ID)
+    return await start_session_v2(model_id=DEFAULT_MODEL_ID)
 
 
-def read_sitk_image(contents, metadata):
-    print(f'arr_gz size: {len(contents)}, first byte: {contents[0]:d}, second byte: {contents[1]:d}')
-    contents_raw = gzip.decompress(contents)
-    array = np.frombuffer(contents_raw, dtype=np.float32)
+def read_image_array(contents, metadata):
+    decoder = ImageDecoder(json.loads(metadata))
+    decoder.feed(contents)
+    return decoder.finish(), decoder.components
 
-    # Reshape the array
-    metadata_dict = json.loads(metadata)
-    if metadata_dict['components_per_pixel'] != 1:
-        dim = metadata_dict['dimensions'][::-1] + [metadata_dict['components_per_pixel']]
-        array = array.reshape(dim)
-        sitk_image = sitk.GetImageFromArray(array, isVector=True)
-    else:
-        dim = metadata_dict['dimensions'][::-1]
-        array = array.reshape(dim)
-        sitk_image = sitk.GetImageFromArray(array, isVector=False)
+
+def read_image_interaction(entry: Session, kind: str, contents, metadata, foreground: bool) -> PackedStep:
+    """
+    Decode a scribble or lasso image into a history step that applies it to the session's
+    model. The image is packed when the step is recorded in the undo history.
+    """
+    array, components = read_image_array(contents, metadata)
+    request_log.debug('Received %s image of shape %s with %d components per pixel', kind, array.shape, components)
     
-    # Load the NIFTI image
-    print(f'Received image of shape {sitk_image.GetSize()} with {sitk_image.GetNumberOfComponentsPerPixel()} components per pixel')
+    def apply(array):
+        import SimpleITK as sitk
+        sitk_image = sitk.GetImageFromArray(array, isVector=components != 1)
+        getattr(entry.seg, f'add_{kind}_interaction')(sitk_image, include_interaction=foreground)
+    return PackedStep(apply, array)
+
+
+def create_image_decoder(metadata: str):
+    try:
+        return ImageDecoder(json.loads(metadata), pinned=global_config.pin_upload_memory)
+    except (ValueError, KeyError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f'Invalid image metadata: {e}')
+
+
+def use_stored_image(entry: Session, stored: StoredImage):
+    """Set a session's image from the image store. The caller holds a reference to the image."""
+    
+    # Pass the image to the model, the next result is sent in full
+    try:
+        entry.seg.set_shared_image(stored)
+    except Exception:
+        image_store.release(stored.image_hash)
+        raise
+    entry.set_image_hash(stored.image_hash)
+    entry.reset_results()
+    
+    # Start encoding the image (e.g., SAM2 embeddings) so that it overlaps with the user's first click
+    session_executor.submit_background(entry.seg.encode_image)
+    
+
+def set_session_image(entry: Session, decoder: ImageDecoder, t_start: float):
+    
+    # Check that the whole image arrived
+    try:
+        array = decoder.finish()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    timer = StageTimer("upload", entry.model_id, t_start)
+    timer.size("upload", decoder.received)
+    timer.lap("decompress")
     
-    return sitk_image
+    # Add the image to the store, or use the identical copy that is already there
+    with timer.stage("set_image"):
+        image_hash = decoder.hexdigest()
+        use_stored_image(entry, image_store.add(image_hash, array, decoder.components))
     
+    timer.log(shape=array.shape, dtype=array.dtype.name)
+    return {"message": "NIFTI file uploaded and stored in GPU memory", "image_hash": image_hash}
+
+
 @app.post("/v2/upload_raw/{session_id}")    
 @app.post("/upload_raw/{session_id}")
 async def upload_raw(session_id: str, file: UploadFile = File(...), metadata: str = Form(...)):
+    """
+    Upload the image for a session as a gzipped raw array. The metadata is a JSON object with 
+    the dimensions, components_per_pixel and, optionally, the dtype of the pixels.
+    """
     
     # Get the current segmentator session
-    seg = session_manager.get_session(session_id)
-    print(seg)
-    print(seg.__dir__)
-    if seg is None:
+    entry = await get_ready_entry(session_id)
+    if entry is None:
        return {"error": "Invalid session"}
 
-    # Read file into memory
-    contents_gzipped = await file.read()
+    # Decompress the upload in chunks into the image array
+    request_recorder.note(metadata=metadata)
+    decoder = create_image_decoder(metadata)
     t0 = time.perf_counter()
-    sitk_image = read_sitk_image(contents_gzipped, metadata)
-    t1 = time.perf_counter()
+    try:
+        while chunk := await file.read(ImageDecoder.CHUNK_SIZE):
+            await session_executor.run_unlocked(decoder.feed, chunk)
+    except (ValueError, zlib.error) as e:
+        raise HTTPException(status_code=400, detail=f'Invalid image data: {e}')
+    return await session_executor.run(entry, set_session_image, entry, decoder, t0)
+
+
+@app.post("/v2/upload_stream/{session_id}")
+async def upload_stream(session_id: str, request: Request, x_image_metadata: str = Header(...)):
+    """
+    Upload the image for a session as a gzipped raw array in the request body, with the
+    metadata in the X-Image-Metadata header. The image is decompressed while it arrives.
+    """
+    
+    # Get the current segmentator session
+    entry = await get_ready_entry(session_id)
+    if entry is None:
+       return {"error": "Invalid session"}
+
+    # Decompress the body as it is received
+    request_recorder.note(metadata=x_image_metadata)
+    decoder = create_image_decoder(x_image_metadata)
+    t0 = time.perf_counter()
+    try:
+        async for chunk in request.stream():
+            await session_executor.run_unlocked(decoder.feed, chunk)
+    except (ValueError, zlib.error) as e:
+        raise HTTPException(status_code=400, detail=f'Invalid image data: {e}')
+    return await session_executor.run(entry, set_session_image, entry, decoder, t0)
+
+
+@app.get("/v2/has_image/{image_hash}")
+def has_image(image_hash: str):
+    """
+    Check whether the server already has an image, identified by the SHA-256 hash of its key
+    header (codec.image_key_header of the upload metadata) followed by its uncompressed pixel
+    data. If so, /v2/use_image can be called instead of uploading it.
+    """
+    return {"available": image_store.has(image_hash)}
+
+
+@app.post("/v2/use_image/{session_id}/{image_hash}")
+async def use_image(session_id: str, image_hash: str):
+    """
+    Set the image of a session to an image the server already has, without uploading it.
+    """
+    
+    # Get the current segmentator session
+    entry = await get_ready_entry(session_id)
+    if entry is None:
+       return {"error": "Invalid session"}
+    
+    # Take a reference to the stored image, so that it stays available
+    stored = image_store.acquire(image_hash)
+    if stored is None:
+        raise HTTPException(status_code=404, detail=f'Unknown image {image_hash}, it must be uploaded')
+    await session_executor.run(entry, use_stored_image, entry, stored)
+    return {"message": "Image set from the image store", "image_hash": image_hash}
+
+
+def select_result(entry: Session, result_mode: str = "full"):
+    """
+    Take the current segmentation result of a session as the last one sent to the client, and
+    return the result mode, region and mask to send. In "delta" mode, only the bounding box of 
+    voxels that changed since the last result sent is returned, falling back to the full mask 
+    when there is no previous result. The result is that of the session's current object.
+    """
+    # Binarize the result straight from the model buffer into a reusable per-session buffer
+    view = entry.seg.get_result_array()
+    arr = entry.result_buffer
+    if arr is None or arr.shape != view.shape:
+        arr = np.empty(view.shape, dtype=np.uint8)
+    np.greater(view, 0, out=arr)
+    
+    # The current result becomes the last one sent, and the previous one is recycled
+    previous = entry.last_result
+    entry.last_result, entry.result_buffer = arr, previous
+    
+    # Select the full mask or only the changed region
+    if result_mode == "delta" and previous is not None and previous.shape == arr.shape:
+        result_mode = "delta"
+        region = changed_region(arr, previous, out=previous)
+        payload = arr[region] if region is not None else arr[:0]
+    else:
+        result_mode = "full"
+        region = tuple(slice(0, n) for n in arr.shape)
+        payload = arr
+    return result_mode, region, payload
+
+
+def encode_result(entry: Session, result_mode: str = "full", codec: str = None):
+    """
+    Encode the current segmentation result of a session for the client (see select_result).
+    Without a codec, the mask is sent as gzipped base64 in a JSON body, as expected by older 
+    clients. Otherwise the payload is sent as raw bytes encoded with the codec, with the 
+    metadata in the X-Result-* headers.
+    """
+    result_mode, region, payload = select_result(entry, result_mode)
+    ndim = payload.ndim
+    
+    # Legacy JSON response
+    if codec is None:
+        arr_gz = gzip.compress(np.ascontiguousarray(payload).reshape(-1)) if payload.size > 0 else b''
+        response = { "status": "success", "result_mode": result_mode, "result": base64.b64encode(arr_gz),
+                     "label": entry.seg.current_object }
+        if result_mode == "delta":
+            response["region"] = region_to_itk(region, ndim)
+        return response
+    
+    # Binary response
+    data = encode_mask(payload, codec)
+    itk_region = region_to_itk(region, ndim)
+    return Response(content=data, media_type="application/octet-stream", headers={
+        "X-Result-Mode": result_mode,
+        "X-Result-Codec": codec,
+        "X-Result-Label": entry.seg.current_object,
+        "X-Result-Index": ",".join(str(x) for x in itk_region["index"]),
+        "X-Result-Size": ",".join(str(x) for x in itk_region["size"]) })
+
+
+def encode_result_frame(entry: Session, result_mode: str = "full", codec: str = "raw+gzip", request_id = None) -> bytes:
+    """Encode the current segmentation result of a session as a binary WebSocket frame."""
+    result_mode, region, payload = select_result(entry, result_mode)
+    header = { "id": request_id, "status": "success", "result_mode": result_mode, "codec": codec,
+               "label": entry.seg.current_object, **region_to_itk(region, payload.ndim) }
+    return pack_frame(header, encode_mask(payload, codec))
+
+
+def response_size(response) -> int:
+    """Size of an encoded result: a binary frame, a binary response or a legacy JSON body."""
+    if isinstance(response, bytes):
+        return len(response)
+    elif isinstance(response, Response):
+        return len(response.body)
+    elif isinstance(response, dict):
+        return len(response.get("result", b''))
+    return 0
+
+
+def validate_codec(codec: str):
+    if codec is not None:
+        try:
+            check_codec(codec)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+
+# Ways of sending a segmentation result, see select_result
+RESULT_MODES = [ "full", "delta" ]
+
+
+def validate_result_mode(result_mode: str):
+    if result_mode not in RESULT_MODES:
+        raise HTTPException(status_code=400, detail=f'Unsupported result mode "{result_mode}", '
+                                                    f'available result modes: {", ".join(RESULT_MODES)}')
+
+
+def get_history(entry: Session):
+    return entry.history(global_config.history_snapshot_interval, global_config.history_memory_budget)
+
+
+def run_interaction(entry: Session, name: str, interaction: Callable, result_mode: str, codec: str, label: str = None,
+                    encode: Callable = encode_result):
+    """
+    Apply an interaction to the given object (the current one if None) of the session's model
+    and encode the result with encode(entry, result_mode, codec). This runs in a worker thread 
+    while the session's lock is held.
+    """
+    # Switch to the object the interaction is for
+    if label is not None:
+        entry.select_object(label)
+        
+    # Handle the interaction
+    timer = StageTimer(name, entry.model_id)
+    with timer.stage("inference"):
+        interaction()
     
-    # Load NIFTI using SimpleITK
-    seg.set_image(sitk_image)
-    t2 = time.perf_counter()
+    # Add it to the undo history, which may take a snapshot
+    with timer.stage("history"):
+        get_history(entry).record(interaction, entry.seg)
     
-    print(f'Image received\n  t[decode] = {t1-t0:0.6f}\n  t[set_image] = {t2-t1:0.6f}')
+    # Encode the segmentation result
+    with timer.stage("encode"):
+        response = encode(entry, result_mode, codec)
+    timer.size("response", response_size(response))
+    timer.log(result_mode=result_mode, codec=codec)
+    return response
+
+
+def run_point_clicks(entry: Session, click: PendingClick):
+    """
+    Apply the point prompts queued for a session, from the head of the queue up to the given 
+    click, merging those that can be merged into one inference. Only the result of the last
+    click of a batch is encoded, unless a click that will be merged with it is already queued.
+    This runs in a worker thread while the session's lock is held.
+    """
+    while not click.done:
+        batch = click_coalescer.take_batch(entry.pending_clicks)
+        last = batch[-1]
+        try:
+            # Switch to the object the clicks are for
+            if last.label is not None:
+                entry.select_object(last.label)
+                
+            # Handle the interaction, running one inference for all the points
+            timer = StageTimer("handle_point_interaction", entry.model_id)
+            points = [ c.point for c in batch ]
+            with timer.stage("inference"):
+                if len(points) == 1:
+                    entry.seg.add_point_interaction(**points[0])
+                else:
+                    entry.seg.add_point_interactions(points)
+            
+            # Encode the segmentation result, unless it is already stale
+            stale = bool(entry.pending_clicks) and click_coalescer.can_merge(last, entry.pending_clicks[0])
+            if not stale:
+                with timer.stage("encode"):
+                    last.response = last.encode(entry)
+                timer.size("response", response_size(last.response))
+            
+            # Add one undo step per click, as if the clicks had not been merged, which may take a 
+            # snapshot. The points are bound now, since the history replays the steps later
+            steps = [ lambda point=point: entry.seg.add_point_interaction(**point) for point in points ]
+            with timer.stage("history"):
+                get_history(entry).record_all(steps, entry.seg)
+        except Exception as e:
+            for c in batch:
+                c.done, c.error = True, e
+            break
+        
+        for c in batch:
+            c.done, c.superseded = True, c is not last or stale
+        click_coalescer.record(len(batch), len(batch) - 1 + stale)
+        timer.log(clicks=len(batch), stale=stale)
+        
+    if click.error is not None:
+        raise click.error
+
 
-    # Store in session
-    return {"message": "NIFTI file uploaded and stored in GPU memory"}        
+async def submit_point_click(entry: Session, point: dict, label: str, encode: Callable, coalesce: bool) -> PendingClick:
+    """Queue a point prompt for a session and wait until it was applied."""
+    click = PendingClick(point, label, entry.n_requests, encode, coalesce)
+    entry.pending_clicks.append(click)
+    await session_executor.run(entry, run_point_clicks, entry, click)
+    return click
 
 
 @app.get("/v2/process_point_interaction/{session_id}")
-def handle_point_interaction(
+async def handle_point_interaction(
     session_id: str, 
     point: list[int] = Query(...), 
-    foreground: bool = False):
+    foreground: bool = False,
+    axis: int = None,
+    label: str = None,
+    result_mode: str = "full",
+    codec: str = None,
+    coalesce: bool = False,
+    x_result_mode: str = Header(None),
+    x_result_codec: str = Header(None)):
+    """
+    Add a point prompt and return the resulting segmentation. With coalesce=true, points that
+    arrive while the model is busy are merged into one inference, and the requests whose result 
+    is superseded by a later point get {"status": "superseded"} (204 with a codec) instead.
+    """
     
     # Get the current segmentator session
-    seg = session_manager.get_session(session_id)
-    if seg is None:
+    entry = await get_ready_entry(session_id)
+    if entry is None:
        return {"error": "Invalid session"}
+    codec = x_result_codec or codec
+    validate_codec(codec)
+    result_mode = x_result_mode or result_mode
+    validate_result_mode(result_mode)
    
-    print(f'Processing point interaction at {point}, foreground={foreground}')
-   
-    # Handle the interaction
-    t0 = time.perf_counter()
-    seg.add_point_interaction(point, include_interaction=foreground)
-    t1 = time.perf_counter()
-    
-    # Base64 encode the segmentation result
-    arr = np.where(sitk.GetArrayFromImage(seg.get_result()) > 0, 1, 0).astype(np.int8)
-    arr_gz = gzip.compress(arr.tobytes())
-    print(f'arr_gz size: {len(arr_gz)}, first byte: {arr_gz[0]:d}, second byte: {arr_gz[1]:d}')
-    arr_b64 = base64.b64encode(arr_gz) #.decode("utf-8")
-    t2 = time.perf_counter()
-    
-    print(f'handle_point_interaction timing:')
-    print(f'  t[nnInteractive] = {t1-t0:.6f}')
-    print(f'  t[encode] = {t2-t1:.6f}')
-    return { "status": "success", "result": arr_b64 }
+    # Handle the interaction, volume models also take the axis of the slice the point is on
+    slice_args = {} if axis is None else {"axis": axis}
+    click = await submit_point_click(entry, { "index_itk": point, "include_interaction": foreground, **slice_args }, 
+                                     label, lambda entry: encode_result(entry, result_mode, codec), coalesce)
+    if not click.superseded:
+        return click.response
+    if codec is None:
+        return { "status": "superseded", "label": label }
+    return Response(status_code=204, headers={ "X-Result-Mode": "superseded" })
 
 
 @app.get("/process_point_interaction/{session_id}")
-def handle_point_interaction_legacy(session_id: str, x: int, y: int, z: int, foreground: bool = False):
-    return handle_point_interaction(session_id, [x, y, z], foreground)
+async def handle_point_interaction_legacy(session_id: str, x: int, y: int, z: int, foreground: bool = False):
+    return await handle_point_interaction(session_id, [x, y, z], foreground, axis=None, label=None, result_mode="full", codec=None, 
+                                          coalesce=False, x_result_mode=None, x_result_codec=None)
     
 
 @app.post("/process_scribble_interaction/{session_id}")
 async def handle_scribble_interaction(session_id: str, 
                                       file: UploadFile = File(...), 
                                       metadata: str = Form(...), 
-                                      foreground: bool = False):
+                                      foreground: bool = False,
+                                      label: str = None,
+                                      result_mode: str = "full",
+                                      codec: str = None,
+                                      x_result_mode: str = Header(None),
+                                      x_result_codec: str = Header(None)):
     
     # Get the current segmentator session
-    seg = session_manager.get_session(session_id)
-    if seg is None:
+    entry = await get_ready_entry(session_id)
+    if entry is None:
        return {"error": "Invalid session"}
+    codec = x_result_codec or codec
+    validate_codec(codec)
+    validate_result_mode(x_result_mode or result_mode)
    
     # Read squiggle image into memory
+    request_recorder.note(metadata=metadata)
     contents_gzipped = await file.read()
-    sitk_image = read_sitk_image(contents_gzipped, metadata)
+    try:
+        interaction = await session_executor.run_unlocked(read_image_interaction, entry, "scribble", 
+                                                          contents_gzipped, metadata, foreground)
+    except (ValueError, KeyError, TypeError, zlib.error) as e:
+        raise HTTPException(status_code=400, detail=f'Invalid image data: {e}')
 
     # Handle the interaction
-    t0 = time.perf_counter()
-    seg.add_scribble_interaction(sitk_image, include_interaction=foreground)
-    t1 = time.perf_counter()
-    
-    # Base64 encode the segmentation result
-    arr = np.where(sitk.GetArrayFromImage(seg.get_result()) > 0, 1, 0).astype(np.int8)
-    arr_gz = gzip.compress(arr.tobytes())
-    print(f'arr_gz size: {len(arr_gz)}, first byte: {arr_gz[0]:d}, second byte: {arr_gz[1]:d}')
-    arr_b64 = base64.b64encode(arr_gz) #.decode("utf-8")
-    t2 = time.perf_counter()
-    
-    print(f'handle_scribble_interaction timing:')
-    print(f'  t[nnInteractive] = {t1-t0:.6f}')
-    print(f'  t[encode] = {t2-t1:.6f}')
-    return { "status": "success", "result": arr_b64 }
+    return await session_executor.run(entry, run_interaction, entry, "handle_scribble_interaction", 
+                                      interaction, x_result_mode or result_mode, codec, label)
     
 @app.post("/process_lasso_interaction/{session_id}")
 async def handle_lasso_interaction(session_id: str, 
                                       file: UploadFile = File(...), 
                                       metadata: str = Form(...), 
-                                      foreground: bool = False):
+                                      foreground: bool = False,
+                                      label: str = None,
+                                      result_mode: str = "full",
+                                      codec: str = None,
+                                      x_result_mode: str = Header(None),
+                                      x_result_codec: str = Header(None)):
     
     # Get the current segmentator session
-    seg = session_manager.get_session(session_id)
-    if seg is None:
+    entry = await get_ready_entry(session_id)
+    if entry is None:
        return {"error": "Invalid session"}
+    codec = x_result_codec or codec
+    validate_codec(codec)
+    validate_result_mode(x_result_mode or result_mode)
    
     # Read squiggle image into memory
+    request_recorder.note(metadata=metadata)
     contents_gzipped = await file.read()
-    sitk_image = read_sitk_image(contents_gzipped, metadata)
+    try:
+        interaction = await session_executor.run_unlocked(read_image_interaction, entry, "lasso", 
+                                                          contents_gzipped, metadata, foreground)
+    except (ValueError, KeyError, TypeError, zlib.error) as e:
+        raise HTTPException(status_code=400, detail=f'Invalid image data: {e}')
 
     # Handle the interaction
-    t0 = time.perf_counter()
-    seg.add_lasso_interaction(sitk_image, include_interaction=foreground)
-    t1 = time.perf_counter()
-    
-    # Base64 encode the segmentation result
-    arr = np.where(sitk.GetArrayFromImage(seg.get_result()) > 0, 1, 0).astype(np.int8)
-    arr_gz = gzip.compress(arr.tobytes())
-    print(f'arr_gz size: {len(arr_gz)}, first byte: {arr_gz[0]:d}, second byte: {arr_gz[1]:d}')
-    arr_b64 = base64.b64encode(arr_gz) #.decode("utf-8")
-    t2 = time.perf_counter()
-    
-    print(f'handle_lasso_interaction timing:')
-    print(f'  t[nnInteractive] = {t1-t0:.6f}')
-    print(f'  t[encode] = {t2-t1:.6f}')
-    return { "status": "success", "result": arr_b64 }
+    return await session_executor.run(entry, run_interaction, entry, "handle_lasso_interaction", 
+                                      interaction, x_result_mode or result_mode, codec, label)
     
 
+def reset_session_interactions(entry: Session, label: str = None):
+    # Reset the model, the next result is sent in full
+    if label is not None:
+        entry.select_object(label)
+    entry.seg.reset_interactions()
+    get_history(entry).record(lambda: entry.seg.reset_interactions(), entry.seg)
+    entry.last_result = None
+
+
 @app.get("/v2/reset_interactions/{session_id}")
 @app.get("/reset_interactions/{session_id}")
-def handle_reset_interactions(session_id: str):
+async def handle_reset_interactions(session_id: str, label: str = None):
     
     # Get the current segmentator session
-    seg = session_manager.get_session(session_id)
-    if seg is None:
+    entry = await get_ready_entry(session_id)
+    if entry is None:
        return {"error": "Invalid session"}
    
     # Handle the interaction
-    seg.reset_interactions()
-    
-    # Base64 encode the segmentation result
+    await session_executor.run(entry, reset_session_interactions, entry, label)
     return { "status": "success" }
+
+
+def move_in_history(entry: Session, label: str, forward: bool, result_mode: str, codec: str,
+                    encode: Callable = encode_result):
+    if label is not None:
+        entry.select_object(label)
+    history = get_history(entry)
+    timer = StageTimer("redo" if forward else "undo", entry.model_id)
+    with timer.stage("inference"):
+        moved = history.redo(entry.seg) if forward else history.undo(entry.seg)
+    if not moved:
+        raise HTTPException(status_code=409, detail=f'Nothing to {"redo" if forward else "undo"}')
+    with timer.stage("encode"):
+        response = encode(entry, result_mode, codec)
+    timer.size("response", response_size(response))
+    timer.log(result_mode=result_mode, codec=codec)
+    return response
+
+
+@app.get("/v2/undo/{session_id}")
+async def handle_undo(
+    session_id: str, 
+    label: str = None,
+    result_mode: str = "full",
+    codec: str = None,
+    x_result_mode: str = Header(None),
+    x_result_codec: str = Header(None)):
+    """
+    Undo the last interaction on an object (the current one by default) and return the 
+    resulting segmentation. The state is restored from a snapshot rather than by running 
+    the model again for the earlier interactions.
+    """
+    return await handle_move_in_history(session_id, label, False, x_result_mode or result_mode, x_result_codec or codec)
+
+
+@app.get("/v2/redo/{session_id}")
+async def handle_redo(
+    session_id: str, 
+    label: str = None,
+    result_mode: str = "full",
+    codec: str = None,
+    x_result_mode: str = Header(None),
+    x_result_codec: str = Header(None)):
+    """
+    Redo the last undone interaction on an object (the current one by default) and return 
+    the resulting segmentation.
+    """
+    return await handle_move_in_history(session_id, label, True, x_result_mode or result_mode, x_result_codec or codec)
+
+
+async def handle_move_in_history(session_id: str, label: str, forward: bool, result_mode: str, codec: str):
+    
+    # Get the current segmentator session
+    entry = await get_ready_entry(session_id)
+    if entry is None:
+       return {"error": "Invalid session"}
+    validate_codec(codec)
+    validate_result_mode(result_mode)
+    return await session_executor.run(entry, move_in_history, entry, label, forward, result_mode, codec)
+
+
+@app.get("/v2/objects/{session_id}")
+async def list_objects(session_id: str):
+    """
+    List the labels of the objects segmented in a session, the current object first.
+    """
+    entry = await get_ready_entry(session_id)
+    if entry is None or entry.seg is None:
+       return {"error": "Invalid session"}
+    return {"objects": entry.seg.object_labels()}
+
+
+def get_object_result(entry: Session, label: str, result_mode: str, codec: str):
+    if label is not None:
+        entry.select_object(label)
+    return encode_result(entry, result_mode, codec)
+
+
+@app.get("/v2/get_result/{session_id}")
+async def handle_get_result(
+    session_id: str, 
+    label: str = None,
+    result_mode: str = "full",
+    codec: str = None,
+    x_result_mode: str = Header(None),
+    x_result_codec: str = Header(None)):
+    """
+    Return the segmentation of an object (the current one by default) without an interaction.
+    """
+    
+    # Get the current segmentator session
+    entry = await get_ready_entry(session_id)
+    if entry is None:
+       return {"error": "Invalid session"}
+    codec = x_result_codec or codec
+    validate_codec(codec)
+    validate_result_mode(x_result_mode or result_mode)
+    return await session_executor.run(entry, get_object_result, entry, label, x_result_mode or result_mode, codec)
+
+
+@app.get("/v2/delete_object/{session_id}/{label}")
+async def handle_delete_object(session_id: str, label: str):
+    """
+    Discard an object of a session, other than the current one, freeing its buffers.
+    """
+    
+    # Get the current segmentator session
+    entry = await get_ready_entry(session_id)
+    if entry is None:
+       return {"error": "Invalid session"}
+    if label == entry.seg.current_object:
+        raise HTTPException(status_code=400, detail="Cannot delete the current object, select another one first")
+    success = await session_executor.run(entry, entry.delete_object, label)
+    return {"message": "Object deleted" if success else "Invalid object"}
+    
+    
+def run_image_interaction(entry: Session, kind: str, contents_gzipped: bytes, metadata: str, foreground: bool, 
+                          result_mode: str, codec: str, label: str, encode: Callable):
+    """Decode a scribble or lasso image and apply it, in the worker thread that holds the session's lock."""
+    interaction = read_image_interaction(entry, kind, contents_gzipped, metadata, foreground)
+    return run_interaction(entry, f'websocket_{kind}_interaction', interaction, result_mode, codec, label, encode)
+
+
+async def handle_socket_message(session_id: str, message: dict, data: bytes = None):
+    """Handle one message received on a session's WebSocket, returning the frame to send back."""
+    request_id, kind = message.get("id"), message.get("type")
+    entry = await get_ready_entry(session_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Invalid session")
+    
+    # Masks are sent as binary frames, encoded with the codec given in the message
+    result_mode, codec, label = message.get("result_mode", "full"), message.get("codec", "raw+gzip"), message.get("label")
+    validate_codec(codec)
+    validate_result_mode(result_mode)
+    encode = lambda entry, result_mode, codec: encode_result_frame(entry, result_mode, codec, request_id)
+    foreground = bool(message.get("foreground", False))
     
+    # Work is queued for the session without awaiting anything else first, so that messages 
+    # are handled in the order they arrived
+    if kind == "point":
+        point = { "index_itk": [ int(x) for x in message["point"] ], "include_interaction": foreground }
+        if message.get("axis") is not None:
+            point["axis"] = int(message["axis"])
+        click = await submit_point_click(entry, point, label, lambda entry: encode(entry, result_mode, codec),
+                                         bool(message.get("coalesce", True)))
+        return click.response if not click.superseded else { "id": request_id, "status": "superseded" }
+    elif kind in ("scribble", "lasso"):
+        metadata = message["metadata"]
+        metadata = metadata if isinstance(metadata, str) else json.dumps(metadata)
+        return await session_executor.run(entry, run_image_interaction, entry, kind, data, metadata, foreground,
+                                          result_mode, codec, label, encode)
+    elif kind == "reset":
+        await session_executor.run(entry, reset_session_interactions, entry, label)
+        return { "id": request_id, "status": "success" }
+    elif kind in ("undo", "redo"):
+        return await session_executor.run(entry, move_in_history, entry, label, kind == "redo", result_mode, codec, encode)
+    else:
+        raise HTTPException(status_code=400, detail=f'Unknown message type "{kind}"')
+
+
+@app.websocket("/v2/ws/{session_id}")
+async def session_websocket(websocket: WebSocket, session_id: str):
+    """
+    Interaction channel for a session, avoiding the per-request overhead of HTTP and the base64 
+    encoding of JSON results. The client sends JSON text messages of the form
+    
+        {"id": 1, "type": "point", "point": [x, y, z], "foreground": true, "axis": null, 
+         "label": null, "result_mode": "delta", "codec": "packbits+zlib", "coalesce": true}
+    
+    where type is "point", "scribble", "lasso", "reset", "undo" or "redo". Scribble and lasso 
+    messages carry the image metadata in "metadata" and are followed by a binary frame with the
+    gzipped image. Masks are sent back as binary frames made by codec.pack_frame, whose JSON 
+    header holds the id, result mode, codec, label, and the ITK index and size of the region. 
+    Other replies and errors are sent as JSON text messages with the id, a status and a detail.
     
+    Messages are handled in the order they arrive, without waiting for the previous reply. 
+    Points sent while the model is busy are merged into one inference unless "coalesce" is 
+    false, and the points whose result was superseded get a "superseded" status reply.
+    """
+    await websocket.accept()
+    send_lock = asyncio.Lock()
+    tasks = set()
+    
+    async def reply(message: dict, data: bytes):
+        try:
+            response = await handle_socket_message(session_id, message, data)
+        except HTTPException as e:
+            response = { "id": message.get("id"), "status": "error", "code": e.status_code, "detail": e.detail }
+        except (KeyError, TypeError, ValueError, zlib.error) as e:
+            response = { "id": message.get("id"), "status": "error", "code": 400, "detail": f'Invalid message: {e!r}' }
+        except Exception as e:
+            logging.getLogger("uvicorn.error").error(f'Failed to handle {message.get("type")} message: {e!r}')
+            response = { "id": message.get("id"), "status": "error", "code": 500, "detail": str(e) }
+        async with send_lock:
+            if isinstance(response, bytes):
+                await websocket.send_bytes(response)
+            else:
+                await websocket.send_json(response)
+    
+    try:
+        while True:
+            # Messages that are not JSON objects get an error reply, and the connection stays open
+            text = await websocket.receive_text()
+            try:
+                message = json.loads(text)
+                if not isinstance(message, dict):
+                    raise ValueError('Expected a JSON object')
+            except ValueError as e:
+                async with send_lock:
+                    await websocket.send_json({ "id": None, "status": "error", "code": 400, "detail": f'Invalid message: {e}' })
+                continue
+            
+            # The gzipped image of a scribble or lasso is sent in the binary frame that follows
+            data = await websocket.receive_bytes() if message.get("type") in ("scribble", "lasso") else None
+            task = asyncio.create_task(reply(message, data))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        for task in list(tasks):
+            task.cancel()
+
+
 @app.get("/v2/end_session/{session_id}")
 @app.get("/end_session/{session_id}")
 def end_session(session_id: str):
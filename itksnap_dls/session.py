@@ -1,25 +1,382 @@
-import torch
 import uuid
+import threading
+import time
+import asyncio
+import collections
+import os
+import shutil
+from .image_store import image_store
+from .history import InteractionHistory
+from .spill import spill_state, load_state
+from .lazy import loaded_torch
 
 PREPARED_SESSION_ID="prepared_session_id"
 
+class Session:
+    """A client session: the segmentation model wrapper plus bookkeeping used by the manager."""
+    
+    def __init__(self, session_id: str, seg, model_id: str = None):
+        self.session_id = session_id
+        self.seg = seg
+        self.model_id = model_id
+        self.created = self.last_access = time.monotonic()
+        
+        # Loading state, the model wrapper may be created in the background
+        self.state = "ready" if seg is not None else "loading"
+        self.progress = 1.0 if seg is not None else 0.0
+        self.message = ""
+        self.loading_task: asyncio.Task = None
+        
+        # Held while work for this session runs, so that requests do not interleave, the 
+        # number of requests that asked for it, and the number still waiting for it
+        self.lock = asyncio.Lock()
+        self.n_requests = 0
+        self.n_queued = 0
+        
+        # Point prompts waiting for the model, which may be merged into one inference
+        self.pending_clicks = collections.deque()
+        
+        # Last mask sent to the client, used to send only the changed region, and a 
+        # spare buffer of the same size that the next result is written into
+        self.last_result = None
+        self.result_buffer = None
+        
+        # The last result and spare buffer of the objects other than the current one, by label
+        self.object_results = {}
+        
+        # Undo/redo history of each object, by label
+        self.histories: dict[str, InteractionHistory] = {}
+        
+        # Hash of the image this session references in the shared image store
+        self.image_hash = None
+        
+        # Model state written to the spill directory while the session is hibernated
+        self.hibernated_state = None
+        self.spill_dir = None
+        
+    def set_progress(self, fraction: float, message: str):
+        self.progress, self.message = fraction, message
+        
+    def set_ready(self, seg):
+        self.seg = seg
+        self.state, self.progress, self.message = "ready", 1.0, ""
+        
+    def set_failed(self, message: str):
+        self.state, self.message = "failed", message
+        
+    def remove_spill(self):
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+        
+    def select_object(self, label: str):
+        """Switch the model and the result buffers to another object, creating it if needed."""
+        current = self.seg.current_object
+        if label == current:
+            return
+        self.seg.select_object(label)
+        self.object_results[current] = (self.last_result, self.result_buffer)
+        self.last_result, self.result_buffer = self.object_results.pop(label, (None, None))
+        
+    def history(self, interval: int = 10, budget: int = None) -> InteractionHistory:
+        """The undo/redo history of the current object, created with the given settings if needed."""
+        label = self.seg.current_object
+        if label not in self.histories:
+            self.histories[label] = InteractionHistory(interval, budget)
+        return self.histories[label]
+        
+    def delete_object(self, label: str) -> bool:
+        self.object_results.pop(label, None)
+        self.histories.pop(label, None)
+        return self.seg.delete_object(label)
+        
+    def reset_results(self):
+        """Forget the results sent for all objects, after the image changed."""
+        self.last_result = None
+        self.object_results = {}
+        self.histories = {}
+        
+    def set_image_hash(self, image_hash: str):
+        """Switch to a new image in the image store, releasing the previous one."""
+        if self.image_hash is not None:
+            image_store.release(self.image_hash)
+        self.image_hash = image_hash
+        
+    def status(self) -> dict:
+        return { "session_id": self.session_id, "model_id": self.model_id, "state": self.state, 
+                 "progress": self.progress, "message": self.message,
+                 "embedding_ready": self.seg is not None and self.seg.embedding_ready(),
+                 "history": self.histories[self.seg.current_object].stats() 
+                            if self.seg is not None and self.seg.current_object in self.histories else None }
+        
+    def memory_footprint(self) -> tuple[int, int]:
+        """Approximate (host, device) bytes held by this session."""
+        host, device = self.seg.memory_footprint() if hasattr(self.seg, 'memory_footprint') else (0, 0)
+        buffers = [ self.last_result, self.result_buffer ]
+        for results in self.object_results.values():
+            buffers.extend(results)
+        for buffer in buffers:
+            if buffer is not None:
+                host += buffer.nbytes
+        host += sum(h.nbytes for h in self.histories.values())
+        return host, device
+        
+
 class SessionManager:
     
     def __init__(self):
-        self.sessions = {}
+        # Sessions are kept in order of last access, least recently used first
+        self.sessions: dict[str, Session] = {}
+        self.lock = threading.RLock()
+        
+        # Eviction settings, None means no limit
+        self.idle_ttl: float = None
+        self.host_memory_budget: int = None
+        self.device_memory_budget: int = None
+        
+        # Eviction counters
+        self.evicted_sessions = 0
+        self.reclaimed_host_bytes = 0
+        self.reclaimed_device_bytes = 0
+        
+        # Hibernation settings: the directory idle sessions are spilled to (None to disable), the
+        # idle time after which a session is hibernated, and the function that creates a model
+        # wrapper for a model ID when a session is restored
+        self.spill_dir: str = None
+        self.hibernate_after: float = None
+        self.model_factory = None
+        
+        # Hibernation counters
+        self.hibernated_sessions = 0
+        self.restored_sessions = 0
+        
+    def configure(self, idle_ttl: float = None, host_memory_budget: int = None, device_memory_budget: int = None):
+        self.idle_ttl = idle_ttl
+        self.host_memory_budget = host_memory_budget
+        self.device_memory_budget = device_memory_budget
+        
+    def configure_hibernation(self, spill_dir: str, hibernate_after: float = None, model_factory = None):
+        self.spill_dir = spill_dir
+        self.hibernate_after = hibernate_after
+        self.model_factory = model_factory
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
 
-    def create_session(self, session_data, user_session_id=str(uuid.uuid4())):
-        session_id = user_session_id
-        self.sessions[session_id] = session_data
+    def create_session(self, session_data, user_session_id: str = None, model_id: str = None):
+        session_id = user_session_id if user_session_id is not None else str(uuid.uuid4())
+        with self.lock:
+            self.sessions[session_id] = Session(session_id, session_data, model_id)
         return session_id
+    
+    def get_entry(self, session_id) -> Session:
+        with self.lock:
+            entry = self.sessions.pop(session_id, None)
+            if entry is not None:
+                entry.last_access = time.monotonic()
+                self.sessions[session_id] = entry
+            return entry
 
     def get_session(self, session_id):
-        return self.sessions.get(session_id)
+        entry = self.get_entry(session_id)
+        if entry is not None and entry.state == "hibernated":
+            self.restore(entry)
+        return entry.seg if entry is not None else None
 
     def delete_session(self, session_id):
-        if session_id in self.sessions:
-            del self.sessions[session_id]
-            return True
-        return False
+        with self.lock:
+            if session_id in self.sessions:
+                entry = self.sessions.pop(session_id)
+                entry.set_image_hash(None)
+                entry.remove_spill()
+                return True
+            return False
+        
+    def evict(self) -> list[Session]:
+        """Evict sessions that have been idle too long, then least recently used sessions 
+        until the memory budgets are met. Sessions that are loading and sessions with work in
+        progress are never evicted, and the most recently used session is not evicted for
+        memory, only once it has been idle too long. If hibernation is
+        enabled, sessions idle for hibernate_after seconds and sessions over the memory budgets
+        are not deleted but returned, to be hibernated under their lock by the caller."""
+        now = time.monotonic()
+        n_evicted = 0
+        to_hibernate = []
+        with self.lock:
+            footprint = { sid: e.memory_footprint() for sid, e in self.sessions.items() }
+            host_total = sum(f[0] for f in footprint.values())
+            device_total = sum(f[1] for f in footprint.values())
+            entries = list(self.sessions.values())
+            for entry in entries:
+                if entry.lock.locked() or entry.state == "loading":
+                    continue
+                idle = self.idle_ttl is not None and now - entry.last_access > self.idle_ttl
+                mru = entry is entries[-1]
+                over_host = not mru and self.host_memory_budget is not None and host_total > self.host_memory_budget
+                over_device = not mru and self.device_memory_budget is not None and device_total > self.device_memory_budget
+                if not idle and entry.state == "hibernated":
+                    continue
+                if not idle and self.spill_dir and entry.state == "ready":
+                    drowsy = self.hibernate_after is not None and now - entry.last_access > self.hibernate_after
+                    if drowsy or over_host or over_device:
+                        host, device = footprint[entry.session_id]
+                        host_total, device_total = host_total - host, device_total - device
+                        to_hibernate.append(entry)
+                    continue
+                if idle or over_host or over_device:
+                    host, device = footprint[entry.session_id]
+                    host_total, device_total = host_total - host, device_total - device
+                    del self.sessions[entry.session_id]
+                    entry.set_image_hash(None)
+                    entry.remove_spill()
+                    self.evicted_sessions += 1
+                    self.reclaimed_host_bytes += host
+                    self.reclaimed_device_bytes += device
+                    n_evicted += 1
+                    print(f'Evicted session {entry.session_id} idle for {now - entry.last_access:0.0f} seconds, '
+                          f'reclaimed {host / 2**20:0.1f} MB host and {device / 2**20:0.1f} MB device memory')
+            entry = None
+            
+        # Return the memory held by the evicted sessions to the device
+        torch = loaded_torch()
+        if n_evicted > 0 and torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        return to_hibernate
+    
+    def hibernate(self, entry: Session):
+        """
+        Write the model state of an idle session to the spill directory and release the model
+        wrapper. The session keeps its reference to the shared image, its undo/redo history and 
+        the non-array parts of the model state in memory. Call with the session's lock held.
+        """
+        if entry.state != "ready" or entry.seg is None or not self.spill_dir:
+            return
+        t0 = time.perf_counter()
+        host, device = entry.memory_footprint()
+        entry.remove_spill()
+        entry.spill_dir = os.path.join(self.spill_dir, f'{entry.session_id}-{uuid.uuid4().hex[:8]}')
+        os.makedirs(entry.spill_dir)
+        try:
+            entry.hibernated_state = spill_state(entry.seg.save_session_state(), entry.spill_dir)
+        except Exception as e:
+            print(f'Failed to hibernate session {entry.session_id}: {e!r}')
+            entry.remove_spill()
+            return
+        
+        # The results sent to the client are dropped, so the next results are sent in full
+        entry.seg = None
+        entry.state = "hibernated"
+        entry.last_result = entry.result_buffer = None
+        entry.object_results = {}
+        torch = loaded_torch()
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        with self.lock:
+            self.hibernated_sessions += 1
+        print(f'Hibernated session {entry.session_id} in {time.perf_counter() - t0:0.3f} s, '
+              f'released {host / 2**20:0.1f} MB host and {device / 2**20:0.1f} MB device memory')
+        
+    def restore(self, entry: Session):
+        """Bring a hibernated session back with a new model wrapper. Call with the session's lock held."""
+        if entry.state != "hibernated":
+            return
+        t0 = time.perf_counter()
+        seg = self.model_factory(entry.model_id)
+        if entry.image_hash is not None:
+            # The session still holds its reference to the image, this one is only for the lookup
+            stored = image_store.acquire(entry.image_hash)
+            image_store.release(entry.image_hash)
+            seg.set_shared_image(stored)
+        seg.load_session_state(load_state(entry.hibernated_state))
+        
+        # On POSIX systems, the files mapped by the restored arrays stay readable after removal
+        entry.hibernated_state = None
+        entry.remove_spill()
+        entry.set_ready(seg)
+        with self.lock:
+            self.restored_sessions += 1
+        print(f'Restored session {entry.session_id} in {time.perf_counter() - t0:0.3f} s')
+            
+    def queue_stats(self) -> dict:
+        """Number of sessions in each state, and the requests and clicks waiting for their session."""
+        with self.lock:
+            entries = list(self.sessions.values())
+        return {
+            "states": collections.Counter(e.state for e in entries),
+            "queued_requests": sum(e.n_queued for e in entries),
+            "pending_clicks": sum(len(e.pending_clicks) for e in entries)
+        }
+            
+    def stats(self) -> dict:
+        with self.lock:
+            footprint = [ e.memory_footprint() for e in self.sessions.values() ]
+            return {
+                "sessions": len(self.sessions),
+                "host_bytes": sum(f[0] for f in footprint),
+                "device_bytes": sum(f[1] for f in footprint),
+                "evicted_sessions": self.evicted_sessions,
+                "reclaimed_host_bytes": self.reclaimed_host_bytes,
+                "reclaimed_device_bytes": self.reclaimed_device_bytes,
+                "hibernated": sum(e.state == "hibernated" for e in self.sessions.values()),
+                "hibernated_sessions": self.hibernated_sessions,
+                "restored_sessions": self.restored_sessions
+            }
+
+session_manager = SessionManager()  # Singleton instance
+
+class SessionPool:
+    """
+    Keeps a number of initialized and warmed-up segmentation sessions ready for each
+    model ID, so that starting a session does not have to wait for model setup. The
+    pool is refilled in the background whenever a prepared session is handed out.
+    """
+    
+    def __init__(self):
+        self.factory = None
+        self.sizes = {}
+        self.ready = {}
+        self.filling = set()
+        self.lock = threading.Lock()
+        
+    def configure(self, factory, sizes: dict[str, int]):
+        """Set the function that creates a prepared session for a model ID and the pool sizes."""
+        self.factory = factory
+        self.sizes = dict(sizes)
+        for model_id in self.sizes:
+            self.refill(model_id)
+            
+    def acquire(self, model_id: str):
+        """Take a prepared session for the model, or return None if none is ready."""
+        with self.lock:
+            prepared = self.ready.get(model_id)
+            seg = prepared.pop(0) if prepared else None
+        self.refill(model_id)
+        return seg
+    
+    def refill(self, model_id: str):
+        with self.lock:
+            if self.factory is None or self.sizes.get(model_id, 0) <= 0 or model_id in self.filling:
+                return
+            self.filling.add(model_id)
+        threading.Thread(target=self._fill, args=(model_id,), 
+                         name=f'{PREPARED_SESSION_ID}:{model_id}', daemon=True).start()
+        
+    def _fill(self, model_id: str):
+        try:
+            while True:
+                with self.lock:
+                    if len(self.ready.get(model_id, [])) >= self.sizes.get(model_id, 0):
+                        break
+                seg = self.factory(model_id)
+                with self.lock:
+                    self.ready.setdefault(model_id, []).append(seg)
+        except Exception as e:
+            print(f'Failed to prepare a session for model {model_id}: {e}')
+        finally:
+            with self.lock:
+                self.filling.discard(model_id)
+                
+    def size(self, model_id: str) -> int:
+        with self.lock:
+            return len(self.ready.get(model_id, []))
 
-session_manager = SessionManager()  # Singleton instance
\ No newline at end of file
+session_pool = SessionPool()  # Singleton instance
\ No newline at end of file
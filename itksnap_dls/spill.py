@@ -0,0 +1,59 @@
+import os
+import numpy as np
+from .lazy import is_tensor, is_blosc2_array, loaded_torch
+
+
+class SpilledArray:
+    """Placeholder for an array or tensor that was written to a .npy file, or a blosc2 array written to a .b2nd file."""
+
+    def __init__(self, path: str, device = None):
+        self.path = path
+        self.device = device
+
+    def load(self):
+        if self.path.endswith('.b2nd'):
+            # Read the compressed frame back into a writable in-memory array with the same chunks
+            import blosc2
+            with open(self.path, 'rb') as f:
+                return blosc2.ndarray_from_cframe(f.read(), copy=True)
+            
+        # Map the file copy-on-write, so that pages are read on first use and writes stay private
+        array = np.load(self.path, mmap_mode='c')
+        return loaded_torch().from_numpy(array).to(self.device) if self.device is not None else array
+
+
+def spill_state(value, directory: str, counter: list = None):
+    """
+    Write the arrays and tensors in a model state to .npy files in a directory, and return the
+    state with SpilledArray placeholders in their place. Blosc2 arrays are written as they are
+    compressed, to .b2nd files. Other values are kept as they are.
+    """
+    counter = counter if counter is not None else [0]
+    if is_blosc2_array(value):
+        path = os.path.join(directory, f'{counter[0]}.b2nd')
+        counter[0] += 1
+        value.save(path, mode='w')
+        return SpilledArray(path)
+    elif isinstance(value, np.ndarray) or is_tensor(value):
+        device = value.device if is_tensor(value) else None
+        array = value.detach().cpu().numpy() if device is not None else value
+        path = os.path.join(directory, f'{counter[0]}.npy')
+        counter[0] += 1
+        np.save(path, array)
+        return SpilledArray(path, device)
+    elif isinstance(value, dict):
+        return { k: spill_state(v, directory, counter) for k, v in value.items() }
+    elif isinstance(value, (list, tuple)):
+        return type(value)(spill_state(v, directory, counter) for v in value)
+    return value
+
+
+def load_state(value):
+    """Load a model state written by spill_state."""
+    if isinstance(value, SpilledArray):
+        return value.load()
+    elif isinstance(value, dict):
+        return { k: load_state(v) for k, v in value.items() }
+    elif isinstance(value, (list, tuple)):
+        return type(value)(load_state(v) for v in value)
+    return value